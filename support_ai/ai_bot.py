@@ -45,7 +45,8 @@ def main():
         if not query:
             continue
         for token in chain.ask(query, session=session):
-            print(token, end='')
+            print(token, end='', flush=True)
+    chain.close()
 
 
 if __name__ == '__main__':
@@ -2,17 +2,23 @@
 Support-AI API Server
 """
 import argparse
+import atexit
+import logging
+import os
+import time
 
 from flask import Blueprint, Flask, jsonify, request, Response
 from flask_restful import Api, Resource
 from support_ai.lib import const
 from support_ai.lib.chain import Chain
-from support_ai.utils import get_config
+from support_ai.lib.utils import metrics
+from support_ai.utils import get_config, get_filter, start_stream
 
 app = Flask(__name__)
 chain = None  # pylint: disable=invalid-name
 api_blueprint = Blueprint('api', __name__)
 api = Api(api_blueprint)
+logger = logging.getLogger(__name__)
 
 
 class AI(Resource):  # pylint: disable=too-few-public-methods
@@ -23,12 +29,16 @@ class AI(Resource):  # pylint: disable=too-few-public-methods
     def get(self):  # pylint: disable=no-self-use
         """
         Handles GET requests to the /api/ai endpoint. Queries the AI model
-        with the provided query and optional datasource and session arguments.
+        with the provided query and optional datasource, session and metadata
+        filter arguments.
 
         Returns:
             Response: A text/plain response with the model's response or
-            a JSON error message if the query parameter is missing.
+            a JSON error message if the query parameter is missing or the
+            query fails before any output, with a 400 status for invalid
+            arguments and a 500 status for other errors.
         """
+        start = time.monotonic()
         query = request.args.get('query')
         datasource = request.args.get('datasource')
         session = request.args.get('session')
@@ -36,11 +46,19 @@ class AI(Resource):  # pylint: disable=too-few-public-methods
         if query is None:
             return {'message': 'Query not specified'}, 400
         try:
-            return Response(chain.ask(query, ds_type=datasource,
-                                      session=session),
+            where = get_filter(request.args.get('filter'))
+        except ValueError:
+            return {'message': 'Invalid filter'}, 400
+        try:
+            output = start_stream('api.ai', chain.ask(
+                query, ds_type=datasource, session=session, where=where))
+            return Response(metrics.timed_stream('api.ai', output, start),
                             mimetype='text/plain')
         except ValueError:
             return {'message': 'Service unavailable'}, 400
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('Query failed')
+            return {'message': 'Internal server error'}, 500
 
 
 class Salesforce(Resource):  # pylint: disable=too-few-public-methods
@@ -58,19 +76,26 @@ class Salesforce(Resource):  # pylint: disable=too-few-public-methods
 
         Returns:
             Response: A text/plain response with the case summary or a JSON
-            error message if the case number is missing or service is
-            unavailable.
+            error message if the case number is missing or the summary fails
+            before any output, with a 400 status for invalid arguments and a
+            500 status for other errors.
         """
+        start = time.monotonic()
         if case_number is None:
             return {'message': 'Case number not specified'}, 400
 
         data = {const.CASE_NUMBER: case_number}
         try:
-            return Response(chain.custom_api(const.CONFIG_SF,
-                                             const.SUMMARIZE_CASE, data),
-                            mimetype='text/plain')
+            output = start_stream('api.salesforce', chain.custom_api(
+                const.CONFIG_SF, const.SUMMARIZE_CASE, data))
+            return Response(
+                    metrics.timed_stream('api.salesforce', output, start),
+                    mimetype='text/plain')
         except ValueError:
             return {'message': 'Service unavailable'}, 400
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('Case summary failed')
+            return {'message': 'Internal server error'}, 500
 
 
 class History(Resource):  # pylint: disable=too-few-public-methods
@@ -95,6 +120,22 @@ class History(Resource):  # pylint: disable=too-few-public-methods
         return jsonify(success=True)
 
 
+class Metrics(Resource):  # pylint: disable=too-few-public-methods
+    """
+    Resource class for the Metrics endpoint.
+    """
+
+    def get(self):  # pylint: disable=no-self-use
+        """
+        Handles GET requests to the /api/metrics endpoint.
+
+        Returns:
+            Response: A JSON response with the process-wide counters and
+            observations.
+        """
+        return jsonify(metrics.snapshot())
+
+
 def parse_args():
     """
     Parses command-line arguments for the support-ai API server.
@@ -105,6 +146,11 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description='Command line tool for support-ai')
     parser.add_argument('--config', type=str, default=None, help='Config path')
+    parser.add_argument('--asgi', action='store_true',
+                        help='Serve the API with async handlers on an ASGI '
+                             'server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of ASGI worker processes')
     return parser.parse_args()
 
 
@@ -113,16 +159,28 @@ def main():
     Main function to initialize the support-ai server. Loads configuration,
     initializes the Chain, and sets up API routes.
 
-    The server listens on all interfaces at port 8080.
+    The server listens on all interfaces at port 8080. With --asgi, the API
+    is served by uvicorn with async handlers instead of Flask's server.
     """
     global chain  # pylint: disable=global-statement
     args = parse_args()
+    if args.asgi:
+        # pylint: disable=import-outside-toplevel
+        import uvicorn
+        from support_ai.asgi_app import CONFIG_ENV
+        if args.config is not None:
+            os.environ[CONFIG_ENV] = args.config
+        uvicorn.run('support_ai.asgi_app:create_app', factory=True,
+                    host='0.0.0.0', port=8080, workers=args.workers)
+        return
     config = get_config(args.config)
     chain = Chain(config)
+    atexit.register(chain.close)
 
     api.add_resource(AI, '/ai')
     api.add_resource(Salesforce, '/salesforce/<string:case_number>/summary')
     api.add_resource(History, '/history')
+    api.add_resource(Metrics, '/metrics')
 
     app.register_blueprint(api_blueprint, url_prefix='/api')
     app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False)
@@ -0,0 +1,158 @@
+"""
+Support-AI ASGI Application
+
+Serves the same API as the Flask server with async handlers running the
+async call path of the chain, so that slow Salesforce and LLM calls don't
+hold a thread while they wait and one event loop multiplexes many
+concurrent requests.
+"""
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from support_ai.lib import const
+from support_ai.lib.chain import Chain
+from support_ai.lib.utils import metrics
+from support_ai.utils import astart_stream, get_config, get_filter
+
+CONFIG_ENV = 'SUPPORT_AI_CONFIG'
+logger = logging.getLogger(__name__)
+
+
+async def ai(request):
+    """
+    Handles GET requests to the /api/ai endpoint. Queries the AI model
+    with the provided query and optional datasource, session and metadata
+    filter arguments.
+
+    Args:
+        request: The incoming request.
+
+    Returns:
+        Response: A streamed text/plain response with the model's response
+        or a JSON error message if the query parameter is missing or the
+        query fails before any output, with a 400 status for invalid
+        arguments and a 500 status for other errors.
+    """
+    start = time.monotonic()
+    chain = request.app.state.chain
+    query = request.query_params.get('query')
+    datasource = request.query_params.get('datasource')
+    session = request.query_params.get('session')
+
+    if query is None:
+        return JSONResponse({'message': 'Query not specified'}, 400)
+    try:
+        where = get_filter(request.query_params.get('filter'))
+    except ValueError:
+        return JSONResponse({'message': 'Invalid filter'}, 400)
+    try:
+        output = await astart_stream('api.ai', await chain.aask(
+            query, ds_type=datasource, session=session, where=where))
+    except ValueError:
+        return JSONResponse({'message': 'Service unavailable'}, 400)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception('Query failed')
+        return JSONResponse({'message': 'Internal server error'}, 500)
+    return StreamingResponse(
+            metrics.atimed_stream('api.ai', output, start),
+            media_type='text/plain')
+
+
+async def salesforce(request):
+    """
+    Handles GET requests to the /api/salesforce/<case_number>/summary
+    endpoint.
+
+    Args:
+        request: The incoming request.
+
+    Returns:
+        Response: A streamed text/plain response with the case summary or a
+        JSON error message if the summary fails before any output, with a
+        400 status for invalid arguments and a 500 status for other errors.
+    """
+    start = time.monotonic()
+    chain = request.app.state.chain
+    data = {const.CASE_NUMBER: request.path_params['case_number']}
+    try:
+        output = await astart_stream('api.salesforce', await chain.acustom_api(
+            const.CONFIG_SF, const.SUMMARIZE_CASE, data))
+    except ValueError:
+        return JSONResponse({'message': 'Service unavailable'}, 400)
+    except Exception:  # pylint: disable=broad-exception-caught
+        logger.exception('Case summary failed')
+        return JSONResponse({'message': 'Internal server error'}, 500)
+    return StreamingResponse(
+            metrics.atimed_stream('api.salesforce', output, start),
+            media_type='text/plain')
+
+
+async def history(request):
+    """
+    Handles DELETE requests to the /api/history endpoint. Clears the
+    history for the specified session.
+
+    Args:
+        request: The incoming request.
+
+    Returns:
+        Response: A JSON response with success status, or an error
+        message if the session parameter is missing.
+    """
+    session = request.query_params.get('session')
+
+    if session is None:
+        return JSONResponse({'message': 'Session not specified'}, 400)
+    await run_in_threadpool(request.app.state.chain.clear_history, session)
+    return JSONResponse({'success': True})
+
+
+async def get_metrics(request):  # pylint: disable=unused-argument
+    """
+    Handles GET requests to the /api/metrics endpoint.
+
+    Args:
+        request: The incoming request.
+
+    Returns:
+        Response: A JSON response with the process-wide counters and
+        observations.
+    """
+    return JSONResponse(metrics.snapshot())
+
+
+def create_app():
+    """
+    Creates the ASGI application. Every worker process creates its own
+    Chain from the configuration file named by the SUPPORT_AI_CONFIG
+    environment variable, or the default configuration.
+
+    Returns:
+        Starlette: The ASGI application.
+    """
+    config = get_config(os.environ.get(CONFIG_ENV))
+
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.chain = Chain(config)
+        try:
+            yield
+        finally:
+            app.state.chain.close()
+
+    routes = [
+        Mount('/api', routes=[
+            Route('/ai', ai, methods=['GET']),
+            Route('/salesforce/{case_number}/summary', salesforce,
+                  methods=['GET']),
+            Route('/history', history, methods=['DELETE']),
+            Route('/metrics', get_metrics, methods=['GET']),
+        ]),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan)
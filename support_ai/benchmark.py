@@ -0,0 +1,347 @@
+"""
+Support-AI Benchmark Tool
+"""
+
+import argparse
+import random
+import statistics
+import time
+from functools import partial
+
+import chromadb
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from support_ai.lib import const
+from support_ai.lib.datasources.salesforce import (
+  SYMPTOM_INITIAL_PROMPT,
+  SYMPTOM_REFINE_PROMPT,
+)
+from support_ai.lib.model_manager.model_manager import ModelManager
+from support_ai.lib.utils.docs_chain import (
+  DEFAULT_TREE_REDUCE_PARALLELISM,
+  get_strategy,
+  STRATEGY_REFINE,
+  STRATEGY_TREE_REDUCE,
+)
+from support_ai.lib.vectorstore import (
+  COLLECTION_METADATA,
+  get_collection_metadata,
+  VectorStore,
+)
+from support_ai.utils import get_config
+
+INDEX_BATCH_SIZE = 1000
+
+
+def parse_args():
+    """
+    Parses command-line arguments for the support-ai benchmark tool.
+
+    Returns:
+        argparse.Namespace: Parsed arguments, including the config file path
+                            and the selected benchmark.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark tool for support-ai')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Config path')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    vectorstore = subparsers.add_parser(
+        'vectorstore',
+        help='Compare cold and warm vector store query latency')
+    vectorstore.add_argument('--datasource', type=str, required=True,
+                             help='Datasource type to query')
+    vectorstore.add_argument('--query', type=str, required=True,
+                             help='Query text')
+    vectorstore.add_argument('--iterations', type=int, default=10,
+                             help='Number of measured queries per path')
+
+    summarize = subparsers.add_parser(
+        'summarize',
+        help='Compare the latency and output length of the summarization '
+             'strategies')
+    summarize.add_argument('--llm', type=str, required=True,
+                           help='Name of the llm to use')
+    summarize.add_argument('--file', type=str, required=True,
+                           help='Path of the text to summarize')
+    summarize.add_argument('--chunk-size', type=int, default=1024,
+                           help='Chunk size in characters')
+    summarize.add_argument('--parallelism', type=int,
+                           default=DEFAULT_TREE_REDUCE_PARALLELISM,
+                           help='Maximum number of concurrent calls of a '
+                                'tree reduce summary')
+    summarize.add_argument('--iterations', type=int, default=3,
+                           help='Number of measured summaries per strategy')
+
+    index = subparsers.add_parser(
+        'index',
+        help='Compare the recall and latency of vector store index '
+             'parameters on the stored embeddings of a datasource')
+    index.add_argument('--datasource', type=str, required=True,
+                       help='Datasource type whose embeddings are indexed')
+    index.add_argument('--index', type=str, action='append', default=[],
+                       help='Index parameters to compare, such as '
+                            'M=32,construction_ef=200,search_ef=50; may be '
+                            'repeated (default: the configured parameters)')
+    index.add_argument('--queries', type=int, default=100,
+                       help='Number of stored embeddings used as queries')
+    index.add_argument('--k', type=int, default=4,
+                       help='Number of neighbours retrieved per query')
+    index.add_argument('--seed', type=int, default=0,
+                       help='Seed of the query sampling')
+    return parser.parse_args()
+
+
+def get_ds_config(config, ds_type):
+    """
+    Looks up the configuration of a datasource by its type.
+
+    Args:
+        config: The loaded configuration dictionary.
+        ds_type: The datasource type to look up.
+
+    Returns:
+        dict: The datasource configuration.
+
+    Raises:
+        ValueError: If the datasource is not configured.
+    """
+    for ds_config in config.get(const.CONFIG_DATASOURCES, []):
+        if ds_config.get(const.CONFIG_TYPE) == ds_type:
+            return ds_config
+    raise ValueError(f'Unknown datasource type: {ds_type}')
+
+
+def report(name, samples):
+    """
+    Prints latency statistics for a list of samples.
+
+    Args:
+        name: The label of the measured path.
+        samples: The measured latencies in seconds.
+    """
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f'{name}:\tmean {statistics.mean(samples) * 1000:.2f}ms\t'
+          f'median {statistics.median(samples) * 1000:.2f}ms\t'
+          f'p95 {p95 * 1000:.2f}ms')
+
+
+def measure(fn, iterations, setup=None):
+    """
+    Measures the latency of a function.
+
+    Args:
+        fn: The function to measure.
+        iterations: The number of measured calls.
+        setup: An optional function called before each measured call, which
+               is not included in the measurement.
+
+    Returns:
+        list: The measured latencies in seconds.
+    """
+    samples = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def benchmark_vectorstore(config, args):
+    """
+    Compares query latency with a freshly opened vector store (cold), whose
+    database is reopened and whose index is loaded from disk by the query,
+    against the cached handle (warm).
+
+    Args:
+        config: The loaded configuration dictionary.
+        args: Parsed command-line arguments.
+    """
+    ds_config = get_ds_config(config, args.datasource)
+    embeddings = ModelManager(config).get_model(ds_config).embeddings
+    vector_store = VectorStore()
+
+    def query():
+        vector_store.similarity_search(args.datasource, embeddings,
+                                       args.query)
+
+    cold = measure(query, args.iterations, setup=vector_store.close)
+    query()
+    warm = measure(query, args.iterations)
+    vector_store.close()
+    report('cold', cold)
+    report('warm', warm)
+
+
+def benchmark_summarize(config, args):
+    """
+    Compares the latency and output length of the refine and tree reduce
+    strategies when summarizing the symptom of a text.
+
+    Args:
+        config: The loaded configuration dictionary.
+        args: Parsed command-line arguments.
+    """
+    model = ModelManager(config).get_model({const.CONFIG_LLM: args.llm})
+    with open(args.file, encoding='utf-8') as stream:
+        text = stream.read()
+    splitter = RecursiveCharacterTextSplitter(
+            chunk_size=args.chunk_size,
+            chunk_overlap=128,
+            )
+    docs = splitter.create_documents([text])
+    print(f'chunks:\t{len(docs)}')
+
+    def summarize(strategy, lengths):
+        lengths.append(len(strategy.summarize(
+            model.llm, docs, SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT)))
+
+    for name in [STRATEGY_REFINE, STRATEGY_TREE_REDUCE]:
+        lengths = []
+        strategy = get_strategy(name, args.parallelism, model.limiter)
+        report(name, measure(partial(summarize, strategy, lengths),
+                             args.iterations))
+        print(f'{name}:\tmean output length '
+              f'{statistics.mean(lengths):.0f} characters')
+
+
+def parse_index_params(params):
+    """
+    Parses index parameters given as comma separated key=value pairs.
+
+    Args:
+        params: The index parameters, such as M=32,search_ef=50.
+
+    Returns:
+        dict: The parameters, with the numeric values converted to int.
+    """
+    parsed = {}
+    for param in filter(None, params.split(',')):
+        key, _, value = param.partition('=')
+        parsed[key.strip()] = int(value) if value.strip().isdigit() \
+            else value.strip()
+    return parsed
+
+
+def get_neighbours(embeddings, queries, space, k):
+    """
+    Computes the exact nearest neighbours of queries.
+
+    Args:
+        embeddings: The indexed embeddings, one per row.
+        queries: The query embeddings, one per row.
+        space: The distance space, one of l2, cosine or ip.
+        k: The number of neighbours per query.
+
+    Returns:
+        numpy.ndarray: The row indexes of the neighbours of every query.
+    """
+    if space == 'cosine':
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1,
+                                                 keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    if space == 'l2':
+        distances = (queries ** 2).sum(axis=1)[:, None] - \
+            2 * queries @ embeddings.T + (embeddings ** 2).sum(axis=1)
+    else:
+        distances = -queries @ embeddings.T
+    return np.argsort(distances, axis=1, kind='stable')[:, :k]
+
+
+def benchmark_params(client, records, queries, params, k):
+    """
+    Indexes records in memory with index parameters, and reports the build
+    time, query latency and recall against an exact search.
+
+    Args:
+        client: The in-memory Chroma client.
+        records: The ids and the embeddings, one per row, of the records.
+        queries: The query embeddings, one per row.
+        params: The index parameters.
+        k: The number of neighbours retrieved per query.
+    """
+    ids, embeddings = records
+    name = ','.join(f'{key}={value}' for key, value in params.items()) or \
+        'default'
+    collection = client.create_collection(
+            'benchmark-index',
+            metadata=get_collection_metadata({COLLECTION_METADATA: params}))
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(ids), INDEX_BATCH_SIZE):
+            collection.add(ids=ids[i:i + INDEX_BATCH_SIZE],
+                           embeddings=embeddings[i:i + INDEX_BATCH_SIZE])
+        print(f'{name}:\tbuild {time.perf_counter() - start:.2f}s')
+        results = []
+        samples = []
+        for vector in queries:
+            samples.extend(measure(partial(
+                lambda vector: results.append(collection.query(
+                    query_embeddings=[vector], n_results=k,
+                    include=[])['ids'][0]), vector), 1))
+        report(name, samples)
+    finally:
+        client.delete_collection('benchmark-index')
+    hits = sum(len(set(found) & {ids[i] for i in neighbours})
+               for found, neighbours in zip(results, get_neighbours(
+                   embeddings, queries, params.get(const.CONFIG_SPACE, 'l2'),
+                   k)))
+    print(f'{name}:\trecall@{k} '
+          f'{hits / (len(queries) * min(k, len(ids))):.3f}')
+
+
+def benchmark_index(config, args):
+    """
+    Compares the build time, query latency and recall of index parameters
+    by indexing the stored embeddings of a datasource in memory, using
+    stored embeddings as queries and an exact search as ground truth.
+
+    Args:
+        config: The loaded configuration dictionary.
+        args: Parsed command-line arguments.
+
+    Raises:
+        ValueError: If the datasource has no stored embeddings.
+    """
+    ds_config = get_ds_config(config, args.datasource)
+    vector_store = VectorStore(config)
+    ids = []
+    embeddings = []
+    for batch in vector_store.iter_records(args.datasource):
+        ids.extend(batch['ids'])
+        embeddings.extend(batch['embeddings'])
+    vector_store.close()
+    if not ids:
+        raise ValueError(f'The {args.datasource} vector store is empty')
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    queries = embeddings[random.Random(args.seed).sample(
+            range(len(ids)), min(args.queries, len(ids)))]
+    print(f'records:\t{len(ids)}\tqueries:\t{len(queries)}')
+    configured = ds_config.get(COLLECTION_METADATA, {})
+    client = chromadb.EphemeralClient()
+    for params in [parse_index_params(params) for params in args.index] or \
+            [{}]:
+        benchmark_params(client, (ids, embeddings), queries,
+                         {**configured, **params}, args.k)
+
+
+def main():
+    """
+    Main function to execute the support-ai benchmark tool.
+    """
+    args = parse_args()
+    config = get_config(args.config)
+    benchmarks = {
+        'vectorstore': benchmark_vectorstore,
+        'summarize': benchmark_summarize,
+        'index': benchmark_index,
+    }
+    benchmarks[args.benchmark](config, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import sys
 import time
 
 from support_ai.lib.datasources.ds_updater import DSUpdater
+from support_ai.lib.vectorstore import VectorStore
 from support_ai.utils import get_config
 
 
@@ -16,11 +17,23 @@ def parse_args():
     Parses command-line arguments for the support-ai data source updater.
 
     Returns:
-        argparse.Namespace: Parsed arguments, including the config file path.
+        argparse.Namespace: Parsed arguments, including the config file path
+                            and the datasource to rebuild or whose metadata
+                            to backfill, if any.
     """
     parser = argparse.ArgumentParser(
         description='Command line tool for support-ai')
     parser.add_argument('--config', type=str, default=None, help='Config path')
+    parser.add_argument('--rebuild', type=str, default=None,
+                        metavar='DATASOURCE',
+                        help='Rebuild the vector store index of a datasource '
+                             'with its configured parameters and exit, while '
+                             'no updater or server is running')
+    parser.add_argument('--backfill-metadata', type=str, default=None,
+                        metavar='DATASOURCE',
+                        help='Refresh the metadata of every stored record of '
+                             'a datasource without embedding it again and '
+                             'exit')
     return parser.parse_args()
 
 
@@ -30,11 +43,25 @@ def main():
 
     Loads the configuration, initializes the DSUpdater, and sets up signal
     handling for graceful termination. Runs the update thread continuously
-    until a termination signal is received.
+    until a termination signal is received, unless a datasource is rebuilt
+    or has its metadata backfilled instead.
     """
     args = parse_args()
     config = get_config(args.config)
+    if args.rebuild is not None:
+        vector_store = VectorStore(config)
+        count = vector_store.rebuild(args.rebuild)
+        vector_store.close()
+        print(f'Rebuilt {args.rebuild} with {count} records')
+        return
     ds_updater = DSUpdater(config)
+    if args.backfill_metadata is not None:
+        count = ds_updater.backfill_metadata(args.backfill_metadata)
+        ds_updater.vector_store.close()
+        ds_updater.fingerprint_index.close()
+        print(f'Backfilled the metadata of {count} '
+              f'{args.backfill_metadata} records')
+        return
 
     def signal_handler(*_):
         ds_updater.cancel_update_thread()
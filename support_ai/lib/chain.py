@@ -6,6 +6,11 @@ from support_ai.lib import const
 from support_ai.lib.context import BaseContext
 from support_ai.lib.datasources.ds_querier import DSQuerier
 from support_ai.lib.memory import Memory
+from support_ai.lib.utils import metrics
+from support_ai.lib.utils.lru import SingleFlight
+from support_ai.lib.utils.parallel_executor import configure_pools
+
+NO_MATCH = 'No relevant match was found for the query.'
 
 
 class Chain(BaseContext):
@@ -26,6 +31,7 @@ class Chain(BaseContext):
             ValueError: If the basic model configuration is missing.
         """
         super().__init__(config)
+        configure_pools(config.get(const.CONFIG_EXECUTOR, {}))
         if const.CONFIG_BASIC_MODEL not in config:
             raise ValueError(
                 f'The config doesn\'t contain {const.CONFIG_BASIC_MODEL}')
@@ -38,27 +44,51 @@ class Chain(BaseContext):
             self.memory = None
 
         self.ds_querier = DSQuerier(config)
+        self.custom_api_flight = SingleFlight()
+        # Sync and async calls return differently streamed contents, so they
+        # are coalesced separately.
+        self.acustom_api_flight = SingleFlight()
+        metrics.register('chain.custom_api', lambda: {
+            'coalesced': self.custom_api_flight.coalesced +
+            self.acustom_api_flight.coalesced})
 
     def __stream(self, output):
         """
-        Streams the output in segments based on delimiters.
+        Streams the output in segments based on delimiters, as soon as each
+        chunk of the output is generated.
 
         Args:
-            output: The full output text to be streamed.
+            output: An iterable of output chunks to be streamed.
 
         Yields:
             str: A segment of the output split by delimiters.
         """
         delimiters = [' ', '\t', '\n']
-        left = 0
-        for right, c in enumerate(output):
-            if c in delimiters:
-                yield output[left:right + 1]
-                left = right + 1
-        if left < len(output):
-            yield output[left:]
+        for chunk in output:
+            left = 0
+            for right, c in enumerate(chunk):
+                if c in delimiters:
+                    yield chunk[left:right + 1]
+                    left = right + 1
+            if left < len(chunk):
+                yield chunk[left:]
+
+    async def __astream(self, output):
+        """
+        Streams the output like __stream, from an async iterable of output
+        chunks.
 
-    def ask(self, query, ds_type=None, session=None):
+        Args:
+            output: An async iterable of output chunks to be streamed.
+
+        Yields:
+            str: A segment of the output split by delimiters.
+        """
+        async for chunk in output:
+            for segment in self.__stream([chunk]):
+                yield segment
+
+    def ask(self, query, ds_type=None, session=None, where=None):
         """
         Processes a query and returns generated responses with
         memory integration.
@@ -67,20 +97,26 @@ class Chain(BaseContext):
             query: The user query to process.
             ds_type: Type of data source to query.
             session: Session identifier for memory context.
+            where: An optional Chroma where filter on the metadata of the
+                   retrieved documents.
 
         Returns:
             generator: Streamed response segments.
         """
-        ds, doc = self.ds_querier.query(query, ds_type)
+        ds, doc = self.ds_querier.query(query, ds_type, where)
+        if ds is None:
+            return self.__stream([NO_MATCH])
         content = ds.get_content(doc.metadata)
         if session is not None and self.memory is not None:
-            content.summary = self.memory.integrate(session, query,
-                                                    content.Summary)
+            content.summary = self.memory.stream_integrate(
+                    session, query, ''.join(content.iter_summary()))
         return self.__stream(ds.generate_output(content))
 
     def custom_api(self, ds_type, action, data):
         """
         Calls a custom API action on a data source and returns the result.
+        Concurrent calls with the same data source, action and data, such as
+        several requests to summarize the same case, share one computation.
 
         Args:
             ds_type: Data source type for the action.
@@ -91,9 +127,58 @@ class Chain(BaseContext):
             generator: Streamed response segments from the data source API.
         """
         ds = self.ds_querier.get_ds(ds_type)
-        content = ds.custom_api(action, data)
+        key = (ds_type, action, tuple(sorted(data.items())))
+        content = self.custom_api_flight.do(
+                key, lambda: ds.custom_api(action, data))
         return self.__stream(ds.generate_output(content))
 
+    async def aask(self, query, ds_type=None, session=None, where=None):
+        """
+        Processes a query like ask, awaiting the language model and the data
+        sources instead of blocking on them.
+
+        Args:
+            query: The user query to process.
+            ds_type: Type of data source to query.
+            session: Session identifier for memory context.
+            where: An optional Chroma where filter on the metadata of the
+                   retrieved documents.
+
+        Returns:
+            AsyncGenerator: Streamed response segments.
+        """
+        ds, doc = await self.ds_querier.aquery(query, ds_type, where)
+        if ds is None:
+            async def no_match():
+                yield NO_MATCH
+            return self.__astream(no_match())
+        content = await ds.aget_content(doc.metadata)
+        if session is not None and self.memory is not None:
+            context = ''.join([chunk async for chunk in
+                               content.aiter_summary()])
+            content.summary = self.memory.astream_integrate(session, query,
+                                                            context)
+        return self.__astream(ds.agenerate_output(content))
+
+    async def acustom_api(self, ds_type, action, data):
+        """
+        Calls a custom API action like custom_api, awaiting the data source.
+
+        Args:
+            ds_type: Data source type for the action.
+            action: Action to execute on the data source.
+            data: Data required by the API action.
+
+        Returns:
+            AsyncGenerator: Streamed response segments from the data source
+                            API.
+        """
+        ds = self.ds_querier.get_ds(ds_type)
+        key = (ds_type, action, tuple(sorted(data.items())))
+        content = await self.acustom_api_flight.ado(
+                key, lambda: ds.acustom_api(action, data))
+        return self.__astream(ds.agenerate_output(content))
+
     def clear_history(self, session):
         """
         Clears the session history in memory.
@@ -104,3 +189,9 @@ class Chain(BaseContext):
         if self.memory is None:
             return
         self.memory.clear(session)
+
+    def close(self):
+        """
+        Releases the resources held by the chain, flushing the vector store.
+        """
+        self.ds_querier.close()
@@ -9,11 +9,53 @@ CONFIG_TYPE = 'type'
 CONFIG_MODEL = 'model'
 CONFIG_LLM = 'llm'
 CONFIG_EMBEDDINGS = 'embeddings'
+CONFIG_CONCURRENCY = 'concurrency'
+CONFIG_CONTEXT_SIZE = 'context_size'
+CONFIG_OUTPUT_TOKENS = 'output_tokens'
+CONFIG_EMBEDDINGS_CACHE = 'embeddings_cache'
 CONFIG_BASIC_MODEL = 'basic_model'
 CONFIG_MEMORY = 'memory'
 CONFIG_DB_CONNECTION = 'db_connection'
 CONFIG_DATASOURCES = 'datasources'
 CONFIG_AUTHENTICATION = 'authentication'
+# Executor
+CONFIG_EXECUTOR = 'executor'
+# Query cache
+CONFIG_QUERY_CACHE = 'query_cache'
+# Retrieval
+CONFIG_RETRIEVAL = 'retrieval'
+CONFIG_K = 'k'
+CONFIG_SCORE_THRESHOLD = 'score_threshold'
+# Vector store index
+CONFIG_SPACE = 'space'
+CONFIG_M = 'M'
+CONFIG_CONSTRUCTION_EF = 'construction_ef'
+CONFIG_SEARCH_EF = 'search_ef'
+# Routing
+CONFIG_ROUTING = 'routing'
+CONFIG_MODE = 'mode'
+CONFIG_MARGIN = 'margin'
+CONFIG_FUSION = 'fusion'
+CONFIG_ROUTING_EXAMPLES = 'routing_examples'
+# Updater
+CONFIG_UPDATER = 'updater'
+CONFIG_BATCH_SIZE = 'batch_size'
+CONFIG_BATCH_BYTES = 'batch_bytes'
+# Summary cache
+CONFIG_SUMMARY_CACHE = 'summary_cache'
+CONFIG_SQLITE = 'sqlite'
+CONFIG_MONGODB = 'mongodb'
+CONFIG_PATH = 'path'
+CONFIG_TTL = 'ttl'
+CONFIG_MAXSIZE = 'maxsize'
+# Summary strategy
+CONFIG_SUMMARY_STRATEGY = 'summary_strategy'
+CONFIG_TREE_REDUCE_PARALLELISM = 'tree_reduce_parallelism'
+CONFIG_JUDGE_BATCH_SIZE = 'judge_batch_size'
+CONFIG_COMMENT_FILTER = 'comment_filter'
+CONFIG_ENABLED = 'enabled'
+CONFIG_MIN_WORDS = 'min_words'
+CONFIG_DUPLICATE_THRESHOLD = 'duplicate_threshold'
 # Salesforce
 CONFIG_SF = 'salesforce'
 CONFIG_USERNAME = 'username'
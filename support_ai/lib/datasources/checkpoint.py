@@ -0,0 +1,159 @@
+"""
+This module provides the CheckpointStore class, which persists the sync
+position of each data source so that updates can resume where they stopped.
+"""
+
+import json
+import os
+from datetime import datetime
+
+from support_ai.lib.const import META_DIR
+from support_ai.lib.datasources.ds import Checkpoint
+
+
+CHECKPOINT_DIR = META_DIR + 'checkpoints'
+
+
+def get_soql_condition(checkpoint):
+    """
+    Builds a SOQL condition selecting the records after a checkpoint, for
+    queries ordered by LastModifiedDate and Id.
+
+    Args:
+        checkpoint: The Checkpoint to resume from.
+
+    Returns:
+        str: The SOQL condition.
+    """
+    if checkpoint.record_id is None:
+        return f'LastModifiedDate >= {checkpoint.timestamp}'
+    return f'(LastModifiedDate > {checkpoint.timestamp} OR ' \
+           f'(LastModifiedDate = {checkpoint.timestamp} AND ' \
+           f'Id > \'{checkpoint.record_id}\'))'
+
+
+def get_checkpoint(record):
+    """
+    Creates the checkpoint positioned at a Salesforce record.
+
+    Args:
+        record: A record containing the Id and LastModifiedDate fields.
+
+    Returns:
+        Checkpoint: The checkpoint of the record.
+    """
+    # Salesforce returns UTC datetimes like 2024-01-02T03:04:05.000+0000,
+    # while SOQL literals take no milliseconds.
+    return Checkpoint(f'{record["LastModifiedDate"][:19]}Z', record['Id'])
+
+
+def get_epoch(timestamp):
+    """
+    Converts a Salesforce datetime into seconds since the epoch, which the
+    vector store can compare in range filters.
+
+    Args:
+        timestamp: A UTC datetime like 2024-01-02T03:04:05.000+0000.
+
+    Returns:
+        int: The seconds since the epoch.
+    """
+    return int(datetime.strptime(timestamp,
+                                 '%Y-%m-%dT%H:%M:%S.%f%z').timestamp())
+
+
+class WatermarkTracker:  # pylint: disable=too-few-public-methods
+    """
+    Tracks the watermark of records processed out of order: it only
+    advances over the contiguous prefix of records that have all been
+    processed.
+    """
+
+    def __init__(self, records):
+        """
+        Initializes the WatermarkTracker.
+
+        Args:
+            records: The records in query order.
+        """
+        self.records = records
+        self.completed = set()
+        self.next_index = 0
+
+    def complete(self, index):
+        """
+        Marks a record as processed.
+
+        Args:
+            index: The position of the record.
+
+        Returns:
+            Checkpoint: The checkpoint of the last record of the processed
+                        prefix, or None if the first record is pending.
+        """
+        self.completed.add(index)
+        while self.next_index in self.completed:
+            self.completed.remove(self.next_index)
+            self.next_index += 1
+        if self.next_index == 0:
+            return None
+        return get_checkpoint(self.records[self.next_index - 1])
+
+
+class CheckpointStore:
+    """
+    Stores one checkpoint per data source as a JSON file.
+    """
+
+    def __init__(self):
+        """
+        Initializes the CheckpointStore, ensuring the storage directory
+        exists.
+        """
+        os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+
+    def __get_path(self, ds_type):
+        """
+        Returns the checkpoint file path of a data source.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            str: The checkpoint file path.
+        """
+        return os.path.join(CHECKPOINT_DIR, f'{ds_type}.json')
+
+    def load(self, ds_type):
+        """
+        Loads the checkpoint of a data source.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            Checkpoint: The saved checkpoint, or None if the data source has
+                        never been synced.
+        """
+        path = self.__get_path(ds_type)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return Checkpoint(**json.load(f))
+
+    def save(self, ds_type, checkpoint):
+        """
+        Atomically saves the checkpoint of a data source.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            checkpoint: The Checkpoint to save.
+        """
+        path = self.__get_path(ds_type)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'timestamp': checkpoint.timestamp,
+                       'record_id': checkpoint.record_id}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
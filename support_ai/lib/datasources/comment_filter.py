@@ -0,0 +1,190 @@
+"""
+This module provides the CommentFilter class, which drops case comments
+that obviously carry no solution, such as acknowledgements, follow-up
+requests, signatures and near-duplicates, before any LLM call.
+"""
+
+import hashlib
+import re
+from collections import Counter
+
+from support_ai.lib import const
+
+DEFAULT_MIN_WORDS = 4
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+MINHASH_PRIME = (1 << 61) - 1
+REASON_SHORT = 'short'
+REASON_BOILERPLATE = 'boilerplate'
+REASON_DUPLICATE = 'duplicate'
+
+SIGNATURE_PATTERN = re.compile(
+        r'^\s*(--+|(best|kind|warm)?\s*regards,?|thanks?( you)?,|'
+        r'sincerely,?|cheers,?)\s*$',
+        re.IGNORECASE)
+SENTENCE_PATTERN = re.compile(r'[.?!;\n]+')
+BOILERPLATE_PATTERNS = [re.compile(pattern) for pattern in (
+        r'(hi|hello|dear)( [\w-]+){0,3},?',
+        r'(many )?(thanks?|thank you|thx|ty)( (so|very) much)?'
+        r'( for [\w\' ]{0,40})?,?',
+        r'(any|is there any) (updates?|news|progress)( \w+){0,4}',
+        r'[\w\', ]{0,40}\b(will|we\'ll|i\'ll) (get back|update you|'
+        r'follow up|keep you (posted|updated))( \w+){0,6}',
+        r'(we|i) (have )?(received|acknowledged?) (your|the) '
+        r'(case|request|ticket|email)( \w+){0,8}',
+        r'(please|kindly) (let us know|provide an update|update us)'
+        r'( \w+){0,8}',
+        r'(this|the) case (has been|was|is|will be) (created|opened|closed|'
+        r'assigned|auto[- ]?closed|automatically closed)( \w+){0,4}',
+        )]
+WORD_PATTERN = re.compile(r'\w+')
+RESOLUTION_PATTERN = re.compile(
+        r'\b(fix\w*|resolv\w*|solv\w*|solution|workaround|work around|'
+        r'root cause|caused|reboot\w*|restart\w*|reinstall\w*|upgrad\w*|'
+        r'downgrad\w*|patch\w*|replac\w*|disabl\w*|enabl\w*|roll\w* ?back|'
+        r'works|working)\b')
+_permutations = [
+        (int.from_bytes(hashlib.blake2b(f'a{i}'.encode(), digest_size=8)
+                        .digest(), 'big') % MINHASH_PRIME | 1,
+         int.from_bytes(hashlib.blake2b(f'b{i}'.encode(), digest_size=8)
+                        .digest(), 'big') % MINHASH_PRIME)
+        for i in range(MINHASH_BANDS * MINHASH_ROWS)]
+
+
+def strip_signature(comment):
+    """
+    Removes the signature closing a comment.
+
+    Args:
+        comment: The comment body.
+
+    Returns:
+        str: The comment body before its signature, if any.
+    """
+    lines = comment.splitlines()
+    for index, line in enumerate(lines):
+        if index > 0 and SIGNATURE_PATTERN.match(line):
+            return '\n'.join(lines[:index])
+    return comment
+
+
+def get_minhash(words):
+    """
+    Computes the MinHash signature of the word shingles of a text.
+
+    Args:
+        words: The normalized words of the text.
+
+    Returns:
+        Tuple[int]: The minimum hash of the shingles under every
+                    permutation.
+    """
+    shingles = {' '.join(words[i:i + SHINGLE_SIZE])
+                for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(),
+                                             digest_size=8).digest(), 'big')
+              for shingle in shingles]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes)
+                 for a, b in _permutations)
+
+
+def get_similarity(minhash, other):
+    """
+    Estimates the Jaccard similarity of the shingles of two texts.
+
+    Args:
+        minhash: The MinHash signature of a text.
+        other: The MinHash signature of the other text.
+
+    Returns:
+        float: The estimated similarity, between 0 and 1.
+    """
+    return sum(a == b for a, b in zip(minhash, other)) / len(minhash)
+
+
+class CommentFilter:
+    """
+    A local, deterministic filter of case comments. A comment is dropped if
+    it is too short once its signature is removed, unless it mentions a
+    resolution such as "Reboot fixed it.", if every sentence of it is
+    boilerplate, or if it is a near-duplicate of a previous comment, found
+    by locality-sensitive hashing of MinHash signatures over word shingles.
+    """
+
+    def __init__(self, config):
+        """
+        Initializes the CommentFilter.
+
+        Args:
+            config: The comment filter configuration.
+        """
+        self.enabled = config.get(const.CONFIG_ENABLED, True)
+        self.min_words = config.get(const.CONFIG_MIN_WORDS,
+                                    DEFAULT_MIN_WORDS)
+        self.duplicate_threshold = config.get(
+                const.CONFIG_DUPLICATE_THRESHOLD, DEFAULT_DUPLICATE_THRESHOLD)
+
+    def get_reason(self, comment, words):
+        """
+        Checks a comment against the length and boilerplate rules.
+
+        Args:
+            comment: The comment body without its signature.
+            words: The normalized words of the comment.
+
+        Returns:
+            str: The reason to drop the comment, or None to keep it.
+        """
+        if len(words) < self.min_words and \
+                not RESOLUTION_PATTERN.search(' '.join(words)):
+            return REASON_SHORT
+        sentences = [' '.join(sentence.split())
+                     for sentence in SENTENCE_PATTERN.split(comment.lower())]
+        if all(any(pattern.fullmatch(sentence)
+                   for pattern in BOILERPLATE_PATTERNS)
+               for sentence in sentences if sentence):
+            return REASON_BOILERPLATE
+        return None
+
+    def filter(self, comments):
+        """
+        Filters comments, keeping the first of near-duplicate comments.
+
+        Args:
+            comments: The comment bodies, in chronological order.
+
+        Returns:
+            Tuple[List[str], Counter]: The kept comments in their original
+                                       order, and the number of dropped
+                                       comments by reason.
+        """
+        dropped = Counter()
+        if not self.enabled:
+            return list(comments), dropped
+        kept = []
+        signatures = []
+        buckets = {}
+        for comment in comments:
+            body = strip_signature(comment)
+            words = WORD_PATTERN.findall(body.lower())
+            reason = self.get_reason(body, words)
+            if reason is not None:
+                dropped[reason] += 1
+                continue
+            minhash = get_minhash(words)
+            bands = [(band, minhash[band * MINHASH_ROWS:
+                                    (band + 1) * MINHASH_ROWS])
+                     for band in range(MINHASH_BANDS)]
+            candidates = {index for band in bands
+                          for index in buckets.get(band, ())}
+            if any(get_similarity(minhash, signatures[index]) >=
+                   self.duplicate_threshold for index in candidates):
+                dropped[REASON_DUPLICATE] += 1
+                continue
+            for band in bands:
+                buckets.setdefault(band, []).append(len(signatures))
+            signatures.append(minhash)
+            kept.append(comment)
+        return kept, dropped
@@ -3,44 +3,112 @@ Module for defining data structures and an abstract base class for
 data sources.
 """
 
+import asyncio
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
+from typing import AsyncIterable, Iterable
+
+from support_ai.lib.utils.parallel_executor import iterate_in_thread
+
+
+@dataclass
+class Checkpoint:
+    """
+    Represents a position in a datasource's update stream, ordered by
+    modification time and then record ID.
+
+    A record_id of None means every record modified at or after the
+    timestamp still has to be processed.
+    """
+
+    timestamp: str
+    record_id: str = None
 
 
 @dataclass
 class Data:
     """
     Represents a document with associated metadata and an identifier.
+
+    The optional watermark marks the position in the datasource up to which
+    every record has been produced, even when records are produced out of
+    order. The optional fingerprint identifies the source content the
+    document was generated from.
+
+    A Data without document stands for a record skipped as unchanged: its
+    document isn't written again, but its metadata, which may have changed,
+    replaces the stored one, and its watermark advances the checkpoint.
     """
 
     document: str
     metadata: dict
     id: str
+    watermark: Checkpoint = None
+    fingerprint: str = None
 
 
 @dataclass
 class Content:
     """
     Represents content containing metadata and a summary.
+
+    The summary is either a string or an iterable, or async iterable, of
+    string chunks that are streamed as they are generated.
     """
 
     metadata: dict
-    summary: str
+    summary: str | Iterable[str] | AsyncIterable[str]
+
+    def iter_summary(self):
+        """
+        Iterates over the chunks of the summary.
+
+        Yields:
+            str: The next chunk of the summary.
+        """
+        if isinstance(self.summary, str):
+            yield self.summary
+        else:
+            yield from self.summary
+
+    async def aiter_summary(self):
+        """
+        Iterates over the chunks of the summary without blocking the event
+        loop.
+
+        Yields:
+            str: The next chunk of the summary.
+        """
+        if isinstance(self.summary, str):
+            yield self.summary
+        elif isinstance(self.summary, AsyncIterable):
+            async for chunk in self.summary:
+                yield chunk
+        else:
+            async for chunk in iterate_in_thread(self.summary):
+                yield chunk
 
 
 class Datasource(ABC):
     """
     Abstract base class for data source implementations.
+
+    The async methods default to running their sync counterparts in a worker
+    thread, and can be overridden with native async implementations.
     """
 
     @abstractmethod
-    def get_update_data(self, start_date, end_date):
+    def get_update_data(self, checkpoint, is_unchanged=None):
         """
-        Retrieve updated data based on the specified date range.
+        Retrieve data updated after the specified checkpoint.
 
         Args:
-            start_date: The start date for filtering updates.
-            end_date: The end date for filtering updates.
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all data.
+            is_unchanged: An optional function taking a record ID and its
+                          content fingerprint, returning True if the record
+                          doesn't need to be processed again. Skipped
+                          records are produced without document.
 
         Returns:
             NotImplemented: Must be overridden by subclasses.
@@ -77,7 +145,7 @@ class Datasource(ABC):
     @abstractmethod
     def generate_output(self, content):
         """
-        Generate output based on the provided content.
+        Generate output chunks based on the provided content.
 
         Args:
             content: The content used to generate the output.
@@ -86,3 +154,63 @@ class Datasource(ABC):
             NotImplemented: Must be overridden by subclasses.
         """
         return NotImplemented
+
+    async def aget_update_data(self, checkpoint, is_unchanged=None):
+        """
+        Retrieve data updated after the specified checkpoint without blocking
+        the event loop.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all data.
+            is_unchanged: An optional function taking a record ID and its
+                          content fingerprint, returning True if the record
+                          doesn't need to be processed again. Skipped
+                          records are produced without document.
+
+        Yields:
+            Data: The next updated data.
+        """
+        async for data in iterate_in_thread(
+                self.get_update_data(checkpoint, is_unchanged)):
+            yield data
+
+    async def aget_content(self, metadata):
+        """
+        Retrieve content based on the provided metadata without blocking the
+        event loop.
+
+        Args:
+            metadata: The metadata used to retrieve the content.
+
+        Returns:
+            Content: The retrieved content.
+        """
+        return await asyncio.to_thread(self.get_content, metadata)
+
+    async def acustom_api(self, action, data):
+        """
+        Handle custom API actions without blocking the event loop.
+
+        Args:
+            action: The action to perform.
+            data: The data associated with the action.
+
+        Returns:
+            Content: The content returned by the action.
+        """
+        return await asyncio.to_thread(self.custom_api, action, data)
+
+    async def agenerate_output(self, content):
+        """
+        Generate output chunks based on the provided content without
+        blocking the event loop.
+
+        Args:
+            content: The content used to generate the output.
+
+        Yields:
+            str: The next chunk of the output.
+        """
+        async for chunk in iterate_in_thread(self.generate_output(content)):
+            yield chunk
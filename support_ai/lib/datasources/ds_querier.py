@@ -3,11 +3,26 @@ This module provides the DSQuerier class, which is responsible for
 querying different data sources based on the provided configuration
 and user queries.
 """
+import asyncio
+import json
+import time
+from functools import partial
+from itertools import zip_longest
+from threading import Lock
+
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from support_ai.lib import const
 from support_ai.lib.context import BaseContext
+from support_ai.lib.datasources.router import (
+  DEFAULT_MARGIN,
+  EmbeddingRouter,
+  ROUTING_EXAMPLES,
+)
+from support_ai.lib.utils import metrics
+from support_ai.lib.utils.lru import SingleFlight, TTLCache
+from support_ai.lib.utils.parallel_executor import run_fn_in_parallel
 from support_ai.lib.vectorstore import VectorStore
 from support_ai.lib.datasources.utils import get_datasources
 
@@ -26,6 +41,15 @@ Do not respond with the answer other than salesforce, knowledgebase.
 Question: {query}
 Answer:
 """.strip()
+QUERY_CACHE_MAXSIZE = 1024
+QUERY_CACHE_TTL = 10*60
+DEFAULT_K = 4
+DEFAULT_SCORE_THRESHOLD = float('-inf')
+ROUTING_LLM = 'llm'
+ROUTING_EMBEDDINGS = 'embeddings'
+ROUTING_FANOUT = 'fanout'
+FUSION_RRF = 'rrf'
+FUSION_SCORE = 'score'
 
 
 class DSQuerier(BaseContext):
@@ -42,32 +66,172 @@ class DSQuerier(BaseContext):
         self.model = self.model_manager.get_model(
                         config[const.CONFIG_BASIC_MODEL])
         self.datasources = get_datasources(config)
-        self.vector_store = VectorStore()
+        self.vector_store = VectorStore(config)
+        cache_config = config.get(const.CONFIG_QUERY_CACHE, {})
+        self.query_cache = TTLCache(
+                maxsize=cache_config.get(const.CONFIG_MAXSIZE,
+                                         QUERY_CACHE_MAXSIZE),
+                seconds=cache_config.get(const.CONFIG_TTL, QUERY_CACHE_TTL),
+                name='ds_querier.query_cache')
+        self.query_flight = SingleFlight()
+        retrieval_config = config.get(const.CONFIG_RETRIEVAL, {})
+        self.k = retrieval_config.get(const.CONFIG_K, DEFAULT_K)
+        self.score_threshold = retrieval_config.get(
+                const.CONFIG_SCORE_THRESHOLD, DEFAULT_SCORE_THRESHOLD)
+        routing_config = config.get(const.CONFIG_ROUTING, {})
+        self.routing_mode = routing_config.get(const.CONFIG_MODE, ROUTING_LLM)
+        self.fusion = routing_config.get(const.CONFIG_FUSION, FUSION_RRF)
+        if self.fusion not in (FUSION_RRF, FUSION_SCORE):
+            raise ValueError(f'Unknown fusion method: {self.fusion}')
+        self.router = self.__get_router(config)
+        self.routing_mutex = Lock()
+        self.routing_counts = {'routed': 0, 'fallbacks': 0}
+        metrics.register('ds_querier.routing', self.__routing_stats)
 
-    def __judge_ds_type(self, query):
+    def __get_router(self, config):
         """
-        Determines the type of data source based on the query.
+        Creates the embedding router if the routing mode is embeddings.
 
         Args:
-            query: The user query to classify.
+            config: The configuration, which may contain a routing section
+                    and example queries for each data source.
 
         Returns:
-            str: The type of the data source.
+            EmbeddingRouter: The router, or None to route with the LLM.
+
+        Raises:
+            ValueError: If the routing mode is unknown, or if the basic model
+                        has no embeddings for the embeddings mode.
+        """
+        if self.routing_mode not in (ROUTING_LLM, ROUTING_EMBEDDINGS,
+                                     ROUTING_FANOUT):
+            raise ValueError(f'Unknown routing mode: {self.routing_mode}')
+        if self.routing_mode != ROUTING_EMBEDDINGS:
+            return None
+        if self.model.embeddings is None:
+            raise ValueError(f'The basic model config doesn\'t contain '
+                             f'{const.CONFIG_EMBEDDINGS}')
+        examples = {}
+        for ds_config in config[const.CONFIG_DATASOURCES]:
+            ds_type = ds_config[const.CONFIG_TYPE]
+            examples[ds_type] = ds_config.get(const.CONFIG_ROUTING_EXAMPLES,
+                                              ROUTING_EXAMPLES.get(ds_type))
+            if not examples[ds_type]:
+                raise ValueError(f'The datasource config doesn\'t contain '
+                                 f'{const.CONFIG_ROUTING_EXAMPLES}')
+        return EmbeddingRouter(
+                self.model.embeddings, examples,
+                config.get(const.CONFIG_ROUTING, {}).get(const.CONFIG_MARGIN,
+                                                         DEFAULT_MARGIN))
+
+    def __routing_stats(self):
+        """
+        Returns the routing statistics.
+
+        Returns:
+            dict: The number of queries routed and of LLM fallbacks, and the
+                  rate of fallbacks.
+        """
+        with self.routing_mutex:
+            counts = dict(self.routing_counts)
+        return {**counts,
+                'fallback_rate': counts['fallbacks'] / counts['routed']
+                if counts['routed'] else 0.0}
+
+    def __count_routing(self, start, fallback):
+        """
+        Records the latency of a routing decision and whether it fell back
+        to the LLM.
+
+        Args:
+            start: The monotonic time at which the routing started.
+            fallback: Whether the LLM made the decision.
+        """
+        metrics.observe('ds_querier.routing_seconds',
+                        time.monotonic() - start)
+        with self.routing_mutex:
+            self.routing_counts['routed'] += 1
+            self.routing_counts['fallbacks'] += fallback
+
+    def __get_classification_chain(self):
+        """
+        Builds the chain classifying a query into a data source type.
+
+        Returns:
+            Runnable: The chain taking the user query.
         """
-        if len(self.datasources) == 1:
-            return list(self.datasources.keys())[0]
         prompt = PromptTemplate.from_template(CLASSIFICATION_PROMPT)
-        chain = (
+        return (
                 {'query': RunnablePassthrough()}
                 | prompt
                 | self.model.llm
                 | StrOutputParser()
                 )
-        ds_type = chain.invoke(query)
+
+    def __check_ds_type(self, ds_type):
+        """
+        Returns the classified data source type if it is known, or the first
+        data source type otherwise.
+
+        Args:
+            ds_type: The classified data source type.
+
+        Returns:
+            str: The type of the data source.
+        """
         if ds_type not in self.datasources:
             return list(self.datasources.keys())[0]
         return ds_type
 
+    def __judge_ds_type(self, query):
+        """
+        Determines the type of data source based on the query, with the
+        embedding router if configured, falling back to the LLM when the
+        router is undecided.
+
+        Args:
+            query: The user query to classify.
+
+        Returns:
+            str: The type of the data source.
+        """
+        if len(self.datasources) == 1:
+            return list(self.datasources.keys())[0]
+        start = time.monotonic()
+        if self.router is not None:
+            ds_type = self.router.route(query)
+            if ds_type is not None:
+                self.__count_routing(start, False)
+                return ds_type
+        ds_type = self.__check_ds_type(
+                self.__get_classification_chain().invoke(query))
+        self.__count_routing(start, True)
+        return ds_type
+
+    async def __ajudge_ds_type(self, query):
+        """
+        Determines the type of data source like __judge_ds_type, awaiting
+        the language model.
+
+        Args:
+            query: The user query to classify.
+
+        Returns:
+            str: The type of the data source.
+        """
+        if len(self.datasources) == 1:
+            return list(self.datasources.keys())[0]
+        start = time.monotonic()
+        if self.router is not None:
+            ds_type = await self.router.aroute(query)
+            if ds_type is not None:
+                self.__count_routing(start, False)
+                return ds_type
+        ds_type = self.__check_ds_type(
+                await self.__get_classification_chain().ainvoke(query))
+        self.__count_routing(start, True)
+        return ds_type
+
     def get_ds(self, ds_type):
         """
         Retrieves the specified data source.
@@ -85,7 +249,7 @@ class DSQuerier(BaseContext):
             raise ValueError(f'Unknown datasource type: {ds_type}')
         return self.datasources[ds_type]
 
-    def query(self, query, ds_type=None):
+    def query(self, query, ds_type=None, where=None):
         """
         Executes a query against the appropriate data source.
 
@@ -93,16 +257,209 @@ class DSQuerier(BaseContext):
             query: The user query to execute.
             ds_type: The type of data source. If None,
                      it will be determined.
+            where: An optional Chroma where filter on the document metadata.
 
         Returns:
             Tuple: A tuple containing the data source instance and the
-                   retrieved documents.
+                   retrieved document, or None and None if no document is
+                   relevant enough.
+        """
+        hits = self.query_hits(query, ds_type, where)
+        return hits[0][:2] if hits else (None, None)
+
+    def query_with_score(self, query, ds_type=None, where=None):
+        """
+        Executes a query against the appropriate data source.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source. If None,
+                     it will be determined.
+            where: An optional Chroma where filter on the document metadata.
+
+        Returns:
+            Tuple: A tuple containing the data source instance, the best
+                   retrieved document and its relevance score, or None if no
+                   document is relevant enough.
         """
-        if ds_type is None:
-            ds_type = self.__judge_ds_type(query)
+        hits = self.query_hits(query, ds_type, where)
+        return hits[0] if hits else None
 
+    def query_hits(self, query, ds_type=None, where=None):
+        """
+        Executes a query against the appropriate data source, or against
+        every data source in the fan-out routing mode, keeping the documents
+        whose relevance score reaches the configured threshold.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source. If None,
+                     it will be determined.
+            where: An optional Chroma where filter on the document metadata,
+                   such as {'severity': 'L1'} or
+                   {'created_at': {'$gte': 1704067200}}.
+
+        Returns:
+            List[Tuple]: The tuples of the data source instance, a retrieved
+                         document and its relevance score, from the most
+                         relevant document.
+        """
+        if ds_type is None and self.routing_mode == ROUTING_FANOUT and \
+                len(self.datasources) > 1:
+            results = run_fn_in_parallel(
+                    [(partial(self.__search, query, where=where), ds_type)
+                     for ds_type in self.datasources],
+                    len(self.datasources))
+            hits = self.__fuse(results)
+        else:
+            if ds_type is None:
+                ds_type = self.__judge_ds_type(query)
+            hits = self.__search(query, ds_type, where)
+        return self.__select_hits(hits)
+
+    def __select_hits(self, hits):
+        """
+        Keeps the hits whose relevance score reaches the threshold, counting
+        the queries without any. The scale of the scores, and so of the
+        threshold, depends on the distance space of each collection.
+
+        Args:
+            hits: The ranked hits.
+
+        Returns:
+            List[Tuple]: The relevant hits.
+        """
+        hits = [hit for hit in hits if hit[2] >= self.score_threshold]
+        if not hits:
+            metrics.incr('ds_querier.no_match')
+        return hits
+
+    def __search(self, query, ds_type, where=None):
+        """
+        Searches the vector store of a data source for the query. Results
+        are cached by normalized query until the vector store is written,
+        and concurrent searches for the same query are coalesced.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source.
+            where: An optional Chroma where filter on the document metadata.
+
+        Returns:
+            List[Tuple]: The tuples of the data source instance, a retrieved
+                         document and its relevance score, from the most
+                         relevant document.
+        """
         ds = self.get_ds(ds_type)
-        docs = self.vector_store.similarity_search(ds_type,
-                                                   ds.model_manager.embeddings,
-                                                   query)
-        return ds, docs[0]
+        key = (ds_type, ' '.join(query.lower().split()),
+               json.dumps(where, sort_keys=True),
+               self.vector_store.get_generation(ds_type))
+        docs = self.query_cache.get(key)
+        if docs is None:
+            def search():
+                docs = self.vector_store.similarity_search_with_score(
+                        ds_type, ds.model.embeddings, query, k=self.k,
+                        where=where)
+                self.query_cache.put(key, docs)
+                return docs
+            docs = self.query_flight.do(key, search)
+        return [(ds, doc, score) for doc, score in docs]
+
+    def __fuse(self, results):
+        """
+        Merges the results of several data sources into a single ranking.
+
+        Every record only appears in the ranking of its own data source, so
+        reciprocal rank fusion amounts to interleaving the rankings round
+        robin: the best document of every data source, in the configured
+        order of the data sources, then the second best ones, and so on.
+        Relevance scores are left out, as they are only comparable across
+        collections using the same distance space. With score fusion, which
+        suits data sources sharing a distance space, documents are ranked by
+        relevance score.
+
+        Args:
+            results: The results of every data source, in the configured
+                     order, each ranked from the most relevant document.
+
+        Returns:
+            List[Tuple]: The tuples of the data source instance, a document
+                         and its relevance score, from the best document.
+        """
+        if self.fusion == FUSION_SCORE:
+            return sorted((hit for hits in results for hit in hits),
+                          key=lambda hit: hit[2], reverse=True)
+        return [hit for hits in zip_longest(*results) for hit in hits
+                if hit is not None]
+
+    async def aquery(self, query, ds_type=None, where=None):
+        """
+        Executes a query like query, awaiting the language model. The vector
+        store search runs in a worker thread.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source. If None,
+                     it will be determined.
+            where: An optional Chroma where filter on the document metadata.
+
+        Returns:
+            Tuple: A tuple containing the data source instance and the
+                   retrieved document, or None and None if no document is
+                   relevant enough.
+        """
+        hits = await self.aquery_hits(query, ds_type, where)
+        return hits[0][:2] if hits else (None, None)
+
+    async def aquery_with_score(self, query, ds_type=None, where=None):
+        """
+        Executes a query like query_with_score, awaiting the language model.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source. If None,
+                     it will be determined.
+            where: An optional Chroma where filter on the document metadata.
+
+        Returns:
+            Tuple: A tuple containing the data source instance, the best
+                   retrieved document and its relevance score, or None if no
+                   document is relevant enough.
+        """
+        hits = await self.aquery_hits(query, ds_type, where)
+        return hits[0] if hits else None
+
+    async def aquery_hits(self, query, ds_type=None, where=None):
+        """
+        Executes a query like query_hits, awaiting the language model. The
+        vector store searches run in worker threads.
+
+        Args:
+            query: The user query to execute.
+            ds_type: The type of data source. If None,
+                     it will be determined.
+            where: An optional Chroma where filter on the document metadata.
+
+        Returns:
+            List[Tuple]: The tuples of the data source instance, a retrieved
+                         document and its relevance score, from the most
+                         relevant document.
+        """
+        if ds_type is None and self.routing_mode == ROUTING_FANOUT and \
+                len(self.datasources) > 1:
+            results = await asyncio.gather(*(
+                    asyncio.to_thread(self.__search, query, ds_type, where)
+                    for ds_type in self.datasources))
+            hits = self.__fuse(results)
+        else:
+            if ds_type is None:
+                ds_type = await self.__ajudge_ds_type(query)
+            hits = await asyncio.to_thread(self.__search, query, ds_type,
+                                           where)
+        return self.__select_hits(hits)
+
+    def close(self):
+        """
+        Releases the vector store handles held by the querier.
+        """
+        self.vector_store.close()
@@ -5,17 +5,26 @@ from various data sources at specified intervals.
 
 import os
 import threading
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import partial
 
+from support_ai.lib import const
 from support_ai.lib.const import META_DIR
 from support_ai.lib.context import BaseContext
+from support_ai.lib.utils.batch import batched
+from support_ai.lib.utils.parallel_executor import configure_pools
 from support_ai.lib.vectorstore import VectorStore
+from support_ai.lib.datasources.checkpoint import CheckpointStore
+from support_ai.lib.datasources.ds import Checkpoint
+from support_ai.lib.datasources.fingerprint import FingerprintIndex
 from support_ai.lib.datasources.utils import get_datasources
 
 
 UPDATE_TIME = META_DIR + 'update_time'
 TIME_FORMAT = '%m/%d/%Y'
 TIMER_INTERVAL = 24*60*60
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BATCH_BYTES = 1024*1024
 
 
 class RepeatTimer(threading.Timer):
@@ -35,8 +44,16 @@ class DSUpdater(BaseContext):
 
     def __init__(self, config):
         super().__init__(config)
-        self.vector_store = VectorStore()
+        configure_pools(config.get(const.CONFIG_EXECUTOR, {}))
+        self.vector_store = VectorStore(config)
+        self.checkpoint_store = CheckpointStore()
+        self.fingerprint_index = FingerprintIndex()
         self.datasources = get_datasources(config)
+        updater_config = config.get(const.CONFIG_UPDATER, {})
+        self.batch_size = updater_config.get(const.CONFIG_BATCH_SIZE,
+                                             DEFAULT_BATCH_SIZE)
+        self.batch_bytes = updater_config.get(const.CONFIG_BATCH_BYTES,
+                                              DEFAULT_BATCH_BYTES)
         self.update_timer = RepeatTimer(TIMER_INTERVAL, self.__trigger_update)
         self.update_thread = threading.Thread(target=self.__update_data_worker)
         self.stop_update_thread = threading.Event()
@@ -50,43 +67,111 @@ class DSUpdater(BaseContext):
         with self.update_cond:
             self.update_cond.notify()
 
-    def __get_update_date(self):
+    def __get_legacy_checkpoint(self):
         """
-        Retrieves the last update date from a file.
+        Retrieves the checkpoint from the update date file written by
+        earlier versions, which applies to every data source.
 
         Returns:
-            datetime.date: The last update date, or None if the
-                           update date file does not exist.
+            Checkpoint: A checkpoint at the start of the last update date,
+                        or None if the update date file does not exist.
         """
         if os.path.exists(UPDATE_TIME):
             with open(UPDATE_TIME, encoding="utf-8") as f:
-                return datetime.strptime(f.readline(), TIME_FORMAT).date()
+                date = datetime.strptime(f.readline(), TIME_FORMAT).date()
+            return Checkpoint(f'{date.isoformat()}T00:00:00Z')
         return None
 
-    def __update_data(self):
+    def __until_stopped(self, data_iter):
         """
-        Updates data from all data sources.
+        Passes data through until the update thread is asked to stop.
+
+        Args:
+            data_iter: An iterable of Data objects.
+
+        Yields:
+            Data: The next Data object, as long as no stop was requested.
         """
-        start_date = self.__get_update_date()
-        end_date = (datetime.now() + timedelta(1)).date()
-        for ds_type, ds in self.datasources.items():
+        for data in data_iter:
             if self.stop_update_thread.is_set():
                 return
-            for data in ds.get_update_data(start_date, end_date):
-                if self.stop_update_thread.is_set():
-                    return
-                self.vector_store.update(ds_type,
-                                         ds.model.embeddings,
-                                         data)
-        self.__save_next_update_date()
+            yield data
+
+    def __write_data(self, ds_type, ds, data_iter, save_checkpoint=True):
+        """
+        Writes data of a data source in batches bounded by count and total
+        text size. Records with a document are embedded and written, while
+        only the metadata of the records skipped as unchanged is replaced.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            ds: The data source.
+            data_iter: An iterable of Data objects.
+            save_checkpoint: Whether the checkpoint of the data source is
+                             committed after every batch.
+
+        Returns:
+            int: The number of records written or refreshed.
+        """
+        count = 0
+        for batch in batched(
+                data_iter, self.batch_size, self.batch_bytes,
+                lambda data: len((data.document or '').encode())):
+            written = [data for data in batch if data.document is not None]
+            self.vector_store.bulk_update(ds_type, ds.model.embeddings,
+                                          written)
+            self.vector_store.update_metadata(
+                    ds_type, [data for data in batch
+                              if data.document is None])
+            self.fingerprint_index.bulk_update(ds_type, written)
+            if save_checkpoint and batch[-1].watermark is not None:
+                self.checkpoint_store.save(ds_type, batch[-1].watermark)
+            count += len(batch)
+        return count
+
+    def backfill_metadata(self, ds_type):
+        """
+        Replaces the metadata of every stored record of a data source with
+        the one its data source produces now, such as fields added since the
+        records were written, without any LLM or embedding work. The
+        checkpoint of the data source is left as is.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            int: The number of records refreshed.
+
+        Raises:
+            ValueError: If the data source isn't configured.
+        """
+        if ds_type not in self.datasources:
+            raise ValueError(f'Unknown datasource {ds_type}')
+        ds = self.datasources[ds_type]
+        return self.__write_data(
+                ds_type, ds, ds.get_update_data(None, lambda *_: True),
+                save_checkpoint=False)
 
-    def __save_next_update_date(self):
+    def __update_data(self):
         """
-        Saves the current date as the next update date.
+        Updates data from all data sources, embedding and writing the data
+        in batches bounded by count and total text size. Each data source's
+        checkpoint is committed after every batch, so an interrupted update
+        resumes right after the last written batch. Records whose content
+        fingerprint matches the one already written are skipped by the data
+        sources before any LLM or embedding work; their metadata is still
+        refreshed, and the checkpoint still advances past them.
         """
-        now = datetime.now()
-        with open(UPDATE_TIME, 'w+', encoding="utf-8") as f:
-            f.write(now.strftime(TIME_FORMAT))
+        for ds_type, ds in self.datasources.items():
+            if self.stop_update_thread.is_set():
+                return
+            checkpoint = self.checkpoint_store.load(ds_type)
+            if checkpoint is None:
+                checkpoint = self.__get_legacy_checkpoint()
+            data_iter = self.__until_stopped(ds.get_update_data(
+                    checkpoint,
+                    partial(self.fingerprint_index.is_unchanged, ds_type)))
+            self.__write_data(ds_type, ds, data_iter)
 
     def __update_data_worker(self):
         """
@@ -116,3 +201,5 @@ class DSUpdater(BaseContext):
             self.update_cond.notify()
         if self.update_thread.is_alive():
             self.update_thread.join()
+        self.vector_store.close()
+        self.fingerprint_index.close()
@@ -0,0 +1,97 @@
+"""
+This module provides the FingerprintIndex class, which remembers a content
+fingerprint for every record written to the vector store so that unchanged
+records can be skipped before any LLM or embedding work.
+"""
+
+import hashlib
+import sqlite3
+from threading import Lock
+
+from support_ai.lib.const import META_DIR
+
+
+FINGERPRINT_DB = META_DIR + 'fingerprints.db'
+
+
+def get_fingerprint(*fields):
+    """
+    Computes the content fingerprint of a record.
+
+    Args:
+        *fields: The record fields the generated document is derived from.
+
+    Returns:
+        str: The hex SHA-256 digest of the fields.
+    """
+    digest = hashlib.sha256()
+    for field in fields:
+        digest.update(str(field).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class FingerprintIndex:
+    """
+    A persistent index of content fingerprints keyed by data source type and
+    record ID, stored in SQLite.
+    """
+
+    def __init__(self, path=FINGERPRINT_DB):
+        """
+        Initializes the FingerprintIndex, creating the database if needed.
+
+        Args:
+            path: The SQLite database path.
+        """
+        self.mutex = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'ds_type TEXT NOT NULL, '
+                'id TEXT NOT NULL, '
+                'fingerprint TEXT NOT NULL, '
+                'PRIMARY KEY (ds_type, id))')
+
+    def is_unchanged(self, ds_type, record_id, fingerprint):
+        """
+        Checks whether a record was already written with the same content.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            record_id: The record ID, as used for Data.id.
+            fingerprint: The current content fingerprint of the record.
+
+        Returns:
+            bool: True if the stored fingerprint matches.
+        """
+        with self.mutex:
+            row = self.conn.execute(
+                'SELECT fingerprint FROM fingerprints '
+                'WHERE ds_type = ? AND id = ?',
+                (ds_type, record_id)).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def bulk_update(self, ds_type, data_list):
+        """
+        Records the fingerprints of a batch of written data.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            data_list: A list of Data objects; those without a fingerprint
+                       are ignored.
+        """
+        rows = [(ds_type, data.id, data.fingerprint) for data in data_list
+                if data.fingerprint is not None]
+        with self.mutex, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO fingerprints '
+                '(ds_type, id, fingerprint) VALUES (?, ?, ?)', rows)
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self.mutex:
+            self.conn.close()
@@ -2,6 +2,8 @@
 This module provides functionality for interacting with a Salesforce
 Knowledge Base,
 """
+import asyncio
+from functools import partial
 from html.parser import HTMLParser
 from io import StringIO
 
@@ -11,8 +13,20 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from support_ai.lib import const
 from support_ai.lib.context import BaseContext
+from support_ai.lib.summary_cache import (
+  astream_with_cache,
+  get_summary_cache,
+  stream_with_cache,
+)
 from support_ai.lib.utils.lru import timed_lru_cache
+from support_ai.lib.utils.shared_stream import AsyncSharedStream, SharedStream
+from support_ai.lib.datasources.checkpoint import (
+  get_checkpoint,
+  get_epoch,
+  get_soql_condition,
+)
 from support_ai.lib.datasources.ds import Data, Content, Datasource
+from support_ai.lib.datasources.fingerprint import get_fingerprint
 
 
 QUESTIONS_PROMPT = """
@@ -119,6 +133,22 @@ class KnowledgeBaseSource(BaseContext, Datasource):
         auth = get_authentication(config[const.CONFIG_AUTHENTICATION])
         self.sf = simple_salesforce.Salesforce(**auth)
         self.model = self.model_manager.get_model(config)
+        self.summary_cache = get_summary_cache(config, const.CONFIG_KB)
+
+    def __get_questions_chain(self):
+        """
+        Builds the chain generating questions from an article summary.
+
+        Returns:
+            Runnable: The chain taking the summary of an article.
+        """
+        prompt = PromptTemplate.from_template(QUESTIONS_PROMPT)
+        return (
+                {'summary': RunnablePassthrough()}
+                | prompt
+                | self.model.llm
+                | StrOutputParser()
+                )
 
     def __generate_qeustions(self, summary):
         """
@@ -131,36 +161,43 @@ class KnowledgeBaseSource(BaseContext, Datasource):
         Returns:
             list: A list of questions generated from the summary.
         """
-        prompt = PromptTemplate.from_template(QUESTIONS_PROMPT)
-        chain = (
-                {'summary': RunnablePassthrough()}
-                | prompt
-                | self.model.llm
-                | StrOutputParser()
-                )
-        return chain.invode(summary)
+        return self.__get_questions_chain().invoke(summary)
 
-    def __get_articles(self, start_date=None, end_date=None):
+    async def __agenerate_questions(self, summary):
         """
-        Retrieves articles from the Salesforce Knowledge Base within the
-        specified date range.
+        Generates questions like __generate_qeustions, awaiting the language
+        model.
 
         Args:
-            start_date: The start date for filtering articles.
-            end_date: The end date for filtering articles.
+            summary: The summary of the article for which to generate
+                     questions.
 
-        Yields:
-            Data: A Data object containing generated questions, metadata,
-                  and article ID.
+        Returns:
+            str: The questions generated from the summary.
+        """
+        return await self.__get_questions_chain().ainvoke(summary)
+
+    def __select_articles(self, checkpoint, is_unchanged):
+        """
+        Queries the published articles modified after the specified
+        checkpoint, marking the unchanged ones as skipped.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all articles.
+            is_unchanged: An optional function taking an article record ID
+                          and its content fingerprint, returning True if the
+                          article can be skipped.
+
+        Returns:
+            List[Tuple[dict, str]]: The article records in query order with
+                                    their content fingerprints, or None for
+                                    the skipped articles.
         """
         clause = ''
         conditions = []
-        if start_date is not None:
-            conditions.append(
-                f'LastModifiedDate >= {start_date.isoformat()}T00:00:00Z')
-        if end_date is not None:
-            conditions.append(
-                f'LastModifiedDate < {end_date.isoformat()}T00:00:00Z')
+        if checkpoint is not None:
+            conditions.append(get_soql_condition(checkpoint))
         conditions.append(
             'Knowledge_1_Approval_Status__c = \'Approval Complete\'')
         conditions.append(
@@ -170,71 +207,225 @@ class KnowledgeBaseSource(BaseContext, Datasource):
             if clause:
                 clause += ' AND '
             clause += condition
-        sql_cmd = 'SELECT Id, KnowledgeArticleId, Title, Summary ' + \
-                  'FROM Knowledge__kav' + \
-                  (f' WHERE {clause}' if clause else '')
+        sql_cmd = 'SELECT Id, KnowledgeArticleId, Title, Summary, ' + \
+                  'LastModifiedDate FROM Knowledge__kav' + \
+                  (f' WHERE {clause}' if clause else '') + \
+                  ' ORDER BY LastModifiedDate, Id'
         articles = self.sf.query_all(sql_cmd)
 
+        selected = []
         for article in articles['records']:
+            fingerprint = get_fingerprint(article['KnowledgeArticleId'],
+                                          article['Title'],
+                                          article['Summary'])
+            if is_unchanged is not None and \
+                    is_unchanged(article['Id'], fingerprint):
+                fingerprint = None
+            selected.append((article, fingerprint))
+        return selected
+
+    @staticmethod
+    def __get_index_metadata(article):
+        """
+        Returns the metadata stored with an article in the vector store,
+        which searches can filter on.
+
+        Args:
+            article: The article record.
+
+        Returns:
+            dict: The knowledge article ID, title and modification time in
+                  seconds since the epoch.
+        """
+        return {
+                'article_id': article['KnowledgeArticleId'],
+                'title': article['Title'],
+                'modified_at': get_epoch(article['LastModifiedDate']),
+                }
+
+    def __get_articles(self, checkpoint=None, is_unchanged=None):
+        """
+        Retrieves articles from the Salesforce Knowledge Base modified after
+        the specified checkpoint.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all articles.
+            is_unchanged: An optional function taking an article record ID
+                          and its content fingerprint, returning True if the
+                          article can be skipped.
+
+        Yields:
+            Data: A Data object containing metadata, article ID and
+                  watermark, and generated questions unless the article is
+                  skipped.
+        """
+        for article, fingerprint in self.__select_articles(checkpoint,
+                                                           is_unchanged):
             yield Data(
+                    None if fingerprint is None else
                     self.__generate_qeustions(article['Summary']),
-                    {'article_id': article['KnowledgeArticleId'],
-                     'title': article['Title']},
-                    article['Id']
+                    self.__get_index_metadata(article),
+                    article['Id'],
+                    get_checkpoint(article),
+                    fingerprint
             )
 
-    def get_update_data(self, start_date, end_date):
+    async def __aget_articles(self, checkpoint=None, is_unchanged=None):
         """
-        Retrieves update data for the specified date range.
+        Retrieves articles like __get_articles, awaiting the language model.
 
         Args:
-            start_date: The start date for filtering articles.
-            end_date: The end date for filtering articles.
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all articles.
+            is_unchanged: An optional function taking an article record ID
+                          and its content fingerprint, returning True if the
+                          article can be skipped.
+
+        Yields:
+            Data: A Data object containing metadata, article ID and
+                  watermark, and generated questions unless the article is
+                  skipped.
+        """
+        for article, fingerprint in await asyncio.to_thread(
+                self.__select_articles, checkpoint, is_unchanged):
+            yield Data(
+                    None if fingerprint is None else
+                    await self.__agenerate_questions(article['Summary']),
+                    self.__get_index_metadata(article),
+                    article['Id'],
+                    get_checkpoint(article),
+                    fingerprint
+            )
+
+    def get_update_data(self, checkpoint, is_unchanged=None):
+        """
+        Retrieves articles updated after the specified checkpoint.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all articles.
+            is_unchanged: An optional function taking an article record ID
+                          and its content fingerprint, returning True if the
+                          article can be skipped.
 
         Returns:
             generator: A generator yielding Data objects for each article.
         """
-        return self.__get_articles(start_date, end_date)
+        return self.__get_articles(checkpoint, is_unchanged)
 
-    @timed_lru_cache()
-    def __get_summary(self, solution):
+    def aget_update_data(self, checkpoint, is_unchanged=None):
         """
-        Generates a concise summary for the provided solution.
+        Retrieves articles updated after the specified checkpoint, awaiting
+        the language model.
 
         Args:
-            solution: The solution text to summarize.
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all articles.
+            is_unchanged: An optional function taking an article record ID
+                          and its content fingerprint, returning True if the
+                          article can be skipped.
 
         Returns:
-            str: The concise summary generated for the solution.
+            AsyncGenerator: An async generator yielding Data objects for
+                            each article.
+        """
+        return self.__aget_articles(checkpoint, is_unchanged)
+
+    def __get_summary_chain(self):
+        """
+        Builds the chain summarizing a solution.
+
+        Returns:
+            Runnable: The chain taking the solution text.
         """
         prompt = PromptTemplate.from_template(SUMMARY_PROMPT)
-        chain = (
+        return (
                 {'solution': RunnablePassthrough()}
                 | prompt
                 | self.model.llm
                 | StrOutputParser()
                 )
-        return chain.invoke(solution)
 
-    def get_content(self, metadata):
+    @timed_lru_cache()
+    def __get_summary(self, solution):
         """
-        Retrieves the content of an article based on its metadata.
+        Returns the concise summary of the provided solution as a shared
+        stream, read from the summary cache if one is configured and holds a
+        summary of the same solution.
+
+        Args:
+            solution: The solution text to summarize.
+
+        Returns:
+            SharedStream: The concise summary generated for the solution.
+        """
+        # The stream only holds the chain, so the cache entry doesn't keep
+        # the data source alive.
+        return SharedStream(partial(
+                stream_with_cache, self.summary_cache,
+                get_fingerprint(solution),
+                partial(self.__get_summary_chain().stream, solution)))
+
+    @timed_lru_cache()
+    def __aget_summary(self, solution):
+        """
+        Returns the concise summary of the provided solution like
+        __get_summary, as an async shared stream.
+
+        Args:
+            solution: The solution text to summarize.
+
+        Returns:
+            AsyncSharedStream: The concise summary generated for the
+                               solution.
+        """
+        return AsyncSharedStream(partial(
+                astream_with_cache, self.summary_cache,
+                get_fingerprint(solution),
+                partial(self.__get_summary_chain().astream, solution)))
+
+    def __query_solution(self, metadata):
+        """
+        Retrieves the solution text of an article.
 
         Args:
             metadata: The metadata containing the article ID.
 
         Returns:
-            Content: A Content object containing the summary of the article.
+            str: The solution of the article without HTML tags.
         """
         article = self.sf.query_all(
             f'SELECT Knowledge_1_Solution__c FROM Knowledge__kav '
             f'WHERE KnowledgeArticleId = \'{metadata["article_id"]}\'')
-        return Content(
-                {},
-                self.__get_summary(
-                    strip_tags(article['records'][0]
-                               ['Knowledge_1_Solution__c']))
-                )
+        return strip_tags(article['records'][0]['Knowledge_1_Solution__c'])
+
+    def get_content(self, metadata):
+        """
+        Retrieves the content of an article based on its metadata.
+
+        Args:
+            metadata: The metadata containing the article ID.
+
+        Returns:
+            Content: A Content object containing the summary of the article.
+        """
+        return Content({}, self.__get_summary(self.__query_solution(metadata)))
+
+    async def aget_content(self, metadata):
+        """
+        Retrieves the content of an article like get_content. The blocking
+        Salesforce query runs in a worker thread and the summary is
+        generated by awaiting the language model.
+
+        Args:
+            metadata: The metadata containing the article ID.
+
+        Returns:
+            Content: A Content object containing the summary of the article.
+        """
+        solution = await asyncio.to_thread(self.__query_solution, metadata)
+        return Content({}, self.__aget_summary(solution))
 
     def custom_api(self, action, data):
         """
@@ -251,12 +442,27 @@ class KnowledgeBaseSource(BaseContext, Datasource):
 
     def generate_output(self, content):
         """
-        Generates the output for the provided content.
+        Generates the output for the provided content, streaming the summary
+        as it is generated.
 
         Args:
             content: The content object to generate output from.
 
         Returns:
-            str: The summary of the content.
+            Iterator[str]: The chunks of the summary of the content.
+        """
+        return content.iter_summary()
+
+    async def agenerate_output(self, content):
+        """
+        Generates the output like generate_output, from a summary streamed
+        asynchronously.
+
+        Args:
+            content: The content object to generate output from.
+
+        Yields:
+            str: The next chunk of the summary of the content.
         """
-        return content.summary
+        async for chunk in content.aiter_summary():
+            yield chunk
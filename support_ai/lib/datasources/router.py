@@ -0,0 +1,136 @@
+"""
+This module provides the EmbeddingRouter class, which routes a query to a
+data source by comparing its embedding with the centroids of example
+queries of every data source, without any LLM call.
+"""
+
+import asyncio
+from threading import Lock
+
+import numpy as np
+from support_ai.lib import const
+
+DEFAULT_MARGIN = 0.05
+ROUTING_EXAMPLES = {
+    const.CONFIG_SF: [
+        'Some issues happened, is there similar discussions?',
+        'Has any customer reported this error before?',
+        'Find cases with the same symptom.',
+        'What was the root cause of similar support cases?',
+    ],
+    const.CONFIG_KB: [
+        'Give me operational steps to resolve certain issue',
+        'How do I configure this feature?',
+        'Is there a knowledge base article about this procedure?',
+        'What are the steps to upgrade the deployment?',
+    ],
+}
+
+
+class EmbeddingRouter:
+    """
+    Routes queries to data sources by cosine similarity between the query
+    embedding and the normalized centroid of the example queries of each
+    data source. A query is left undecided when the best data source
+    doesn't beat the second best by the configured margin.
+    """
+
+    def __init__(self, embeddings, examples, margin=DEFAULT_MARGIN):
+        """
+        Initializes the EmbeddingRouter. The centroids are computed on first
+        use.
+
+        Args:
+            embeddings: The Embeddings embedding the queries and examples.
+            examples: A dictionary of example queries keyed by data source
+                      type.
+            margin: The minimum similarity difference between the best and
+                    second best data sources for a decision.
+        """
+        self.embeddings = embeddings
+        self.examples = examples
+        self.margin = margin
+        self.mutex = Lock()
+        self.ds_types = None
+        self.centroids = None
+
+    @staticmethod
+    def __normalize(vectors):
+        """
+        Scales vectors to unit length.
+
+        Args:
+            vectors: An array of vectors, one per row.
+
+        Returns:
+            numpy.ndarray: The normalized vectors.
+        """
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, np.finfo(vectors.dtype).tiny)
+
+    def __get_centroids(self):
+        """
+        Retrieves the centroids, embedding the examples on first use.
+
+        Returns:
+            Tuple[List[str], numpy.ndarray]: The data source types, and their
+                                             centroids in the same order.
+        """
+        with self.mutex:
+            if self.centroids is None:
+                ds_types = list(self.examples)
+                centroids = [
+                    self.__normalize(np.asarray(
+                        self.embeddings.embed_documents(
+                            self.examples[ds_type]),
+                        dtype=np.float64)).mean(axis=0)
+                    for ds_type in ds_types]
+                self.ds_types = ds_types
+                self.centroids = self.__normalize(np.stack(centroids))
+            return self.ds_types, self.centroids
+
+    def route_vector(self, vector):
+        """
+        Routes an embedded query.
+
+        Args:
+            vector: The query embedding.
+
+        Returns:
+            str: The data source type, or None if the margin is too low.
+        """
+        ds_types, centroids = self.__get_centroids()
+        if len(ds_types) == 1:
+            return ds_types[0]
+        scores = centroids @ self.__normalize(
+                np.asarray(vector, dtype=np.float64))
+        best, second = np.argsort(scores)[::-1][:2]
+        if scores[best] - scores[second] < self.margin:
+            return None
+        return ds_types[best]
+
+    def route(self, query):
+        """
+        Routes a query.
+
+        Args:
+            query: The user query.
+
+        Returns:
+            str: The data source type, or None if the margin is too low.
+        """
+        return self.route_vector(self.embeddings.embed_query(query))
+
+    async def aroute(self, query):
+        """
+        Routes a query like route, awaiting the embeddings.
+
+        Args:
+            query: The user query.
+
+        Returns:
+            str: The data source type, or None if the margin is too low.
+        """
+        if self.centroids is None:
+            await asyncio.to_thread(self.__get_centroids)
+        return self.route_vector(await self.embeddings.aembed_query(query))
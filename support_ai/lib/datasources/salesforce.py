@@ -2,23 +2,47 @@
 This module provides functionality to interact with Salesforce.
 """
 
+import asyncio
 import re
+import weakref
+from functools import partial
+from itertools import chain
 
 import simple_salesforce
-from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from support_ai.lib import const
 from support_ai.lib.context import BaseContext
-from support_ai.lib.utils.docs_chain import docs_refine
-from support_ai.lib.utils.lru import timed_lru_cache
+from support_ai.lib.summary_cache import (
+  astream_with_cache,
+  get_summary_cache,
+  stream_with_cache,
+)
+from support_ai.lib.utils.batch import batched
+from support_ai.lib.utils.docs_chain import (
+  DEFAULT_TREE_REDUCE_PARALLELISM,
+  get_strategy,
+  STRATEGY_REFINE,
+)
+from support_ai.lib.utils import metrics
+from support_ai.lib.utils.lru import timed_lru_cache, TTLCache
 from support_ai.lib.utils.parallel_executor import (
-  run_fn_in_parallel,
+  arun_fn_unordered,
+  arun_in_parallel,
+  run_fn_in_background,
+  run_fn_unordered,
   run_in_parallel,
 )
+from support_ai.lib.utils.shared_stream import AsyncSharedStream, SharedStream
+from support_ai.lib.datasources.checkpoint import (
+  get_epoch,
+  get_soql_condition,
+  WatermarkTracker,
+)
+from support_ai.lib.datasources.comment_filter import CommentFilter
 from support_ai.lib.datasources.ds import Data, Content, Datasource
+from support_ai.lib.datasources.fingerprint import get_fingerprint
 
 
 SYMPTOM_INITIAL_PROMPT = """Summarize symptom of the following content:
@@ -55,6 +79,28 @@ SOL_JUDGEMENT_PROMPT = \
 
     CONTEXT: "{context}"
     ANS: """  # noqa
+SOL_BATCH_JUDGEMENT_PROMPT = \
+"""Judge if each of the following numbered comments has described root cause, solution or workaround.
+    Answer one line per comment, in the form "<number>: YES" or "<number>: NO".
+
+    COMMENTS:
+    1. "The issue is mainly caused by the bug."
+    2. "We are still working on this issue."
+    3. "We can provide a workaround to bypass this issue."
+    ANS:
+    1: YES
+    2: NO
+    3: YES
+
+    COMMENTS:
+{context}
+    ANS:
+"""  # noqa
+SOL_BATCH_COMMENT = '    {index}. "{comment}"'
+SOL_VERDICT_PATTERN = re.compile(r'^\W*(\d+)\W+(YES|NO)\b',
+                                 re.MULTILINE | re.IGNORECASE)
+JUDGE_BATCH_SIZE = 20
+NO_SOLUTION = 'A solution cannot be summarized from the case comments.'
 SOL_INITIAL_PROMPT = \
 """Extract the root cause, workaround or solution from the following content in detail:
     "{context}"
@@ -64,6 +110,30 @@ SOL_REFINE_PROMPT = """Here's the previous extracted content:
     Combine it with the following content in detail:
     "{context}"
     SOLUTION:"""
+USER_QUERY_BATCH_SIZE = 200
+
+_MISSING = object()
+_user_names = TTLCache(maxsize=4096, seconds=24*60*60,
+                       name='salesforce.user_names')
+
+
+def get_referent(ref):
+    """
+    Dereferences a weak reference to a data source or one of its methods.
+
+    Args:
+        ref: The weak reference.
+
+    Returns:
+        Any: The referenced object.
+
+    Raises:
+        ValueError: If the data source no longer exists.
+    """
+    referent = ref()
+    if referent is None:
+        raise ValueError('The Salesforce data source no longer exists')
+    return referent
 
 
 class Dialogs:
@@ -93,6 +163,12 @@ class Dialogs:
         """
         return hash(tuple(str(dialog) for dialog in self.dialogs))
 
+    def __eq__(self, other):
+        """
+        Return whether both instances contain the same dialog entries.
+        """
+        return isinstance(other, Dialogs) and self.dialogs == other.dialogs
+
     def __iter__(self):
         """
         Return an iterator over the dialog entries.
@@ -153,76 +229,312 @@ class SalesforceSource(BaseContext, Datasource):
         auth = get_authentication(config[const.CONFIG_AUTHENTICATION])
         self.sf = simple_salesforce.Salesforce(**auth)
         self.model = self.model_manager.get_model(config)
+        self.use_relationship_query = True
+        self.summary_cache = get_summary_cache(config, const.CONFIG_SF)
+        self.strategy = config.get(const.CONFIG_SUMMARY_STRATEGY,
+                                   STRATEGY_REFINE)
+        get_strategy(self.strategy)
+        self.tree_reduce_parallelism = config.get(
+                const.CONFIG_TREE_REDUCE_PARALLELISM,
+                DEFAULT_TREE_REDUCE_PARALLELISM)
+        self.judge_batch_size = config.get(const.CONFIG_JUDGE_BATCH_SIZE,
+                                           JUDGE_BATCH_SIZE)
+        self.comment_filter = CommentFilter(
+                config.get(const.CONFIG_COMMENT_FILTER, {}))
+
+    def __get_strategy(self, strategy):
+        """
+        Retrieves the summarization strategy of a call, bound to the
+        concurrency settings of the llm.
 
-    def __get_symptom(self, desc):
+        Args:
+            strategy: The strategy name, or None for the configured one.
+
+        Returns:
+            Strategy: The functions implementing the strategy.
+        """
+        return get_strategy(strategy or self.strategy,
+                            self.tree_reduce_parallelism, self.model.limiter,
+                            self.model.alimiter)
+
+    def __split_description(self, desc):
+        """
+        Splits the provided case description into documents.
+
+        Args:
+            desc: The case description to split.
+
+        Returns:
+            List[Document]: The documents of the description.
+        """
+        return self.model.budget.split([desc], SYMPTOM_INITIAL_PROMPT,
+                                       SYMPTOM_REFINE_PROMPT)
+
+    def __get_symptom(self, desc, strategy=None):
         """
         Extracts symptoms from the provided case description.
 
         Args:
             desc: The case description from which to extract symptoms.
+            strategy: The summarization strategy, or None for the configured
+                      one.
 
         Returns:
             List[Document]: A list of documents containing refined symptoms.
         """
-        splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1024,
-                chunk_overlap=128,
-                )
-        docs = splitter.create_documents([desc])
-        return docs_refine(self.model.llm, docs, SYMPTOM_INITIAL_PROMPT,
-                           SYMPTOM_REFINE_PROMPT)
+        return self.__get_strategy(strategy).summarize(
+                self.model.llm, self.__split_description(desc),
+                SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT)
 
-    def __get_cases(self, start_date=None, end_date=None):
+    async def __aget_symptom(self, desc, strategy=None):
         """
-        Retrieves cases from Salesforce based on the specified date range.
+        Extracts symptoms from the provided case description like
+        __get_symptom, awaiting the language model.
 
         Args:
-            start_date: The starting date for case retrieval.
-            end_date: The ending date for case retrieval.
+            desc: The case description from which to extract symptoms.
+            strategy: The summarization strategy, or None for the configured
+                      one.
 
-        Yields:
-            Data: An instance of Data containing symptoms, metadata, and
-                  case number for each case.
+        Returns:
+            str: The refined symptoms.
+        """
+        return await self.__get_strategy(strategy).asummarize(
+                self.model.llm, self.__split_description(desc),
+                SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT)
+
+    def __select_cases(self, checkpoint, is_unchanged):
+        """
+        Queries the cases modified after the specified checkpoint, marking
+        the cases without description and the unchanged ones as skipped.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all cases.
+            is_unchanged: An optional function taking a case number and its
+                          content fingerprint, returning True if the case
+                          can be skipped.
+
+        Returns:
+            Tuple[list, list]: The case records in query order and their
+                               content fingerprints, or None for the
+                               skipped cases.
         """
         clause = ''
-        conditions = []
-        if start_date is not None:
-            conditions.append(
-                f'LastModifiedDate >= {start_date.isoformat()}T00:00:00Z')
-
-        if end_date is not None:
-            conditions.append(
-                f'LastModifiedDate < {end_date.isoformat()}T00:00:00Z')
-
-        for condition in conditions:
-            if clause:
-                clause += ' AND '
-            clause += condition
-
-        sql_cmd = 'SELECT Id, CaseNumber, Subject, Description ' + \
-                  'FROM Case' + (f' WHERE {clause}' if clause else '')
-        for case in self.sf.query_all(sql_cmd)['records']:
-            if case['Description'] is None:
-                continue
+        if checkpoint is not None:
+            clause = get_soql_condition(checkpoint)
+
+        sql_cmd = 'SELECT Id, CaseNumber, Subject, Description, ' + \
+                  'Sev_Lvl__c, CreatedDate, LastModifiedDate FROM Case' + \
+                  (f' WHERE {clause}' if clause else '') + \
+                  ' ORDER BY LastModifiedDate, Id'
+        cases = self.__query(sql_cmd)['records']
+        fingerprints = []
+        for case in cases:
+            fingerprint = None
+            if case['Description'] is not None:
+                fingerprint = get_fingerprint(case['Subject'],
+                                              case['Description'])
+                if is_unchanged is not None and \
+                        is_unchanged(case['CaseNumber'], fingerprint):
+                    fingerprint = None
+            fingerprints.append(fingerprint)
+        return cases, fingerprints
+
+    @staticmethod
+    def __get_index_metadata(case):
+        """
+        Returns the metadata stored with a case in the vector store, which
+        searches can filter on.
+
+        Args:
+            case: The case record.
+
+        Returns:
+            dict: The case number, subject, severity level, and creation and
+                  modification times in seconds since the epoch.
+        """
+        return {
+                'case_number': case['CaseNumber'],
+                'subject': case['Subject'] or '',
+                'severity': case['Sev_Lvl__c'] or '',
+                'created_at': get_epoch(case['CreatedDate']),
+                'modified_at': get_epoch(case['LastModifiedDate']),
+                }
+
+    def __get_skipped_data(self, cases, index, tracker):
+        """
+        Returns the Data of a skipped case, which refreshes its stored
+        metadata without processing its content again.
+
+        Args:
+            cases: The case records in query order.
+            index: The position of the skipped case.
+            tracker: The WatermarkTracker of the cases.
+
+        Returns:
+            Data: The metadata, case number and watermark of the case.
+        """
+        return Data(None, self.__get_index_metadata(cases[index]),
+                    cases[index]['CaseNumber'], tracker.complete(index))
+
+    def __get_cases(self, checkpoint=None, is_unchanged=None):
+        """
+        Retrieves cases from Salesforce modified after the specified
+        checkpoint. Symptom extraction runs for up to the llm's configured
+        concurrency cases at once, and cases are yielded in completion order.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all cases.
+            is_unchanged: An optional function taking a case number and its
+                          content fingerprint, returning True if the case
+                          can be skipped.
+
+        Yields:
+            Data: An instance of Data containing metadata, case number and
+                  watermark for each skipped case, then containing symptoms
+                  as well for each other case.
+        """
+        cases, fingerprints = self.__select_cases(checkpoint, is_unchanged)
+        tracker = WatermarkTracker(cases)
+        selected = []
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint is None:
+                yield self.__get_skipped_data(cases, index, tracker)
+            else:
+                selected.append(index)
+        for position, symptom in run_fn_unordered(
+                lambda index: self.__get_symptom(cases[index]['Description']),
+                selected, self.model.concurrency,
+                limiter=self.model.limiter):
+            index = selected[position]
             yield Data(
-                    self.__get_symptom(case['Description']),
-                    {'case_number': case['CaseNumber'],
-                     'subject': case['Subject']},
-                    case['CaseNumber']
+                    symptom,
+                    self.__get_index_metadata(cases[index]),
+                    cases[index]['CaseNumber'],
+                    tracker.complete(index),
+                    fingerprints[index]
                     )
 
-    def get_update_data(self, start_date, end_date):
+    async def __aget_cases(self, checkpoint=None, is_unchanged=None):
         """
-        Gets updated cases within the specified date range.
+        Retrieves cases like __get_cases, awaiting the symptom extraction of
+        up to the llm's configured concurrency cases at once.
 
         Args:
-            start_date: The starting date for case retrieval.
-            end_date: The ending date for case retrieval.
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all cases.
+            is_unchanged: An optional function taking a case number and its
+                          content fingerprint, returning True if the case
+                          can be skipped.
+
+        Yields:
+            Data: An instance of Data containing metadata, case number and
+                  watermark for each skipped case, then containing symptoms
+                  as well for each other case.
+        """
+        cases, fingerprints = await asyncio.to_thread(
+                self.__select_cases, checkpoint, is_unchanged)
+        tracker = WatermarkTracker(cases)
+        selected = []
+        for index, fingerprint in enumerate(fingerprints):
+            if fingerprint is None:
+                yield self.__get_skipped_data(cases, index, tracker)
+            else:
+                selected.append(index)
+        async for position, symptom in arun_fn_unordered(
+                lambda index: self.__aget_symptom(
+                    cases[index]['Description']),
+                selected, self.model.concurrency,
+                limiter=self.model.alimiter):
+            index = selected[position]
+            yield Data(
+                    symptom,
+                    self.__get_index_metadata(cases[index]),
+                    cases[index]['CaseNumber'],
+                    tracker.complete(index),
+                    fingerprints[index]
+                    )
+
+    def get_update_data(self, checkpoint, is_unchanged=None):
+        """
+        Gets cases updated after the specified checkpoint.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all cases.
+            is_unchanged: An optional function taking a case number and its
+                          content fingerprint, returning True if the case
+                          can be skipped.
 
         Returns:
             Generator: A generator yielding Data instances for each case.
         """
-        return self.__get_cases(start_date, end_date)
+        return self.__get_cases(checkpoint, is_unchanged)
+
+    def aget_update_data(self, checkpoint, is_unchanged=None):
+        """
+        Gets cases updated after the specified checkpoint, awaiting the
+        language model.
+
+        Args:
+            checkpoint: The Checkpoint to resume from, or None to retrieve
+                        all cases.
+            is_unchanged: An optional function taking a case number and its
+                          content fingerprint, returning True if the case
+                          can be skipped.
+
+        Returns:
+            AsyncGenerator: An async generator yielding Data instances for
+                            each case.
+        """
+        return self.__aget_cases(checkpoint, is_unchanged)
+
+    def __query(self, sql_cmd):
+        """
+        Runs a SOQL query, counting it in the metrics.
+
+        Args:
+            sql_cmd: The SOQL query.
+
+        Returns:
+            dict: The query result.
+        """
+        metrics.incr('salesforce.api_calls')
+        return self.sf.query_all(sql_cmd)
+
+    def __get_user_names(self, user_ids):
+        """
+        Resolves user IDs into first names, querying Salesforce only for the
+        IDs missing from the process-wide user name cache.
+
+        Args:
+            user_ids: An iterable of user IDs.
+
+        Returns:
+            dict: A mapping from user ID to first name, or to the user ID
+                  itself for users without first name or not found.
+        """
+        names = {}
+        missing = []
+        for user_id in set(user_ids):
+            name = _user_names.get(user_id, _MISSING)
+            if name is _MISSING:
+                missing.append(user_id)
+            else:
+                names[user_id] = name
+        metrics.incr('salesforce.user_name_cache_hits', len(names))
+        for i in range(0, len(missing), USER_QUERY_BATCH_SIZE):
+            batch = missing[i:i + USER_QUERY_BATCH_SIZE]
+            ids = ', '.join(f'\'{user_id}\'' for user_id in batch)
+            found = {user['Id']: user['FirstName'] for user in self.__query(
+                    f'SELECT Id, FirstName FROM User '
+                    f'WHERE Id IN ({ids})')['records']}
+            for user_id in batch:
+                names[user_id] = found.get(user_id) or user_id
+                _user_names.put(user_id, names[user_id])
+        return names
 
     def __translate_into_dialogs(self, records):
         """
@@ -234,44 +546,62 @@ class SalesforceSource(BaseContext, Datasource):
         Returns:
             Dialogs: An instance of Dialogs containing translated comments.
         """
+        names = self.__get_user_names(
+                comment['CreatedById'] for comment in records)
         dialogs = Dialogs()
         for comment in records:
-            _records = self.sf.query_all(
-                        f'SELECT FirstName FROM User WHERE Id = '
-                        f'\'{comment["CreatedById"]}\'')
-            firstname = _records['records'][0]['FirstName']
-            dialogs.append(firstname, comment["CommentBody"])
+            dialogs.append(names.get(comment['CreatedById']),
+                           comment['CommentBody'])
         return dialogs
 
     @run_in_parallel(parallelism=4)
-    def __condense_context(self, context):
+    def __condense_context(self, context, strategy=None):
         """
         Condenses the context of case comments into a refined summary.
 
         Args:
             context: A list of contexts for each user interaction.
+            strategy: The summarization strategy, or None for the configured
+                      one.
 
         Returns:
             List[str]: A list of condensed summaries for each context.
         """
-        splitter = RecursiveCharacterTextSplitter(
-                chunk_size=2048,
-                chunk_overlap=128,
-                length_function=len,
-                )
-        docs = splitter.create_documents(context)
-        return docs_refine(self.model.llm, docs, CONDENSE_INITIAL_PROMPT,
-                           CONDENSE_REFINE_PROMPT)
+        docs = self.model.budget.split(context, CONDENSE_INITIAL_PROMPT,
+                                       CONDENSE_REFINE_PROMPT)
+        return self.__get_strategy(strategy).summarize(
+                self.model.llm, docs, CONDENSE_INITIAL_PROMPT,
+                CONDENSE_REFINE_PROMPT)
+
+    @arun_in_parallel(parallelism=4)
+    async def __acondense_context(self, context, strategy=None):
+        """
+        Condenses the context of case comments like __condense_context,
+        awaiting the language model.
 
-    def __get_process(self, dialogs):
+        Args:
+            context: A list of contexts for each user interaction.
+            strategy: The summarization strategy, or None for the configured
+                      one.
+
+        Returns:
+            List[str]: A list of condensed summaries for each context.
         """
-        Generates a summarized process statement from dialog comments.
+        docs = self.model.budget.split(context, CONDENSE_INITIAL_PROMPT,
+                                       CONDENSE_REFINE_PROMPT)
+        return await self.__get_strategy(strategy).asummarize(
+                self.model.llm, docs, CONDENSE_INITIAL_PROMPT,
+                CONDENSE_REFINE_PROMPT)
+
+    def __group_dialogs(self, dialogs):
+        """
+        Groups consecutive dialog comments by user.
 
         Args:
             dialogs: The dialog instances containing user comments.
 
         Returns:
-            str: A summarized process statement based on dialog content.
+            List[List[str]]: The comments of each user interaction.
         """
         user = ''
         contexts = []
@@ -285,76 +615,491 @@ class SalesforceSource(BaseContext, Datasource):
             user = dialog['user']
             context = [dialog['comment']]
         contexts.append((context))
-        condensed_contexts = self.__condense_context(contexts)
+        return contexts
+
+    def __get_process_stmt(self, condensed_contexts):
+        """
+        Joins condensed contexts into a single-line process statement.
+
+        Args:
+            condensed_contexts: The condensed summary of each user
+                                interaction.
+
+        Returns:
+            str: The process statement.
+        """
         process_stmt = ' '.join(condensed_contexts).replace('\n', '')
         return re.sub(r'\s+', ' ', process_stmt).strip()
 
+    def __get_process(self, dialogs, strategy=None):
+        """
+        Generates a summarized process statement from dialog comments.
+
+        Args:
+            dialogs: The dialog instances containing user comments.
+            strategy: The summarization strategy, or None for the configured
+                      one.
+
+        Returns:
+            str: A summarized process statement based on dialog content.
+        """
+        return self.__get_process_stmt(self.__condense_context(
+                self.__group_dialogs(dialogs), strategy=strategy))
+
+    async def __aget_process(self, dialogs, strategy=None):
+        """
+        Generates a summarized process statement like __get_process,
+        awaiting the language model.
+
+        Args:
+            dialogs: The dialog instances containing user comments.
+            strategy: The summarization strategy, or None for the configured
+                      one.
+
+        Returns:
+            str: A summarized process statement based on dialog content.
+        """
+        return self.__get_process_stmt(await self.__acondense_context(
+                self.__group_dialogs(dialogs), strategy=strategy))
+
+    def __get_judgement_chains(self):
+        """
+        Builds the chains judging a single comment and a batch of comments.
+
+        Returns:
+            Tuple: The single comment chain and the batch chain.
+        """
+        chains = []
+        for prompt in (SOL_JUDGEMENT_PROMPT, SOL_BATCH_JUDGEMENT_PROMPT):
+            chains.append(
+                    {'context': RunnablePassthrough()}
+                    | PromptTemplate.from_template(prompt)
+                    | self.model.llm
+                    | StrOutputParser()
+                    )
+        return tuple(chains)
+
+    def __batch_comments(self, comments):
+        """
+        Groups comments into the batches judged together, bounded by the
+        configured batch size and the token budget of the batch prompt.
+
+        Args:
+            comments: The comments to be judged.
+
+        Returns:
+            List[List[str]]: The batches of comments, in input order.
+        """
+        budget = self.model.budget
+        return list(batched(
+                comments, self.judge_batch_size,
+                budget.get_chunk_size(SOL_BATCH_JUDGEMENT_PROMPT),
+                lambda comment: budget.count(SOL_BATCH_COMMENT.format(
+                    index=self.judge_batch_size, comment=comment))))
+
+    @staticmethod
+    def __format_batch(comments):
+        """
+        Formats a batch of comments as a numbered list.
+
+        Args:
+            comments: The comments of the batch.
+
+        Returns:
+            str: The numbered comments.
+        """
+        return '\n'.join(SOL_BATCH_COMMENT.format(index=index, comment=comment)
+                         for index, comment in enumerate(comments, 1))
+
+    @staticmethod
+    def __parse_verdicts(result, comments):
+        """
+        Parses the verdicts of a batch of comments.
+
+        Args:
+            result: The output of the batch chain.
+            comments: The comments of the batch.
+
+        Returns:
+            List[str | None]: The comments, or None for the comments judged
+                              as not relevant, or None if a verdict is
+                              missing.
+        """
+        verdicts = {}
+        for index, verdict in SOL_VERDICT_PATTERN.findall(result):
+            verdicts.setdefault(int(index), verdict.upper() == 'YES')
+        if any(index not in verdicts
+               for index in range(1, len(comments) + 1)):
+            return None
+        return [comment if verdicts[index] else None
+                for index, comment in enumerate(comments, 1)]
+
     @run_in_parallel(parallelism=4)
-    def __judge_comment(self, comment):
+    def __judge_batch(self, comments):
+        """
+        Judges a batch of comments in a single call, falling back to a call
+        per comment if the verdicts can't be parsed.
+
+        Args:
+            comments: The comments of the batch.
+
+        Returns:
+            List[str | None]: The comments, or None for the comments judged
+                              as not relevant.
+        """
+        single_chain, batch_chain = self.__get_judgement_chains()
+        if len(comments) > 1:
+            judged = self.__parse_verdicts(
+                    batch_chain.invoke(self.__format_batch(comments)),
+                    comments)
+            if judged is not None:
+                metrics.incr('salesforce.judge.batched', len(comments))
+                return judged
+            metrics.incr('salesforce.judge.fallback', len(comments))
+        return [comment if single_chain.invoke(comment) != 'NO' else None
+                for comment in comments]
+
+    @arun_in_parallel(parallelism=4)
+    async def __ajudge_batch(self, comments):
+        """
+        Judges a batch of comments like __judge_batch, awaiting the language
+        model.
+
+        Args:
+            comments: The comments of the batch.
+
+        Returns:
+            List[str | None]: The comments, or None for the comments judged
+                              as not relevant.
+        """
+        single_chain, batch_chain = self.__get_judgement_chains()
+        if len(comments) > 1:
+            judged = self.__parse_verdicts(
+                    await batch_chain.ainvoke(self.__format_batch(comments)),
+                    comments)
+            if judged is not None:
+                metrics.incr('salesforce.judge.batched', len(comments))
+                return judged
+            metrics.incr('salesforce.judge.fallback', len(comments))
+        return [comment
+                if await single_chain.ainvoke(comment) != 'NO' else None
+                for comment in comments]
+
+    def __filter_comments(self, comments):
+        """
+        Drops the comments that obviously carry no solution before they are
+        judged, counting the dropped comments and the judging calls saved,
+        as estimated from the batch size alone, without counting tokens.
+
+        Args:
+            comments: The comments to filter.
+
+        Returns:
+            List[str]: The remaining comments.
+        """
+        kept, dropped = self.comment_filter.filter(comments)
+        for reason, count in dropped.items():
+            metrics.incr(f'salesforce.comment_filter.{reason}', count)
+        if dropped:
+            metrics.incr('salesforce.comment_filter.calls_saved',
+                         -(-len(comments) // self.judge_batch_size) -
+                         -(-len(kept) // self.judge_batch_size))
+        return kept
+
+    def __judge_comment(self, comments):
         """
         Judges the validity of comments to determine their relevance for
-        solutions.
+        solutions, several comments at a time.
 
         Args:
-            comment: A list of comments to be judged.
+            comments: A list of comments to be judged.
 
         Returns:
             List[str | None]: A list of valid comments or None if the comment
                               is judged as not relevant.
         """
-        prompt = PromptTemplate.from_template(SOL_JUDGEMENT_PROMPT)
-        chain = (
-                {'context': RunnablePassthrough()}
-                | prompt
-                | self.model.llm
-                | StrOutputParser()
-                )
-        result = chain.invoke(comment)
-        return comment if result != 'NO' else None
+        return list(chain.from_iterable(
+                self.__judge_batch(self.__batch_comments(comments))))
 
-    def __get_solution(self, dialogs):
+    async def __ajudge_comment(self, comments):
+        """
+        Judges the validity of comments like __judge_comment, awaiting the
+        language model.
+
+        Args:
+            comments: A list of comments to be judged.
+
+        Returns:
+            List[str | None]: A list of valid comments or None if the comment
+                              is judged as not relevant.
+        """
+        return list(chain.from_iterable(
+                await self.__ajudge_batch(self.__batch_comments(comments))))
+
+    def __get_solution(self, dialogs, strategy=None):
         """
         Generates a solution summary from the provided dialog comments.
 
         Args:
             dialogs: The dialog instances containing user comments.
+            strategy: The summarization strategy, or None for the configured
+                      one.
 
         Returns:
-            List[Document]: A list of documents containing refined solution
-                            summaries.
+            str: The refined solution summary.
         """
-        comments = []
-        for dialog in dialogs:
-            comments.append((dialog['comment']))
-        filtered_comments = self.__judge_comment(comments)
-
-        if filtered_comments is None:
-            return 'A solution cannot be summarized from the case comments.'
-        docs = []
-        for comment in filtered_comments:
-            if comment is not None:
-                docs.append(Document(page_content=comment))
-        return docs_refine(self.model.llm, docs, SOL_INITIAL_PROMPT,
-                           SOL_REFINE_PROMPT)
+        comments = self.__filter_comments(
+                [dialog['comment'] for dialog in dialogs])
+        docs = self.model.budget.split(
+                [comment for comment in self.__judge_comment(comments)
+                 if comment is not None],
+                SOL_INITIAL_PROMPT, SOL_REFINE_PROMPT)
+        if not docs:
+            return NO_SOLUTION
+        return self.__get_strategy(strategy).summarize(
+                self.model.llm, docs, SOL_INITIAL_PROMPT, SOL_REFINE_PROMPT)
+
+    async def __aget_solution(self, dialogs, strategy=None):
+        """
+        Generates a solution summary like __get_solution, awaiting the
+        language model.
+
+        Args:
+            dialogs: The dialog instances containing user comments.
+            strategy: The summarization strategy, or None for the configured
+                      one.
+
+        Returns:
+            str: The refined solution summary.
+        """
+        comments = self.__filter_comments(
+                [dialog['comment'] for dialog in dialogs])
+        docs = self.model.budget.split(
+                [comment for comment in await self.__ajudge_comment(comments)
+                 if comment is not None],
+                SOL_INITIAL_PROMPT, SOL_REFINE_PROMPT)
+        if not docs:
+            return NO_SOLUTION
+        return await self.__get_strategy(strategy).asummarize(
+                self.model.llm, docs, SOL_INITIAL_PROMPT, SOL_REFINE_PROMPT)
+
+    @staticmethod
+    def __stream_summary(model, strategy, extractors, desc, dialogs):
+        """
+        Creates a summary of the case description and dialogs, streaming the
+        symptom tokens as they are generated while the process and solution
+        are extracted in the background.
+
+        Args:
+            model: The Model summarizing the symptom.
+            strategy: The summarization strategy of the symptom.
+            extractors: Weak references to the methods extracting the
+                        process and the solution from the dialogs.
+            desc: The case description.
+            dialogs: The dialog instances containing user comments.
+
+        Yields:
+            str: The next chunk of the summary of symptoms, processes, and
+                 solutions.
+        """
+        fn_args = [(get_referent(extractor), (dialogs))
+                   for extractor in extractors]
+        with run_fn_in_background(fn_args) as futures:
+            yield from strategy.summarize_stream(
+                    model.llm, model.budget.split(
+                        [desc], SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT),
+                    SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT)
+            for future in futures:
+                yield '\n' + future.result()
 
     @timed_lru_cache()
     def __get_summary(self, desc, dialogs):
         """
-        Creates a summary of the case description and dialogs.
+        Returns the summary of the case description and dialogs as a shared
+        stream, read from the summary cache if one is configured and holds a
+        summary of the same content. The stream only holds weak references
+        to the data source, so the cached stream doesn't keep it alive.
+
+        Args:
+            desc: The case description.
+            dialogs: The dialog instances containing user comments.
+
+        Returns:
+            SharedStream: A formatted summary of symptoms, processes, and
+                          solutions.
+        """
+        key = get_fingerprint(desc, *(f'{dialog["user"]}: {dialog["comment"]}'
+                                      for dialog in dialogs))
+        extractors = (weakref.WeakMethod(self.__get_process),
+                      weakref.WeakMethod(self.__get_solution))
+        return SharedStream(partial(
+                stream_with_cache, self.summary_cache, key,
+                partial(self.__stream_summary, self.model,
+                        self.__get_strategy(None), extractors, desc,
+                        dialogs)))
+
+    @staticmethod
+    async def __astream_summary(model, strategy, extractors, desc, dialogs):
+        """
+        Creates a summary like __stream_summary, awaiting the language model.
+        The process and solution extraction is cancelled if the stream is
+        abandoned.
 
         Args:
+            model: The Model summarizing the symptom.
+            strategy: The summarization strategy of the symptom.
+            extractors: Weak references to the coroutine methods extracting
+                        the process and the solution from the dialogs.
             desc: The case description.
             dialogs: The dialog instances containing user comments.
 
+        Yields:
+            str: The next chunk of the summary of symptoms, processes, and
+                 solutions.
+        """
+        tasks = [asyncio.ensure_future(get_referent(extractor)(dialogs))
+                 for extractor in extractors]
+        try:
+            async for chunk in strategy.asummarize_stream(
+                    model.llm, model.budget.split(
+                        [desc], SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT),
+                    SYMPTOM_INITIAL_PROMPT, SYMPTOM_REFINE_PROMPT):
+                yield chunk
+            for task in tasks:
+                yield '\n' + await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @timed_lru_cache()
+    def __aget_summary(self, desc, dialogs):
+        """
+        Returns the summary of the case description and dialogs like
+        __get_summary, as an async shared stream.
+
+        Args:
+            desc: The case description.
+            dialogs: The dialog instances containing user comments.
+
+        Returns:
+            AsyncSharedStream: A formatted summary of symptoms, processes,
+                               and solutions.
+        """
+        key = get_fingerprint(desc, *(f'{dialog["user"]}: {dialog["comment"]}'
+                                      for dialog in dialogs))
+        extractors = (weakref.WeakMethod(self.__aget_process),
+                      weakref.WeakMethod(self.__aget_solution))
+        return AsyncSharedStream(partial(
+                astream_with_cache, self.summary_cache, key,
+                partial(self.__astream_summary, self.model,
+                        self.__get_strategy(None), extractors, desc,
+                        dialogs)))
+
+    def __query_case_with_comments(self, case_number):
+        """
+        Retrieves a case, its published comments and the comment authors'
+        names with a single parent-child relationship query. The author
+        names are stored in the user name cache.
+
+        Args:
+            case_number: The case number to retrieve.
+
+        Returns:
+            Tuple[dict, list]: The case record and its comment records.
+        """
+        case = self.__query(
+                'SELECT Id, Status, Public_Bug_URL__c, Sev_Lvl__c, ' +
+                'CaseNumber, Description, ' +
+                '(SELECT CommentBody, CreatedById, CreatedBy.FirstName ' +
+                'FROM CaseComments WHERE IsPublished = True ' +
+                'ORDER BY LastModifiedDate) FROM Case ' +
+                f'WHERE CaseNumber = \'{case_number}\'')['records'][0]
+        comments = []
+        result = case['CaseComments']
+        while result is not None:
+            comments.extend(result['records'])
+            if result['done']:
+                break
+            metrics.incr('salesforce.api_calls')
+            result = self.sf.query_more(result['nextRecordsUrl'],
+                                        identifier_is_url=True)
+        for comment in comments:
+            created_by = comment['CreatedBy'] or {}
+            _user_names.put(comment['CreatedById'],
+                            created_by.get('FirstName') or
+                            comment['CreatedById'])
+        return case, comments
+
+    def __query_case_and_comments(self, case_number):
+        """
+        Retrieves a case and its published comments with separate queries.
+
+        Args:
+            case_number: The case number to retrieve.
+
+        Returns:
+            Tuple[dict, list]: The case record and its comment records.
+        """
+        case = self.__query(
+                'SELECT Id, Status, Public_Bug_URL__c, Sev_Lvl__c, ' +
+                'CaseNumber, Description FROM Case ' +
+                f'WHERE CaseNumber = \'{case_number}\'')['records'][0]
+        records = self.__query(f'SELECT CommentBody, '
+                               f'CreatedById FROM CaseComment '
+                               f'WHERE ParentId = \'{case["Id"]}\' '
+                               f'AND IsPublished = True '
+                               f'ORDER BY LastModifiedDate')
+        return case, records['records']
+
+    def __get_case_and_comments(self, case_number):
+        """
+        Retrieves a case and its published comments, preferring the single
+        relationship query and falling back to separate queries if the org
+        rejects it.
+
+        Args:
+            case_number: The case number to retrieve.
+
+        Returns:
+            Tuple[dict, list]: The case record and its comment records.
+        """
+        if self.use_relationship_query:
+            try:
+                return self.__query_case_with_comments(case_number)
+            except simple_salesforce.SalesforceMalformedRequest:
+                self.use_relationship_query = False
+        return self.__query_case_and_comments(case_number)
+
+    def __get_case_and_dialogs(self, case_number):
+        """
+        Retrieves a case and its published comments as dialogs.
+
+        Args:
+            case_number: The case number to retrieve.
+
         Returns:
-            str: A formatted summary of symptoms, processes, and solutions.
+            Tuple[dict, Dialogs]: The case record and its dialogs.
+        """
+        with metrics.request_scope():
+            case, comments = self.__get_case_and_comments(case_number)
+            return case, self.__translate_into_dialogs(comments)
+
+    def __get_metadata(self, case):
         """
-        fn_args = [
-            (self.__get_symptom, (desc)),
-            (self.__get_process, (dialogs)),
-            (self.__get_solution, (dialogs))
-            ]
-        return '\n'.join(run_fn_in_parallel(fn_args, 3))
+        Returns the content metadata of a case.
+
+        Args:
+            case: The case record.
+
+        Returns:
+            dict: The case number, status, severity level and bug URL.
+        """
+        return {
+                'case_number': case['CaseNumber'],
+                'status': case['Status'],
+                'sev_lv': case['Sev_Lvl__c'],
+                'bug_url': case['Public_Bug_URL__c']
+                }
 
     def __get_content(self, case_number):
         """
@@ -367,26 +1112,32 @@ class SalesforceSource(BaseContext, Datasource):
             Content: An instance of Content containing case details and
                      summary.
         """
-        case = self.sf.query_all(
-                'SELECT Id, Status, Public_Bug_URL__c, Sev_Lvl__c, ' +
-                'CaseNumber, Description FROM Case ' +
-                f'WHERE CaseNumber = \'{case_number}\'')['records'][0]
-        records = self.sf.query_all(f'SELECT CommentBody, '
-                                    f'CreatedById FROM CaseComment '
-                                    f'WHERE ParentId = \'{case["Id"]}\' '
-                                    f'AND IsPublished = True '
-                                    f'ORDER BY LastModifiedDate')
-        dialogs = self.__translate_into_dialogs(records['records'])
+        case, dialogs = self.__get_case_and_dialogs(case_number)
         return Content(
-                {
-                    'case_number': case['CaseNumber'],
-                    'status': case['Status'],
-                    'sev_lv': case['Sev_Lvl__c'],
-                    'bug_url': case['Public_Bug_URL__c']
-                },
+                self.__get_metadata(case),
                 self.__get_summary(case['Description'], dialogs)
                 )
 
+    async def __aget_content(self, case_number):
+        """
+        Retrieves detailed content like __get_content. The blocking
+        Salesforce queries run in a worker thread and the summary is
+        generated by awaiting the language model.
+
+        Args:
+            case_number: The case number for which to retrieve content.
+
+        Returns:
+            Content: An instance of Content containing case details and
+                     summary.
+        """
+        case, dialogs = await asyncio.to_thread(self.__get_case_and_dialogs,
+                                                case_number)
+        return Content(
+                self.__get_metadata(case),
+                self.__aget_summary(case['Description'], dialogs)
+                )
+
     def get_content(self, metadata):
         """
         Retrieves content for a case based on the provided metadata.
@@ -400,6 +1151,36 @@ class SalesforceSource(BaseContext, Datasource):
         """
         return self.__get_content(metadata['case_number'])
 
+    async def aget_content(self, metadata):
+        """
+        Retrieves content for a case like get_content, without blocking the
+        event loop.
+
+        Args:
+            metadata: A dictionary containing case metadata.
+
+        Returns:
+            Content: An instance of Content containing case details and
+                     summary.
+        """
+        return await self.__aget_content(metadata['case_number'])
+
+    def __check_summarize_data(self, action, data):
+        """
+        Checks the data of the case summary action.
+
+        Args:
+            action: The action to perform.
+            data: The data required for the action.
+
+        Raises:
+            ValueError: If the case number is missing from the data.
+        """
+        if const.CASE_NUMBER not in data:
+            raise ValueError(
+                    f'The {const.CASE_NUMBER} is missing from the '
+                    f'data for the {action} action')
+
     def custom_api(self, action, data):
         """
         Handles custom API actions based on specified action type.
@@ -417,28 +1198,81 @@ class SalesforceSource(BaseContext, Datasource):
         """
         match action:
             case const.SUMMARIZE_CASE:
-                if const.CASE_NUMBER not in data:
-                    raise ValueError(
-                            f'The {const.CASE_NUMBER} is missing from the '
-                            f'data for the {action} action')
+                self.__check_summarize_data(action, data)
                 return self.__get_content(data[const.CASE_NUMBER])
             case _:
                 raise ValueError(f'The {action} action is not implemented.')
 
-    def generate_output(self, content):
+    async def acustom_api(self, action, data):
         """
-        Generates a formatted output string for the provided case content.
+        Handles custom API actions like custom_api, without blocking the
+        event loop.
 
         Args:
-            content: An instance of Content containing case metadata and
-                     summary.
+            action: The action to perform, such as summarizing a case.
+            data: The data required for the action.
 
         Returns:
-            str: A formatted string representing the case details, including
-                 case number, status, severity level, bug URL, and summary.
+            Content: The content returned from the specified action.
+
+        Raises:
+            ValueError: If the action is not implemented or if required data
+                        is missing.
+        """
+        match action:
+            case const.SUMMARIZE_CASE:
+                self.__check_summarize_data(action, data)
+                return await self.__aget_content(data[const.CASE_NUMBER])
+            case _:
+                raise ValueError(f'The {action} action is not implemented.')
+
+    def __get_header(self, content):
+        """
+        Formats the case details preceding the summary.
+
+        Args:
+            content: An instance of Content containing case metadata.
+
+        Returns:
+            str: The case number, status, severity level and bug URL.
         """
         return f'Case:\t\t{content.metadata["case_number"]}\n' \
                f'Status:\t\t{content.metadata["status"]}\n' \
                f'Severity Level:\t{content.metadata["sev_lv"]}\n' \
                f'Bug URL:\t{content.metadata["bug_url"]}\n' \
-               f'Summary:\n{content.summary}\n'
+               f'Summary:\n'
+
+    def generate_output(self, content):
+        """
+        Generates a formatted output for the provided case content, streaming
+        the summary as it is generated.
+
+        Args:
+            content: An instance of Content containing case metadata and
+                     summary.
+
+        Yields:
+            str: The next chunk of the case details, including case number,
+                 status, severity level, bug URL, and summary.
+        """
+        yield self.__get_header(content)
+        yield from content.iter_summary()
+        yield '\n'
+
+    async def agenerate_output(self, content):
+        """
+        Generates a formatted output like generate_output, from a summary
+        streamed asynchronously.
+
+        Args:
+            content: An instance of Content containing case metadata and
+                     summary.
+
+        Yields:
+            str: The next chunk of the case details, including case number,
+                 status, severity level, bug URL, and summary.
+        """
+        yield self.__get_header(content)
+        async for chunk in content.aiter_summary():
+            yield chunk
+        yield '\n'
@@ -2,6 +2,7 @@
 This module provides a memory management class that stores and retrieves
 conversation history in a MongoDB database.
 """
+import asyncio
 from operator import itemgetter
 from threading import Lock
 
@@ -67,26 +68,23 @@ class Memory:
                                                     return_messages=True)
             return self.session_memories[session]
 
-    def integrate(self, session, query, context):
+    def __get_chain(self, memory):
         """
-        Integrates a query with the current session memory, generating
-        a response based on past interactions and provided context.
+        Builds the chain answering a query based on the session history and
+        the provided context.
 
         Args:
-            session: Session ID for memory storage.
-            query: The user query to be integrated with context.
-            context: Additional contextual information for the query.
+            memory: The session memory.
 
         Returns:
-            str: The generated response based on query and context.
+            Runnable: The chain taking the context and the query.
         """
-        memory = self.__get_session_memory(session)
         prompt = ChatPromptTemplate.from_messages([
             ('system', 'You are a helpful chatbot'),
             MessagesPlaceholder(variable_name='history'),
             ('human', 'Based on the context: {context}, {query}'),
             ])
-        chain = (
+        return (
                 RunnablePassthrough.assign(
                     history=RunnableLambda(memory.load_memory_variables) |
                     itemgetter('history')
@@ -95,10 +93,92 @@ class Memory:
                 | self.llm
                 | StrOutputParser()
                 )
+
+    def integrate(self, session, query, context):
+        """
+        Integrates a query with the current session memory, generating
+        a response based on past interactions and provided context.
+
+        Args:
+            session: Session ID for memory storage.
+            query: The user query to be integrated with context.
+            context: Additional contextual information for the query.
+
+        Returns:
+            str: The generated response based on query and context.
+        """
+        memory = self.__get_session_memory(session)
+        chain = self.__get_chain(memory)
         integrated_context = chain.invoke({'context': context, 'query': query})
         memory.save_context({'input': query}, {'output': integrated_context})
         return integrated_context
 
+    def stream_integrate(self, session, query, context):
+        """
+        Integrates a query with the current session memory like integrate,
+        streaming the response as it is generated. The response is saved in
+        the session memory once it is complete.
+
+        Args:
+            session: Session ID for memory storage.
+            query: The user query to be integrated with context.
+            context: Additional contextual information for the query.
+
+        Yields:
+            str: The next chunk of the generated response.
+        """
+        memory = self.__get_session_memory(session)
+        chain = self.__get_chain(memory)
+        chunks = []
+        for chunk in chain.stream({'context': context, 'query': query}):
+            chunks.append(chunk)
+            yield chunk
+        memory.save_context({'input': query}, {'output': ''.join(chunks)})
+
+    async def aintegrate(self, session, query, context):
+        """
+        Integrates a query like integrate, awaiting the language model. The
+        session memory is loaded and saved in a worker thread.
+
+        Args:
+            session: Session ID for memory storage.
+            query: The user query to be integrated with context.
+            context: Additional contextual information for the query.
+
+        Returns:
+            str: The generated response based on query and context.
+        """
+        memory = await asyncio.to_thread(self.__get_session_memory, session)
+        chain = self.__get_chain(memory)
+        integrated_context = await chain.ainvoke({'context': context,
+                                                  'query': query})
+        await asyncio.to_thread(memory.save_context, {'input': query},
+                                {'output': integrated_context})
+        return integrated_context
+
+    async def astream_integrate(self, session, query, context):
+        """
+        Integrates a query like stream_integrate, awaiting the language
+        model.
+
+        Args:
+            session: Session ID for memory storage.
+            query: The user query to be integrated with context.
+            context: Additional contextual information for the query.
+
+        Yields:
+            str: The next chunk of the generated response.
+        """
+        memory = await asyncio.to_thread(self.__get_session_memory, session)
+        chain = self.__get_chain(memory)
+        chunks = []
+        async for chunk in chain.astream({'context': context,
+                                          'query': query}):
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(memory.save_context, {'input': query},
+                                {'output': ''.join(chunks)})
+
     def clear(self, session):
         """
         Clears the conversation memory for a given session.
@@ -0,0 +1,207 @@
+"""
+This module provides an Embeddings wrapper caching the vectors of an
+embeddings backend in memory and in a content-addressed store on disk, so
+that identical texts are embedded only once.
+"""
+
+import hashlib
+import os
+import sqlite3
+from array import array
+from threading import Lock
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from support_ai.lib import const
+from support_ai.lib.utils import metrics
+from support_ai.lib.utils.lru import TTLCache
+
+EMBEDDINGS_CACHE_DB = const.META_DIR + 'embeddings_cache.db'
+DEFAULT_MAXSIZE = 4096
+DEFAULT_TTL = 24*60*60
+QUERY_BATCH_SIZE = 500
+KIND_DOCUMENT = 'document'
+KIND_QUERY = 'query'
+
+
+class EmbeddingsStore:
+    """
+    A persistent store of vectors keyed by content hash, stored in SQLite.
+    """
+
+    def __init__(self, path=EMBEDDINGS_CACHE_DB):
+        """
+        Initializes the EmbeddingsStore, creating the database if needed.
+
+        Args:
+            path: The SQLite database path.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.mutex = Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'key TEXT PRIMARY KEY, '
+                'vector BLOB NOT NULL)')
+
+    def get_many(self, keys):
+        """
+        Retrieves the stored vectors of several keys.
+
+        Args:
+            keys: The content hashes.
+
+        Returns:
+            dict: The vectors of the stored keys.
+        """
+        vectors = {}
+        for i in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[i:i + QUERY_BATCH_SIZE]
+            with self.mutex:
+                rows = self.conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN '
+                    f'({", ".join("?" * len(batch))})', batch).fetchall()
+            for key, blob in rows:
+                vectors[key] = array('d', blob).tolist()
+        return vectors
+
+    def put_many(self, vectors):
+        """
+        Stores vectors.
+
+        Args:
+            vectors: A dictionary of vectors keyed by content hash.
+        """
+        rows = [(key, array('d', vector).tobytes())
+                for key, vector in vectors.items()]
+        with self.mutex, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) '
+                'VALUES (?, ?)', rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    An Embeddings wrapper looking vectors up in an in-memory LRU cache, then
+    in a store on disk shared by every embeddings backend, before embedding
+    the missing texts with the wrapped backend. Vectors are keyed by a hash
+    of the model name, the kind of embedding and the text, and the cache
+    statistics are reported in the metrics.
+    """
+
+    def __init__(self, embeddings, name, config):
+        """
+        Initializes the CachedEmbeddings.
+
+        Args:
+            embeddings: The wrapped Embeddings backend.
+            name: The model name, isolating the vectors of the backend.
+            config: The embeddings cache configuration.
+        """
+        self.embeddings = embeddings
+        self.name = name
+        self.memory = TTLCache(
+                maxsize=config.get(const.CONFIG_MAXSIZE, DEFAULT_MAXSIZE),
+                seconds=config.get(const.CONFIG_TTL, DEFAULT_TTL))
+        self.store = EmbeddingsStore(config.get(const.CONFIG_PATH,
+                                                EMBEDDINGS_CACHE_DB))
+        self.mutex = Lock()
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        metrics.register(f'embeddings_cache.{name}', self.stats)
+
+    def __get_key(self, kind, text):
+        """
+        Computes the content hash of a text.
+
+        Args:
+            kind: Whether the text is embedded as a document or a query.
+            text: The text.
+
+        Returns:
+            str: The hex SHA-256 digest of the model name, kind and text.
+        """
+        digest = hashlib.sha256()
+        for field in (self.name, kind, text):
+            digest.update(field.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def __embed(self, kind, texts, embed_fn):
+        """
+        Embeds texts, looking every distinct text up in the caches first.
+
+        Args:
+            kind: Whether the texts are embedded as documents or queries.
+            texts: The texts to embed.
+            embed_fn: A function embedding a list of texts with the backend.
+
+        Returns:
+            List[List[float]]: The vectors of the texts.
+        """
+        keys = [self.__get_key(kind, text) for text in texts]
+        vectors = {}
+        for key in dict.fromkeys(keys):
+            vector = self.memory.get(key)
+            if vector is not None:
+                vectors[key] = vector
+        memory_hits = len(vectors)
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        stored = self.store.get_many(missing) if missing else {}
+        vectors.update(stored)
+        texts_by_key = dict(zip(keys, texts))
+        missing = [key for key in missing if key not in stored]
+        if missing:
+            embedded = dict(zip(missing, embed_fn(
+                [texts_by_key[key] for key in missing])))
+            self.store.put_many(embedded)
+            vectors.update(embedded)
+        for key in stored.keys() | set(missing):
+            self.memory.put(key, vectors[key])
+        with self.mutex:
+            self.counts['memory_hits'] += memory_hits
+            self.counts['disk_hits'] += len(stored)
+            self.counts['misses'] += len(missing)
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds documents, using the cached vectors when available.
+
+        Args:
+            texts: The documents to embed.
+
+        Returns:
+            List[List[float]]: The vectors of the documents.
+        """
+        return self.__embed(KIND_DOCUMENT, texts,
+                            self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query, using the cached vector when available.
+
+        Args:
+            text: The query to embed.
+
+        Returns:
+            List[float]: The vector of the query.
+        """
+        return self.__embed(KIND_QUERY, [text], lambda texts: [
+            self.embeddings.embed_query(texts[0])])[0]
+
+    def stats(self):
+        """
+        Returns the cache statistics.
+
+        Returns:
+            dict: The number of memory hits, disk hits and misses, and the
+                  rate of lookups served from either cache.
+        """
+        with self.mutex:
+            counts = dict(self.counts)
+        lookups = sum(counts.values())
+        return {**counts,
+                'hit_rate': (counts['memory_hits'] + counts['disk_hits']) /
+                lookups if lookups else 0.0}
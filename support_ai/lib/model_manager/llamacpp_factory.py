@@ -7,6 +7,7 @@ from langchain_community.llms import LlamaCpp
 from langchain_community.embeddings import LlamaCppEmbeddings
 from support_ai.lib import const
 from support_ai.lib.model_manager.model_factory import ModelFactory
+from support_ai.lib.utils.token_budget import DEFAULT_CONTEXT_SIZE
 
 
 class LlamaCppFactory(ModelFactory):
@@ -19,7 +20,8 @@ class LlamaCppFactory(ModelFactory):
         Initializes the LlamaCppFactory with model configuration.
 
         Args:
-            llm_config: Configuration dictionary containing the model path.
+            llm_config: Configuration dictionary containing the model path
+                        and optionally the context size.
 
         Raises:
             ValueError: If the model path is not specified in llm_config.
@@ -28,22 +30,26 @@ class LlamaCppFactory(ModelFactory):
         self.model = llm_config[const.CONFIG_MODEL]
         if not self.model:
             raise ValueError(f'Missing {const.CONFIG_MODEL} in llm config')
+        self.context_size = llm_config.get(const.CONFIG_CONTEXT_SIZE,
+                                           DEFAULT_CONTEXT_SIZE)
 
     def create_llm(self):
         """
         Creates an instance of the LlamaCpp language model.
 
         Returns:
-            LlamaCpp: A LlamaCpp model instance with a specified context size.
+            LlamaCpp: A LlamaCpp model instance with the configured context
+                      size.
         """
-        return LlamaCpp(model_path=self.model, n_ctx=4096)
+        return LlamaCpp(model_path=self.model, n_ctx=self.context_size)
 
     def create_embeddings(self):
         """
         Creates an instance of LlamaCpp embeddings.
 
         Returns:
-            LlamaCppEmbeddings: A LlamaCpp embeddings instance with a
-                                specified context size.
+            LlamaCppEmbeddings: A LlamaCpp embeddings instance with the
+                                configured context size.
         """
-        return LlamaCppEmbeddings(model_path=self.model, n_ctx=4096)
+        return LlamaCppEmbeddings(model_path=self.model,
+                                  n_ctx=self.context_size)
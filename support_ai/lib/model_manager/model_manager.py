@@ -2,21 +2,33 @@
 This module defines functionality for managing language models and
 embeddings configurations.
 """
+import asyncio
 from dataclasses import dataclass
+from threading import BoundedSemaphore
 
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models.llms import BaseLLM
 from support_ai.lib import const
+from support_ai.lib.model_manager.cached_embeddings import CachedEmbeddings
 from support_ai.lib.model_manager.huggingface_factory import HuggingFaceFactory
 from support_ai.lib.model_manager.llamacpp_factory import LlamaCppFactory
 from support_ai.lib.model_manager.ollama_factory import OllamaFactory
 from support_ai.lib.model_manager.openai_factory import OpenAIFactory
 from support_ai.lib.model_manager.remote_factory import RemoteFactory
+from support_ai.lib.utils.token_budget import (
+  DEFAULT_CONTEXT_SIZE,
+  DEFAULT_OUTPUT_TOKENS,
+  TokenBudget,
+)
 
 
 LLM_CONFIG = 'llm_config'
 LLM_INST = 'llm_inst'
 EMBEDDINGS_INST = 'embeddings_inst'
+LIMITER = 'limiter'
+ALIMITER = 'alimiter'
+BUDGET = 'budget'
+DEFAULT_CONCURRENCY = 4
 
 
 def get_model(llm_config):
@@ -53,11 +65,18 @@ def get_model(llm_config):
 class Model:
     """
     A data class representing a language model (llm) and its associated
-    embeddings.
+    embeddings, along with the maximum number of concurrent calls the llm
+    backend should receive and the limiters enforcing it, shared by every
+    user of the llm on the threaded and async call paths respectively, and
+    the token budget sizing the documents given to the llm.
     """
 
     llm: BaseLLM
     embeddings: Embeddings
+    concurrency: int = DEFAULT_CONCURRENCY
+    limiter: BoundedSemaphore = None
+    alimiter: asyncio.Semaphore = None
+    budget: TokenBudget = None
 
 
 class ModelManager:
@@ -100,6 +119,9 @@ class ModelManager:
                         LLM_CONFIG: llm,
                         LLM_INST: None,
                         EMBEDDINGS_INST: None,
+                        LIMITER: None,
+                        ALIMITER: None,
+                        BUDGET: None,
                         }
             cls.__instance = self
         return cls.__instance
@@ -130,9 +152,26 @@ class ModelManager:
             llm_name = config[const.CONFIG_LLM]
             if self.__models[llm_name][LLM_INST] is None:
                 llm_config = self.__models[llm_name][LLM_CONFIG]
+                concurrency = llm_config.get(const.CONFIG_CONCURRENCY,
+                                             DEFAULT_CONCURRENCY)
                 self.__models[llm_name][LLM_INST] = \
                     get_model(llm_config).create_llm()
+                self.__models[llm_name][LIMITER] = \
+                    BoundedSemaphore(concurrency)
+                self.__models[llm_name][ALIMITER] = \
+                    asyncio.Semaphore(concurrency)
+                self.__models[llm_name][BUDGET] = TokenBudget(
+                    self.__models[llm_name][LLM_INST],
+                    llm_config.get(const.CONFIG_CONTEXT_SIZE,
+                                   DEFAULT_CONTEXT_SIZE),
+                    llm_config.get(const.CONFIG_OUTPUT_TOKENS,
+                                   DEFAULT_OUTPUT_TOKENS))
             model.llm = self.__models[llm_name][LLM_INST]
+            model.concurrency = self.__models[llm_name][LLM_CONFIG].get(
+                    const.CONFIG_CONCURRENCY, DEFAULT_CONCURRENCY)
+            model.limiter = self.__models[llm_name][LIMITER]
+            model.alimiter = self.__models[llm_name][ALIMITER]
+            model.budget = self.__models[llm_name][BUDGET]
 
         if const.CONFIG_EMBEDDINGS in config:
             if config[const.CONFIG_EMBEDDINGS] not in self.__models:
@@ -142,7 +181,16 @@ class ModelManager:
             embeddings_name = config[const.CONFIG_EMBEDDINGS]
             if self.__models[embeddings_name][EMBEDDINGS_INST] is None:
                 embeddings_config = self.__models[embeddings_name][LLM_CONFIG]
-                self.__models[embeddings_name][EMBEDDINGS_INST] = \
-                    get_model(embeddings_config).create_embeddings()
+                embeddings = get_model(embeddings_config).create_embeddings()
+                if const.CONFIG_EMBEDDINGS_CACHE in embeddings_config:
+                    model_name = embeddings_config.get(
+                        const.CONFIG_MODEL,
+                        embeddings_config.get(const.CONFIG_LLM_REMOTE_URL))
+                    embeddings = CachedEmbeddings(
+                        embeddings,
+                        f'{embeddings_config[const.CONFIG_TYPE]}:'
+                        f'{model_name}',
+                        embeddings_config[const.CONFIG_EMBEDDINGS_CACHE])
+                self.__models[embeddings_name][EMBEDDINGS_INST] = embeddings
             model.embeddings = self.__models[embeddings_name][EMBEDDINGS_INST]
         return model
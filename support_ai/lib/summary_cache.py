@@ -0,0 +1,311 @@
+"""
+This module provides persistent caches for generated summaries, with a
+local SQLite backend and a MongoDB backend that can be shared by several
+processes or pods.
+"""
+
+import asyncio
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+import pymongo
+from support_ai.lib import const
+
+SUMMARY_CACHE_DB = const.META_DIR + 'summary_cache.db'
+SUMMARY_CACHE_DATABASE = 'support_ai'
+SUMMARY_CACHE_COLLECTION = 'summary_cache'
+DEFAULT_TTL = 7*24*60*60
+DEFAULT_MAXSIZE = 10000
+
+
+class SummaryCache(ABC):
+    """
+    Abstract base class for summary caches. Entries expire individually
+    after the configured lifetime, and the least recently used entries are
+    evicted once the cache holds more than the configured number of entries.
+    """
+
+    def __init__(self, config, namespace):
+        """
+        Initializes the cache settings.
+
+        Args:
+            config: The summary cache configuration.
+            namespace: A prefix isolating the keys of one data source.
+        """
+        self.namespace = namespace
+        self.ttl = config.get(const.CONFIG_TTL, DEFAULT_TTL)
+        self.maxsize = config.get(const.CONFIG_MAXSIZE, DEFAULT_MAXSIZE)
+
+    def _get_key(self, key):
+        """
+        Returns the stored key for a data source key.
+
+        Args:
+            key: The key within the namespace.
+
+        Returns:
+            str: The namespaced key.
+        """
+        return f'{self.namespace}:{key}'
+
+    def _get_key_range(self):
+        """
+        Returns the range of the stored keys of the namespace.
+
+        Returns:
+            Tuple[str, str]: The exclusive lower and upper bounds of the
+                             namespaced keys.
+        """
+        # ';' directly follows ':' and bounds every key with the prefix.
+        return f'{self.namespace}:', f'{self.namespace};'
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Retrieves a summary.
+
+        Args:
+            key: The key derived from the summarized content.
+
+        Returns:
+            NotImplemented: Must be overridden by subclasses.
+        """
+        return NotImplemented
+
+    @abstractmethod
+    def put(self, key, summary):
+        """
+        Stores a summary.
+
+        Args:
+            key: The key derived from the summarized content.
+            summary: The summary to store.
+
+        Returns:
+            NotImplemented: Must be overridden by subclasses.
+        """
+        return NotImplemented
+
+
+class SqliteSummaryCache(SummaryCache):
+    """
+    A summary cache stored in a local SQLite database.
+    """
+
+    def __init__(self, config, namespace):
+        super().__init__(config, namespace)
+        path = config.get(const.CONFIG_PATH, SUMMARY_CACHE_DB)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.mutex = Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS summaries ('
+                'key TEXT PRIMARY KEY, '
+                'summary TEXT NOT NULL, '
+                'expires_at REAL NOT NULL, '
+                'accessed_at REAL NOT NULL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS summaries_accessed_at '
+                'ON summaries (accessed_at)')
+
+    def get(self, key):
+        """
+        Retrieves a summary that hasn't expired, marking it as recently used.
+
+        Args:
+            key: The key derived from the summarized content.
+
+        Returns:
+            str: The cached summary, or None.
+        """
+        now = time.time()
+        with self.mutex, self.conn:
+            row = self.conn.execute(
+                'SELECT summary FROM summaries '
+                'WHERE key = ? AND expires_at > ?',
+                (self._get_key(key), now)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'UPDATE summaries SET accessed_at = ? WHERE key = ?',
+                (now, self._get_key(key)))
+        return row[0]
+
+    def put(self, key, summary):
+        """
+        Stores a summary, removing expired entries and evicting the least
+        recently used entries of the namespace beyond the size limit.
+
+        Args:
+            key: The key derived from the summarized content.
+            summary: The summary to store.
+        """
+        now = time.time()
+        with self.mutex, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO summaries '
+                '(key, summary, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (self._get_key(key), summary, now + self.ttl, now))
+            self.conn.execute(
+                'DELETE FROM summaries WHERE expires_at <= ?', (now,))
+            self.conn.execute(
+                'DELETE FROM summaries WHERE key IN ('
+                'SELECT key FROM summaries WHERE key > ? AND key < ? '
+                'ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (*self._get_key_range(), self.maxsize))
+
+
+class MongoSummaryCache(SummaryCache):
+    """
+    A summary cache stored in MongoDB, shared by every process using the
+    same database.
+    """
+
+    def __init__(self, config, namespace):
+        super().__init__(config, namespace)
+        if const.CONFIG_DB_CONNECTION not in config:
+            raise ValueError(
+                f'The summary cache config doesn\'t contain '
+                f'{const.CONFIG_DB_CONNECTION}')
+        client = pymongo.MongoClient(config[const.CONFIG_DB_CONNECTION])
+        self.collection = \
+            client[SUMMARY_CACHE_DATABASE][SUMMARY_CACHE_COLLECTION]
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+        self.collection.create_index([('namespace', pymongo.ASCENDING),
+                                      ('accessed_at', pymongo.ASCENDING)])
+
+    def get(self, key):
+        """
+        Retrieves a summary that hasn't expired, marking it as recently used.
+
+        Args:
+            key: The key derived from the summarized content.
+
+        Returns:
+            str: The cached summary, or None.
+        """
+        now = datetime.now(timezone.utc)
+        entry = self.collection.find_one_and_update(
+                {'_id': self._get_key(key), 'expires_at': {'$gt': now}},
+                {'$set': {'accessed_at': now}})
+        return None if entry is None else entry['summary']
+
+    def put(self, key, summary):
+        """
+        Stores a summary, evicting the least recently used entries of the
+        namespace beyond the size limit. Expired entries are removed by
+        MongoDB's TTL monitor.
+
+        Args:
+            key: The key derived from the summarized content.
+            summary: The summary to store.
+        """
+        now = datetime.now(timezone.utc)
+        self.collection.replace_one(
+                {'_id': self._get_key(key)},
+                {'namespace': self.namespace,
+                 'summary': summary,
+                 'expires_at': now + timedelta(seconds=self.ttl),
+                 'accessed_at': now},
+                upsert=True)
+        scope = {'namespace': self.namespace}
+        excess = self.collection.count_documents(scope) - self.maxsize
+        if excess > 0:
+            oldest = self.collection.find(scope, {'_id': True}) \
+                .sort('accessed_at', pymongo.ASCENDING).limit(excess)
+            self.collection.delete_many(
+                    {'_id': {'$in': [entry['_id'] for entry in oldest]}})
+
+
+_cache_mapping: dict = {
+    const.CONFIG_SQLITE: SqliteSummaryCache,
+    const.CONFIG_MONGODB: MongoSummaryCache,
+}
+
+
+def get_summary_cache(config, namespace):
+    """
+    Instantiates the summary cache configured for a data source.
+
+    Args:
+        config: The data source configuration, which may contain a summary
+                cache section.
+        namespace: A prefix isolating the keys of the data source.
+
+    Returns:
+        SummaryCache: The summary cache, or None if none is configured.
+
+    Raises:
+        ValueError: If the summary cache type is missing or unknown.
+    """
+    if const.CONFIG_SUMMARY_CACHE not in config:
+        return None
+    cache_config = config[const.CONFIG_SUMMARY_CACHE]
+    if const.CONFIG_TYPE not in cache_config:
+        raise ValueError(f'The summary cache config doesn\'t contain '
+                         f'{const.CONFIG_TYPE}')
+    cache_type = cache_config[const.CONFIG_TYPE]
+    if cache_type not in _cache_mapping:
+        raise ValueError(f'Unknown summary cache type: {cache_type}')
+    return _cache_mapping[cache_type](cache_config, namespace)
+
+
+def stream_with_cache(summary_cache, key, stream_fn):
+    """
+    Streams a summary from the cache, or generates it while storing the
+    complete summary in the cache.
+
+    Args:
+        summary_cache: The SummaryCache to use, or None.
+        key: The key derived from the summarized content.
+        stream_fn: A function without arguments returning an iterator of
+                   summary chunks.
+
+    Yields:
+        str: The next chunk of the summary.
+    """
+    if summary_cache is not None:
+        summary = summary_cache.get(key)
+        if summary is not None:
+            yield summary
+            return
+    chunks = []
+    for chunk in stream_fn():
+        chunks.append(chunk)
+        yield chunk
+    if summary_cache is not None:
+        summary_cache.put(key, ''.join(chunks))
+
+
+async def astream_with_cache(summary_cache, key, stream_fn):
+    """
+    Streams a summary like stream_with_cache, from an async iterator of
+    summary chunks. The cache is accessed from a worker thread.
+
+    Args:
+        summary_cache: The SummaryCache to use, or None.
+        key: The key derived from the summarized content.
+        stream_fn: A function without arguments returning an async iterator
+                   of summary chunks.
+
+    Yields:
+        str: The next chunk of the summary.
+    """
+    if summary_cache is not None:
+        summary = await asyncio.to_thread(summary_cache.get, key)
+        if summary is not None:
+            yield summary
+            return
+    chunks = []
+    async for chunk in stream_fn():
+        chunks.append(chunk)
+        yield chunk
+    if summary_cache is not None:
+        await asyncio.to_thread(summary_cache.put, key, ''.join(chunks))
@@ -0,0 +1,37 @@
+"""
+This module provides utilities for grouping items into bounded batches.
+"""
+
+from typing import Any, Callable, Iterable, Iterator, List
+
+
+def batched(items: Iterable[Any], max_count: int, max_bytes: int,
+            size_fn: Callable[[Any], int]) -> Iterator[List[Any]]:
+    """
+    Groups items into batches bounded by item count and total size.
+
+    A single item larger than max_bytes is still emitted, alone in its own
+    batch.
+
+    Args:
+        items: The items to group.
+        max_count: The maximum number of items in a batch.
+        max_bytes: The maximum total size of the items in a batch.
+        size_fn: A function returning the size of an item in bytes.
+
+    Yields:
+        List[Any]: The next batch of items, in input order.
+    """
+    batch = []
+    batch_bytes = 0
+    for item in items:
+        item_bytes = size_fn(item)
+        if batch and (len(batch) >= max_count or
+                      batch_bytes + item_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        yield batch
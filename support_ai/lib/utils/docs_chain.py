@@ -1,12 +1,23 @@
 """
 This module provides functions for refining and processing documents
-using a language model.
+using a language model, with async counterparts of the refine functions.
+
+Documents can be summarized with one of two strategies: refine, which
+folds the documents into a summary one after the other, and tree reduce,
+which summarizes the documents concurrently and merges the summaries
+pairwise. Both take the same initial and refine prompts, and hold the
+limiter of the language model, if given, during its calls.
 """
 
+from dataclasses import dataclass
 from functools import partial
 from operator import itemgetter
+from typing import Callable
 
-from langchain_core.callbacks.manager import trace_as_chain_group
+from langchain_core.callbacks.manager import (
+    atrace_as_chain_group,
+    trace_as_chain_group,
+)
 from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import format_document, PromptTemplate
@@ -15,26 +26,36 @@ from langchain.chains.combine_documents import (
     collapse_docs,
     split_list_of_docs,
 )
+from support_ai.lib.utils.parallel_executor import (
+  arun_fn_unordered,
+  is_held,
+  limit,
+  run_fn_unordered,
+)
+from support_ai.lib.utils.token_budget import TokenBudget
 
 
+STRATEGY_REFINE = 'refine'
+STRATEGY_TREE_REDUCE = 'tree_reduce'
+DEFAULT_TREE_REDUCE_PARALLELISM = 4
+COLLAPSE_PROMPT = 'Collapse this content:\n\n{context}'
+
 document_prompt = PromptTemplate.from_template("{page_content}")
 partial_format_doc = partial(format_document, prompt=document_prompt)
 
 
-def docs_refine(llm, docs, initial_prompt, refine_prompt):
+def get_refine_chains(llm, initial_prompt, refine_prompt):
     """
-    Refines documents by applying an initial prompt followed by a
-    refine prompt.
+    Builds the chains used to refine documents.
 
     Args:
         llm: The language model used for processing.
-        docs: A list of documents to refine.
         initial_prompt: The initial prompt template for processing the first
                         document.
         refine_prompt: The prompt template for refining subsequent documents.
 
     Returns:
-        str: The refined context after processing all documents.
+        Tuple: The initial chain and the refine chain.
     """
     _initial_prompt = PromptTemplate.from_template(initial_prompt)
     initial_chain = (
@@ -53,8 +74,31 @@ def docs_refine(llm, docs, initial_prompt, refine_prompt):
             | llm
             | StrOutputParser()
             )
+    return initial_chain, refine_chain
+
+
+def docs_refine(llm, docs, initial_prompt, refine_prompt, limiter=None):
+    """
+    Refines documents by applying an initial prompt followed by a
+    refine prompt.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to refine.
+        initial_prompt: The initial prompt template for processing the first
+                        document.
+        refine_prompt: The prompt template for refining subsequent documents.
+        limiter: An optional semaphore held while the documents are refined,
+                 such as the limiter of the language model.
+
+    Returns:
+        str: The refined context after processing all documents.
+    """
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
 
-    with trace_as_chain_group('refine loop', inputs={'input': docs}) as \
+    with limit(limiter), \
+            trace_as_chain_group('refine loop', inputs={'input': docs}) as \
             manager:
         context = initial_chain.invoke(docs[0], config={'callbacks': manager})
         for doc in docs[1:]:
@@ -66,7 +110,481 @@ def docs_refine(llm, docs, initial_prompt, refine_prompt):
     return context
 
 
-def docs_map_reduce(llm, docs, map_prompt, reduce_prompt):
+def docs_refine_stream(llm, docs, initial_prompt, refine_prompt,
+                       limiter=None):
+    """
+    Refines documents like docs_refine, streaming the tokens of the last
+    step as the language model produces them.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to refine.
+        initial_prompt: The initial prompt template for processing the first
+                        document.
+        refine_prompt: The prompt template for refining subsequent documents.
+        limiter: An optional semaphore held while the documents are refined,
+                 such as the limiter of the language model.
+
+    Yields:
+        str: The next chunk of the refined context after processing all
+             documents.
+    """
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    with limit(limiter), \
+            trace_as_chain_group('refine loop', inputs={'input': docs}) as \
+            manager:
+        if len(docs) == 1:
+            yield from initial_chain.stream(docs[0],
+                                            config={'callbacks': manager})
+            return
+        context = initial_chain.invoke(docs[0], config={'callbacks': manager})
+        for doc in docs[1:-1]:
+            context = refine_chain.invoke(
+                    {"prev_context": context, "doc": doc},
+                    config={"callbacks": manager}
+                    )
+            manager.on_chain_end({"output": context})
+        output = ''
+        for chunk in refine_chain.stream(
+                {"prev_context": context, "doc": docs[-1]},
+                config={"callbacks": manager}
+                ):
+            output += chunk
+            yield chunk
+        manager.on_chain_end({"output": output})
+
+
+async def adocs_refine(llm, docs, initial_prompt, refine_prompt,
+                       limiter=None):
+    """
+    Refines documents like docs_refine, awaiting the language model instead
+    of blocking on it.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to refine.
+        initial_prompt: The initial prompt template for processing the first
+                        document.
+        refine_prompt: The prompt template for refining subsequent documents.
+        limiter: An optional semaphore held while the documents are refined,
+                 such as the limiter of the language model.
+
+    Returns:
+        str: The refined context after processing all documents.
+    """
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    async with limit(limiter), \
+            atrace_as_chain_group('refine loop',
+                                  inputs={'input': docs}) as manager:
+        context = await initial_chain.ainvoke(docs[0],
+                                              config={'callbacks': manager})
+        for doc in docs[1:]:
+            context = await refine_chain.ainvoke(
+                    {"prev_context": context, "doc": doc},
+                    config={"callbacks": manager}
+                    )
+            await manager.on_chain_end({"output": context})
+    return context
+
+
+async def adocs_refine_stream(llm, docs, initial_prompt, refine_prompt,
+                              limiter=None):
+    """
+    Refines documents like docs_refine_stream, awaiting the language model
+    instead of blocking on it.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to refine.
+        initial_prompt: The initial prompt template for processing the first
+                        document.
+        refine_prompt: The prompt template for refining subsequent documents.
+        limiter: An optional semaphore held while the documents are refined,
+                 such as the limiter of the language model.
+
+    Yields:
+        str: The next chunk of the refined context after processing all
+             documents.
+    """
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    async with limit(limiter), \
+            atrace_as_chain_group('refine loop',
+                                  inputs={'input': docs}) as manager:
+        if len(docs) == 1:
+            async for chunk in initial_chain.astream(
+                    docs[0], config={'callbacks': manager}):
+                yield chunk
+            return
+        context = await initial_chain.ainvoke(docs[0],
+                                              config={'callbacks': manager})
+        for doc in docs[1:-1]:
+            context = await refine_chain.ainvoke(
+                    {"prev_context": context, "doc": doc},
+                    config={"callbacks": manager}
+                    )
+            await manager.on_chain_end({"output": context})
+        output = ''
+        async for chunk in refine_chain.astream(
+                {"prev_context": context, "doc": docs[-1]},
+                config={"callbacks": manager}
+                ):
+            output += chunk
+            yield chunk
+        await manager.on_chain_end({"output": output})
+
+
+def get_merge_inputs(contexts):
+    """
+    Pairs up summaries to be merged by the refine chain.
+
+    Args:
+        contexts: The summaries of one level of the tree.
+
+    Returns:
+        List[dict]: The refine chain inputs merging each pair of summaries.
+    """
+    return [{'prev_context': contexts[i],
+             'doc': Document(page_content=contexts[i + 1])}
+            for i in range(0, len(contexts) - 1, 2)]
+
+
+def map_calls(fn, inputs, parallelism, limiter):
+    """
+    Calls a function over inputs concurrently on the shared llm pool, each
+    call holding the limiter. If the current task already holds the
+    limiter, the calls run one after the other within it instead, so that
+    nested calls neither exceed the limiter nor wait for it.
+
+    Args:
+        fn: The function calling the language model.
+        inputs: The inputs of the calls.
+        parallelism: The maximum number of concurrent calls.
+        limiter: The limiter of the language model, or None.
+
+    Returns:
+        List[Any]: The results of the calls, in the order of the inputs.
+    """
+    if is_held(limiter):
+        return [fn(param) for param in inputs]
+    results = [None] * len(inputs)
+    for index, result in run_fn_unordered(fn, inputs, parallelism,
+                                          limiter=limiter):
+        results[index] = result
+    return results
+
+
+async def amap_calls(fn, inputs, parallelism, limiter):
+    """
+    Awaits a coroutine function over inputs concurrently like map_calls.
+
+    Args:
+        fn: The coroutine function calling the language model.
+        inputs: The inputs of the calls.
+        parallelism: The maximum number of concurrent calls.
+        limiter: The async limiter of the language model, or None.
+
+    Returns:
+        List[Any]: The results of the calls, in the order of the inputs.
+    """
+    if is_held(limiter):
+        return [await fn(param) for param in inputs]
+    results = [None] * len(inputs)
+    async for index, result in arun_fn_unordered(fn, inputs, parallelism,
+                                                 limiter=limiter):
+        results[index] = result
+    return results
+
+
+def merge_level(refine_chain, contexts, config, parallelism, limiter):
+    """
+    Merges summaries pairwise, concurrently.
+
+    Args:
+        refine_chain: The refine chain merging two summaries.
+        contexts: The summaries of one level of the tree.
+        config: The runnable config.
+        parallelism: The maximum number of concurrent calls.
+        limiter: The limiter of the language model, or None.
+
+    Returns:
+        List[str]: The summaries of the next level of the tree.
+    """
+    merged = map_calls(partial(refine_chain.invoke, config=config),
+                       get_merge_inputs(contexts), parallelism, limiter)
+    if len(contexts) % 2:
+        merged.append(contexts[-1])
+    return merged
+
+
+async def amerge_level(refine_chain, contexts, config, parallelism, limiter):
+    """
+    Merges summaries pairwise like merge_level, awaiting the language model.
+
+    Args:
+        refine_chain: The refine chain merging two summaries.
+        contexts: The summaries of one level of the tree.
+        config: The runnable config.
+        parallelism: The maximum number of concurrent calls.
+        limiter: The async limiter of the language model, or None.
+
+    Returns:
+        List[str]: The summaries of the next level of the tree.
+    """
+    merged = await amap_calls(partial(refine_chain.ainvoke, config=config),
+                              get_merge_inputs(contexts), parallelism,
+                              limiter)
+    if len(contexts) % 2:
+        merged.append(contexts[-1])
+    return merged
+
+
+def docs_tree_reduce(llm, docs, initial_prompt, refine_prompt,
+                     parallelism=DEFAULT_TREE_REDUCE_PARALLELISM,
+                     limiter=None):
+    """
+    Summarizes documents concurrently with the initial prompt, then merges
+    the summaries pairwise with the refine prompt until one remains. N
+    documents cost about log2(N) sequential rounds of calls instead of N.
+    Within a task already holding the limiter, where the calls could only
+    run one after the other, the documents are refined instead, as that
+    takes N calls rather than 2N - 1.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to summarize.
+        initial_prompt: The initial prompt template for processing each
+                        document.
+        refine_prompt: The prompt template for merging two summaries.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional semaphore held during each call, such as the
+                 limiter of the language model.
+
+    Returns:
+        str: The merged summary of all documents.
+    """
+    if is_held(limiter):
+        return docs_refine(llm, docs, initial_prompt, refine_prompt,
+                           limiter=limiter)
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    with trace_as_chain_group('tree reduce', inputs={'input': docs}) as \
+            manager:
+        config = {'callbacks': manager}
+        contexts = map_calls(partial(initial_chain.invoke, config=config),
+                             docs, parallelism, limiter)
+        while len(contexts) > 1:
+            contexts = merge_level(refine_chain, contexts, config,
+                                   parallelism, limiter)
+        manager.on_chain_end({'output': contexts[0]})
+    return contexts[0]
+
+
+def docs_tree_reduce_stream(llm, docs, initial_prompt, refine_prompt,
+                            parallelism=DEFAULT_TREE_REDUCE_PARALLELISM,
+                            limiter=None):
+    """
+    Summarizes documents like docs_tree_reduce, streaming the tokens of the
+    last merge as the language model produces them.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to summarize.
+        initial_prompt: The initial prompt template for processing each
+                        document.
+        refine_prompt: The prompt template for merging two summaries.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional semaphore held during each call, such as the
+                 limiter of the language model.
+
+    Yields:
+        str: The next chunk of the merged summary of all documents.
+    """
+    if is_held(limiter):
+        yield from docs_refine_stream(llm, docs, initial_prompt,
+                                      refine_prompt, limiter=limiter)
+        return
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    with trace_as_chain_group('tree reduce', inputs={'input': docs}) as \
+            manager:
+        config = {'callbacks': manager}
+        if len(docs) == 1:
+            with limit(limiter):
+                yield from initial_chain.stream(docs[0], config=config)
+            return
+        contexts = map_calls(partial(initial_chain.invoke, config=config),
+                             docs, parallelism, limiter)
+        while len(contexts) > 2:
+            contexts = merge_level(refine_chain, contexts, config,
+                                   parallelism, limiter)
+        output = ''
+        with limit(limiter):
+            for chunk in refine_chain.stream(get_merge_inputs(contexts)[0],
+                                             config=config):
+                output += chunk
+                yield chunk
+        manager.on_chain_end({'output': output})
+
+
+async def adocs_tree_reduce(llm, docs, initial_prompt, refine_prompt,
+                            parallelism=DEFAULT_TREE_REDUCE_PARALLELISM,
+                            limiter=None):
+    """
+    Summarizes documents like docs_tree_reduce, awaiting the language model.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to summarize.
+        initial_prompt: The initial prompt template for processing each
+                        document.
+        refine_prompt: The prompt template for merging two summaries.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional asyncio semaphore held during each call, such
+                 as the async limiter of the language model.
+
+    Returns:
+        str: The merged summary of all documents.
+    """
+    if is_held(limiter):
+        return await adocs_refine(llm, docs, initial_prompt, refine_prompt,
+                                  limiter=limiter)
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    async with atrace_as_chain_group('tree reduce',
+                                     inputs={'input': docs}) as manager:
+        config = {'callbacks': manager}
+        contexts = await amap_calls(partial(initial_chain.ainvoke,
+                                            config=config),
+                                    docs, parallelism, limiter)
+        while len(contexts) > 1:
+            contexts = await amerge_level(refine_chain, contexts, config,
+                                          parallelism, limiter)
+        await manager.on_chain_end({'output': contexts[0]})
+    return contexts[0]
+
+
+async def adocs_tree_reduce_stream(llm, docs, initial_prompt, refine_prompt,
+                                   parallelism=DEFAULT_TREE_REDUCE_PARALLELISM,
+                                   limiter=None):
+    """
+    Summarizes documents like docs_tree_reduce_stream, awaiting the language
+    model.
+
+    Args:
+        llm: The language model used for processing.
+        docs: A list of documents to summarize.
+        initial_prompt: The initial prompt template for processing each
+                        document.
+        refine_prompt: The prompt template for merging two summaries.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional asyncio semaphore held during each call, such
+                 as the async limiter of the language model.
+
+    Yields:
+        str: The next chunk of the merged summary of all documents.
+    """
+    if is_held(limiter):
+        async for chunk in adocs_refine_stream(llm, docs, initial_prompt,
+                                               refine_prompt,
+                                               limiter=limiter):
+            yield chunk
+        return
+    initial_chain, refine_chain = get_refine_chains(llm, initial_prompt,
+                                                    refine_prompt)
+
+    async with atrace_as_chain_group('tree reduce',
+                                     inputs={'input': docs}) as manager:
+        config = {'callbacks': manager}
+        if len(docs) == 1:
+            async with limit(limiter):
+                async for chunk in initial_chain.astream(docs[0],
+                                                         config=config):
+                    yield chunk
+            return
+        contexts = await amap_calls(partial(initial_chain.ainvoke,
+                                            config=config),
+                                    docs, parallelism, limiter)
+        while len(contexts) > 2:
+            contexts = await amerge_level(refine_chain, contexts, config,
+                                          parallelism, limiter)
+        output = ''
+        async with limit(limiter):
+            async for chunk in refine_chain.astream(
+                    get_merge_inputs(contexts)[0], config=config):
+                output += chunk
+                yield chunk
+        await manager.on_chain_end({'output': output})
+
+
+@dataclass
+class Strategy:
+    """
+    The functions implementing a summarization strategy, all taking the
+    language model, the documents, the initial prompt and the refine prompt,
+    and the limiter of the language model as a keyword argument. Concurrent
+    strategies take the maximum number of concurrent calls as well.
+    """
+
+    summarize: Callable
+    summarize_stream: Callable
+    asummarize: Callable
+    asummarize_stream: Callable
+    concurrent: bool = False
+
+
+_strategy_mapping: dict = {
+    STRATEGY_REFINE: Strategy(docs_refine, docs_refine_stream,
+                              adocs_refine, adocs_refine_stream),
+    STRATEGY_TREE_REDUCE: Strategy(docs_tree_reduce, docs_tree_reduce_stream,
+                                   adocs_tree_reduce,
+                                   adocs_tree_reduce_stream, concurrent=True),
+}
+
+
+def get_strategy(name, parallelism=DEFAULT_TREE_REDUCE_PARALLELISM,
+                 limiter=None, alimiter=None):
+    """
+    Retrieves a summarization strategy by name, bound to the concurrency
+    settings of a language model.
+
+    Args:
+        name: The strategy name, either refine or tree_reduce.
+        parallelism: The maximum number of concurrent calls of one summary
+                     of a concurrent strategy.
+        limiter: An optional semaphore held during the calls of the threaded
+                 functions, such as the limiter of the language model.
+        alimiter: An optional asyncio semaphore held during the calls of the
+                  async functions, such as the async limiter of the language
+                  model.
+
+    Returns:
+        Strategy: The functions implementing the strategy.
+
+    Raises:
+        ValueError: If the strategy is unknown.
+    """
+    if name not in _strategy_mapping:
+        raise ValueError(f'Unknown summary strategy: {name}')
+    strategy = _strategy_mapping[name]
+    options = {'parallelism': parallelism} if strategy.concurrent else {}
+    return Strategy(
+            partial(strategy.summarize, limiter=limiter, **options),
+            partial(strategy.summarize_stream, limiter=limiter, **options),
+            partial(strategy.asummarize, limiter=alimiter, **options),
+            partial(strategy.asummarize_stream, limiter=alimiter, **options),
+            strategy.concurrent)
+
+
+def docs_map_reduce(llm, docs, map_prompt, reduce_prompt, token_max=None):
     """
     Applies a map-reduce strategy to process and summarize a list of documents.
 
@@ -75,6 +593,9 @@ def docs_map_reduce(llm, docs, map_prompt, reduce_prompt):
         docs: A list of documents to process.
         map_prompt: The prompt template for mapping individual documents.
         reduce_prompt: The prompt template for reducing the results.
+        token_max: The maximum number of tokens of the mapped results
+                   reduced together, or None to fill the context window of
+                   the default size.
 
     Returns:
         str: The final result after mapping and reducing the documents.
@@ -95,8 +616,7 @@ def docs_map_reduce(llm, docs, map_prompt, reduce_prompt):
     def format_docs(docs):
         return "\n\n".join(partial_format_doc(doc) for doc in docs)
 
-    _collapse_prompt = PromptTemplate.from_template('Collapse this '
-                                                    'content:\n\n{context}')
+    _collapse_prompt = PromptTemplate.from_template(COLLAPSE_PROMPT)
     collapse_chain = (
             {"context": format_docs}
             | _collapse_prompt
@@ -104,10 +624,15 @@ def docs_map_reduce(llm, docs, map_prompt, reduce_prompt):
             | StrOutputParser()
             )
 
+    budget = TokenBudget(llm)
+
     def get_num_tokens(docs):
-        return llm.get_num_tokens(format_docs(docs))
+        return budget.count(format_docs(docs))
+
+    if token_max is None:
+        token_max = budget.get_chunk_size(COLLAPSE_PROMPT, reduce_prompt)
 
-    def collapse(docs, config, token_max=3072):
+    def collapse(docs, config):
         while get_num_tokens(docs) > token_max:
             invoke = partial(collapse_chain.invoke, config=config)
             split_docs = split_list_of_docs(docs, get_num_tokens, token_max)
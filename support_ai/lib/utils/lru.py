@@ -1,16 +1,243 @@
 """
-This module provides a decorator for caching function results with a time-based
-expiration using Python's built-in LRU cache.
+This module provides a thread-safe LRU mapping with per-entry expiration, a
+helper coalescing concurrent calls for the same key, and a decorator caching
+function results on top of both.
 """
 
-from functools import lru_cache, wraps
-from datetime import datetime, timedelta
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+from threading import Lock
+import time
+import weakref
+
+from support_ai.lib.utils import metrics
+
+_MISSING = object()
+_KWD_MARK = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, size-bounded LRU mapping whose entries expire
+    individually after a fixed lifetime.
+    """
+
+    def __init__(self, maxsize=128, seconds=60*60, name=None):
+        """
+        Initializes the TTLCache.
+
+        Args:
+            maxsize: The maximum number of entries kept.
+            seconds: The lifetime of an entry in seconds.
+            name: An optional name under which the cache statistics are
+                  reported in the metrics.
+        """
+        self.maxsize = maxsize
+        self.lifetime = seconds
+        self.mutex = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        if name is not None:
+            metrics.register(name, self.stats)
+
+    def get(self, key, default=None):
+        """
+        Retrieves an entry, marking it as recently used.
+
+        Args:
+            key: The key of the entry.
+            default: The value returned if the entry is missing or expired.
+
+        Returns:
+            Any: The cached value, or default.
+        """
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expiration = entry
+            if time.monotonic() >= expiration:
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores an entry, evicting the least recently used entries if the
+        cache is full.
+
+        Args:
+            key: The key of the entry.
+            value: The value to cache.
+        """
+        with self.mutex:
+            self.entries[key] = (value, time.monotonic() + self.lifetime)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        with self.mutex:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the cache statistics.
+
+        Returns:
+            dict: The number of hits, misses, evictions, expirations and
+                  current entries.
+        """
+        with self.mutex:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self.entries),
+            }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key, so that only the first
+    caller runs the function while the others wait for its result.
+    """
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.calls = {}
+        self.tasks = set()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Runs a function unless a call for the same key is already in flight,
+        in which case its outcome is shared.
+
+        Args:
+            key: The key identifying the call.
+            fn: The function to run, without arguments.
+
+        Returns:
+            Any: The result of the function.
+
+        Raises:
+            Exception: Whatever the function raised.
+        """
+        with self.mutex:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.mutex:
+                del self.calls[key]
+        future.set_result(result)
+        return result
+
+    async def ado(self, key, fn):
+        """
+        Awaits a coroutine function unless a call for the same key is
+        already in flight, in which case its outcome is shared. Sync and
+        async calls for the same key are coalesced together. The function
+        runs as a task of its own, so that cancelling the first caller
+        doesn't cancel it for the others.
+
+        Args:
+            key: The key identifying the call.
+            fn: The coroutine function to await, without arguments.
+
+        Returns:
+            Any: The result of the function.
+
+        Raises:
+            Exception: Whatever the function raised.
+        """
+        with self.mutex:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.coalesced += 1
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        async def run():
+            try:
+                result = await fn()
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self.mutex:
+                    del self.calls[key]
+                    self.tasks.discard(task)
+            future.set_result(result)
+            return result
+        task = asyncio.ensure_future(run())
+        with self.mutex:
+            # The event loop only keeps weak references to tasks.
+            self.tasks.add(task)
+        return await asyncio.shield(task)
+
+
+def make_key(args, kwargs):
+    """
+    Builds a cache key from call arguments. The first positional argument,
+    typically the bound instance of a method, is referenced weakly when
+    possible so that cache entries don't keep it alive.
+
+    Args:
+        args: The positional arguments.
+        kwargs: The keyword arguments.
+
+    Returns:
+        tuple: The cache key.
+    """
+    key = list(args)
+    if key:
+        try:
+            key[0] = weakref.ref(key[0])
+        except TypeError:
+            pass
+    if kwargs:
+        key.append(_KWD_MARK)
+        key.extend(sorted(kwargs.items()))
+    return tuple(key)
 
 
 def timed_lru_cache(seconds=60*60, maxsize=32):
     """
-    A decorator that applies an LRU cache to a function with a
-    time-based expiration.
+    A decorator that caches function results in an LRU cache whose entries
+    expire individually. Concurrent calls missing the cache for the same
+    arguments are coalesced into a single call.
     """
 
     def wrapper_cache(func):
@@ -24,14 +251,17 @@ def timed_lru_cache(seconds=60*60, maxsize=32):
             function: The wrapped function with caching and expiration
                       behavior.
         """
-        func = lru_cache(maxsize=maxsize)(func)
-        func.lifetime = timedelta(seconds=seconds)
-        func.expiration = datetime.utcnow() + func.lifetime
+        cache = TTLCache(maxsize=maxsize, seconds=seconds)
+        flight = SingleFlight()
+
+        def stats():
+            return {**cache.stats(), 'coalesced': flight.coalesced}
+        metrics.register(f'{func.__module__}.{func.__qualname__}', stats)
 
         @wraps(func)
         def wrapped_func(*args, **kwargs):
             """
-            Executes the wrapped function, clearing the cache if expired.
+            Returns the cached result, or executes the wrapped function.
 
             Args:
                 *args: Positional arguments passed to the wrapped function.
@@ -40,10 +270,18 @@ def timed_lru_cache(seconds=60*60, maxsize=32):
             Returns:
                 Any: The result of the wrapped function.
             """
-            if datetime.utcnow() >= func.expiration:
-                func.cache_clear()
-                func.expiration = datetime.utcnow() + func.lifetime
-            return func(*args, **kwargs)
+            key = make_key(args, kwargs)
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            def load():
+                value = func(*args, **kwargs)
+                cache.put(key, value)
+                return value
+            return flight.do(key, load)
 
+        wrapped_func.cache_info = stats
+        wrapped_func.cache_clear = cache.clear
         return wrapped_func
     return wrapper_cache
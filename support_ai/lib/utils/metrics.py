@@ -0,0 +1,147 @@
+"""
+This module provides process-wide, thread-safe counters and observations
+that the API server can report.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import time
+
+_mutex = Lock()
+_counters = Counter()
+_observations = {}
+_gauges = {}
+_request_counters = ContextVar('request_counters', default=None)
+
+
+def incr(name, value=1):
+    """
+    Increments a counter, both process-wide and in the enclosing request
+    scope, if any.
+
+    Args:
+        name: The counter name.
+        value: The increment.
+    """
+    with _mutex:
+        _counters[name] += value
+    request_counters = _request_counters.get()
+    if request_counters is not None:
+        request_counters[name] += value
+
+
+def observe(name, value):
+    """
+    Records an observation of a measured value, such as a latency.
+
+    Args:
+        name: The observation name.
+        value: The observed value.
+    """
+    with _mutex:
+        if name not in _observations:
+            _observations[name] = {'count': 0, 'sum': 0, 'max': value}
+        observation = _observations[name]
+        observation['count'] += 1
+        observation['sum'] += value
+        observation['max'] = max(observation['max'], value)
+
+
+def register(name, fn):
+    """
+    Registers a function reporting values computed on demand, such as cache
+    statistics.
+
+    Args:
+        name: The gauge name.
+        fn: A function without arguments returning the reported value.
+    """
+    with _mutex:
+        _gauges[name] = fn
+
+
+@contextmanager
+def request_scope():
+    """
+    Tracks the counters incremented by the current thread within the scope,
+    recording each of them as a '<name>_per_request' observation on exit.
+
+    Yields:
+        Counter: The counters incremented within the scope.
+    """
+    request_counters = Counter()
+    token = _request_counters.set(request_counters)
+    try:
+        yield request_counters
+    finally:
+        _request_counters.reset(token)
+        for name, value in request_counters.items():
+            observe(f'{name}_per_request', value)
+
+
+def timed_stream(name, output, start):
+    """
+    Forwards the chunks of a streamed response, recording the time to the
+    first chunk and the total duration of the response.
+
+    Args:
+        name: The prefix of the recorded observations.
+        output: An iterable of response chunks.
+        start: The monotonic time at which the request was received.
+
+    Yields:
+        str: The next chunk of the response.
+    """
+    first_chunk = True
+    for chunk in output:
+        if first_chunk:
+            observe(f'{name}.ttfb_seconds', time.monotonic() - start)
+            first_chunk = False
+        yield chunk
+    observe(f'{name}.duration_seconds', time.monotonic() - start)
+
+
+async def atimed_stream(name, output, start):
+    """
+    Forwards the chunks of an async streamed response like timed_stream.
+
+    Args:
+        name: The prefix of the recorded observations.
+        output: An async iterable of response chunks.
+        start: The monotonic time at which the request was received.
+
+    Yields:
+        str: The next chunk of the response.
+    """
+    first_chunk = True
+    async for chunk in output:
+        if first_chunk:
+            observe(f'{name}.ttfb_seconds', time.monotonic() - start)
+            first_chunk = False
+        yield chunk
+    observe(f'{name}.duration_seconds', time.monotonic() - start)
+
+
+def snapshot():
+    """
+    Returns the current value of every counter and observation.
+
+    Returns:
+        dict: The counters, the count, sum, average and maximum of every
+              observation, and the value of every gauge.
+    """
+    with _mutex:
+        counters = dict(_counters)
+        observations = {
+            name: {**observation,
+                   'avg': observation['sum'] / observation['count']}
+            for name, observation in _observations.items()
+        }
+        gauges = dict(_gauges)
+    return {
+        'counters': counters,
+        'observations': observations,
+        'gauges': {name: fn() for name, fn in gauges.items()},
+    }
@@ -1,56 +1,512 @@
 """
-This module provides utilities for running functions in parallel using threads.
+This module provides utilities for running functions in parallel on shared,
+long-lived thread pools. It also has async counterparts that run coroutines
+concurrently on the event loop.
+
+Work is split between named pools: the tasks pool runs the work that fans
+out further, and the llm pool runs the leaf calls to the language models.
+Keeping them apart means a task waiting on llm calls never holds a thread
+the llm calls need. The size of the llm pool caps the llm calls in flight
+across every llm, while each llm's limiter caps the calls it receives.
 """
 
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from concurrent.futures import (
+  CancelledError,
+  FIRST_COMPLETED,
+  ThreadPoolExecutor,
+  wait,
+)
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
 import functools
-from typing import List, Any, Callable, Tuple
+from threading import Event, Lock
+from typing import (
+  Any,
+  AsyncIterator,
+  Callable,
+  Iterable,
+  Iterator,
+  List,
+  Tuple,
+)
+
+from support_ai.lib.utils import metrics
+
+POOL_TASKS = 'tasks'
+POOL_LLM = 'llm'
+DEFAULT_POOL_SIZES = {
+    POOL_TASKS: 16,
+    POOL_LLM: 8,
+}
+
+_mutex = Lock()
+_pool_sizes = dict(DEFAULT_POOL_SIZES)
+_pools = {}
+_cancel_scopes = ContextVar('cancel_scopes', default=())
+_held_limiter = ContextVar('held_limiter', default=None)
+
+
+class ExecutorPool:
+    """
+    A named, long-lived thread pool reporting its queue depth. Tasks run in
+    a copy of the submitter's context and are skipped if a cancel scope
+    they were submitted in has been cancelled by the time they start.
+
+    The pool also caps coroutines of the async call path with a semaphore of
+    the same size.
+    """
+
+    def __init__(self, name, max_workers):
+        """
+        Initializes the ExecutorPool.
+
+        Args:
+            name: The pool name, under which its statistics are reported.
+            max_workers: The number of threads of the pool.
+        """
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix=name)
+        self.semaphore = None
+        self.mutex = Lock()
+        self.queued = 0
+        self.active = 0
+        metrics.register(f'executor.{name}', self.stats)
+
+    def __start(self):
+        with self.mutex:
+            self.queued -= 1
+            self.active += 1
+
+    def __finish(self):
+        with self.mutex:
+            self.active -= 1
+
+    def __run(self, fn, args, limiter):
+        """
+        Runs a submitted task unless it was cancelled while queued.
+        """
+        self.__start()
+        try:
+            if any(scope.is_set() for scope in _cancel_scopes.get()):
+                raise CancelledError()
+            # Every task runs in a context of its own.
+            _held_limiter.set(limiter)
+            with limiter or nullcontext():
+                return fn(*args)
+        finally:
+            self.__finish()
+
+    def submit(self, fn, *args, limiter=None):
+        """
+        Submits a function call to the pool.
+
+        Args:
+            fn: The function to call.
+            *args: The arguments of the call.
+            limiter: An optional semaphore held during the call, such as the
+                     limiter of the llm the call uses.
+
+        Returns:
+            Future: The future of the call.
+        """
+        with self.mutex:
+            self.queued += 1
+        future = self.executor.submit(copy_context().run, self.__run, fn,
+                                      args, limiter)
+
+        def dequeue_cancelled(future):
+            if future.cancelled():
+                with self.mutex:
+                    self.queued -= 1
+        future.add_done_callback(dequeue_cancelled)
+        return future
+
+    @asynccontextmanager
+    async def acquire(self, limiter=None):
+        """
+        Holds a slot of the pool, and the limiter if any, for a coroutine.
+
+        Args:
+            limiter: An optional asyncio semaphore held as well, such as the
+                     async limiter of the llm the coroutine uses.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        with self.mutex:
+            self.queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            with self.mutex:
+                self.queued -= 1
+        try:
+            async with limiter or nullcontext():
+                token = _held_limiter.set(limiter)
+                with self.mutex:
+                    self.active += 1
+                try:
+                    yield
+                finally:
+                    self.__finish()
+                    _held_limiter.reset(token)
+        finally:
+            self.semaphore.release()
+
+    def stats(self):
+        """
+        Returns the pool statistics.
+
+        Returns:
+            dict: The number of threads, queued tasks and running tasks.
+        """
+        with self.mutex:
+            return {
+                'max_workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+            }
+
+
+def is_held(limiter):
+    """
+    Checks whether the current pool task holds a limiter, so that the
+    calls it makes itself already count against the limiter.
+
+    Args:
+        limiter: A limiter, or None.
+
+    Returns:
+        bool: True if the limiter is held by the current task.
+    """
+    return limiter is not None and _held_limiter.get() is limiter
+
+
+def limit(limiter):
+    """
+    Returns the context manager holding a limiter during a call, unless the
+    current task already holds it.
+
+    Args:
+        limiter: A threading or asyncio semaphore, or None.
+
+    Returns:
+        The limiter, or a null context if there's none to hold.
+    """
+    if limiter is None or is_held(limiter):
+        return nullcontext()
+    return limiter
+
+
+def configure_pools(pool_sizes):
+    """
+    Sets the number of threads of the shared pools. Pools are created on
+    first use, so the sizes of pools already in use don't change.
+
+    Args:
+        pool_sizes: A mapping from pool name to number of threads.
+    """
+    with _mutex:
+        _pool_sizes.update(pool_sizes)
+
+
+def get_pool(name):
+    """
+    Returns a shared pool, creating it on first use.
+
+    Args:
+        name: The pool name, such as POOL_TASKS or POOL_LLM.
+
+    Returns:
+        ExecutorPool: The shared pool.
+    """
+    with _mutex:
+        if name not in _pools:
+            _pools[name] = ExecutorPool(name, _pool_sizes[name])
+        return _pools[name]
+
+
+class CancelScope:
+    """
+    Groups the tasks submitted by a function and, recursively, by the tasks
+    it submits, so that the queued ones can be skipped once their result is
+    no longer needed.
+    """
+
+    def __init__(self):
+        self.event = Event()
+
+    def run(self, fn, *args):
+        """
+        Calls a function within the scope.
+
+        Args:
+            fn: The function to call.
+            *args: The arguments of the call.
+
+        Returns:
+            Any: The result of the function.
+        """
+        token = _cancel_scopes.set(_cancel_scopes.get() + (self.event,))
+        try:
+            return fn(*args)
+        finally:
+            _cancel_scopes.reset(token)
+
+    def cancel(self):
+        """
+        Cancels the tasks of the scope that haven't started yet.
+        """
+        self.event.set()
 
 
 def run_fn_in_parallel(fn_args: List[Tuple[Any]], parallelism: int):
     """
     Executes a list of function calls with their respective arguments
-    in parallel.
+    in parallel on the shared tasks pool.
 
     Args:
         fn_args: A list of tuples, each containing a function and its
                  arguments.
-        parallelism: The maximum number of threads to use for parallel
-                     execution.
+        parallelism: The maximum number of calls running at once.
 
     Returns:
         List[Any]: A list of results from the executed functions, in the order
                    of function calls.
     """
-    results = []
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        futures = [executor.submit(fn, args) for fn, args in fn_args]
-        for future in futures:
-            results.append(future.result())
+    results = [None] * len(fn_args)
+    for index, result in run_fn_unordered(lambda fn_arg: fn_arg[0](fn_arg[1]),
+                                          fn_args, parallelism,
+                                          pool=POOL_TASKS):
+        results[index] = result
     return results
 
 
+@contextmanager
+def run_fn_in_background(fn_args: List[Tuple[Any]]):
+    """
+    Starts a list of function calls with their respective arguments on the
+    shared tasks pool, letting the caller work while they run. When the
+    caller leaves, for instance because its client went away, the calls and
+    the work they submitted that haven't started yet are cancelled.
+
+    Args:
+        fn_args: A list of tuples, each containing a function and its
+                 arguments.
+
+    Yields:
+        List[Future]: The futures of the function calls, in the order of
+                      function calls.
+    """
+    scope = CancelScope()
+    pool = get_pool(POOL_TASKS)
+    futures = [pool.submit(scope.run, fn, args) for fn, args in fn_args]
+    try:
+        yield futures
+    finally:
+        scope.cancel()
+        for future in futures:
+            future.cancel()
+
+
+def run_fn_unordered(fn: Callable, args_iter: Iterable[Any],
+                     parallelism: int, limiter=None,
+                     pool=POOL_LLM) -> Iterator[Tuple[int, Any]]:
+    """
+    Executes a function over a stream of arguments in parallel on a shared
+    pool, yielding the results as soon as they complete.
+
+    At most `parallelism` calls are in flight at any time, so arguments are
+    only pulled from `args_iter` as calls complete. The calls that haven't
+    started are cancelled if the iteration is abandoned.
+
+    Args:
+        fn: The function to execute for each argument.
+        args_iter: An iterable of arguments, each passed to `fn` as is.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional semaphore held during each call, such as the
+                 limiter of the llm the function uses.
+        pool: The name of the shared pool running the calls.
+
+    Yields:
+        Tuple[int, Any]: The position of the argument in `args_iter` and the
+                         result of the call, in completion order.
+    """
+    executor = get_pool(pool)
+    pending = {}
+    try:
+        for index, args in enumerate(args_iter):
+            if len(pending) >= parallelism:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(fn, args, limiter=limiter)] = index
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def get_limiter(instance, asynchronous=False):
+    """
+    Returns the llm limiter of an instance with a model, if any.
+
+    Args:
+        instance: An instance which may have a model attribute.
+        asynchronous: Whether to return the async limiter.
+
+    Returns:
+        The limiter of the instance's llm, or None.
+    """
+    model = getattr(instance, 'model', None)
+    return getattr(model, 'alimiter' if asynchronous else 'limiter', None)
+
+
 def run_in_parallel(parallelism: int):
     """
     A decorator to enable parallel execution of a method within a class.
+    The calls run on the shared llm pool and hold the limiter of the
+    instance's llm, if it has a model.
 
     Args:
-        parallelism: The maximum number of threads to use for parallel
-                     execution.
+        parallelism: The maximum number of calls in flight for one list of
+                     arguments.
 
     Returns:
         Callable: A decorator that wraps a method to run it in parallel for a
-                  list of arguments.
+                  list of arguments. Keyword arguments are passed to every
+                  call.
     """
     def decorator(fn: Callable):
         @functools.wraps(fn)
-        def wrapper(self, args_list: List[Tuple[Any]]):
-            results = []
-            with ThreadPoolExecutor(max_workers=parallelism) as executor:
-                futures = [executor.submit(fn, self, args)
-                           for args in args_list]
-                for future in futures:
-                    results.append(future.result())
+        def wrapper(self, args_list: List[Tuple[Any]], **kwargs):
+            results = [None] * len(args_list)
+            for index, result in run_fn_unordered(
+                    functools.partial(fn, self, **kwargs), args_list,
+                    parallelism,
+                    limiter=get_limiter(self)):
+                results[index] = result
             return results
         return wrapper
     return decorator
+
+
+async def arun_fn_in_parallel(fn_args: List[Tuple[Any]], parallelism: int,
+                              limiter=None, pool=POOL_LLM):
+    """
+    Awaits a list of coroutine function calls with their respective
+    arguments concurrently, each holding a slot of a shared pool.
+
+    Args:
+        fn_args: A list of tuples, each containing a coroutine function and
+                 its arguments.
+        parallelism: The maximum number of calls awaited at once.
+        limiter: An optional asyncio semaphore held during each call, such
+                 as the async limiter of the llm the functions use.
+        pool: The name of the shared pool capping the calls.
+
+    Returns:
+        List[Any]: A list of results from the executed functions, in the order
+                   of function calls.
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+    executor = get_pool(pool)
+
+    async def run(fn, args):
+        async with semaphore, executor.acquire(limiter):
+            return await fn(args)
+    return await asyncio.gather(*(run(fn, args) for fn, args in fn_args))
+
+
+async def arun_fn_unordered(fn: Callable, args_iter: Iterable[Any],
+                            parallelism: int, limiter=None,
+                            pool=POOL_LLM) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Awaits a coroutine function over a stream of arguments concurrently,
+    yielding the results as soon as they complete, like run_fn_unordered.
+    The calls still in flight are cancelled if the iteration is abandoned.
+
+    Args:
+        fn: The coroutine function to await for each argument.
+        args_iter: An iterable of arguments, each passed to `fn` as is.
+        parallelism: The maximum number of concurrent calls.
+        limiter: An optional asyncio semaphore held during each call, such
+                 as the async limiter of the llm the function uses.
+        pool: The name of the shared pool capping the calls.
+
+    Yields:
+        Tuple[int, Any]: The position of the argument in `args_iter` and the
+                         result of the call, in completion order.
+    """
+    executor = get_pool(pool)
+
+    async def run(args):
+        async with executor.acquire(limiter):
+            return await fn(args)
+    pending = {}
+    try:
+        for index, args in enumerate(args_iter):
+            if len(pending) >= parallelism:
+                done, _ = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield pending.pop(task), task.result()
+            pending[asyncio.ensure_future(run(args))] = index
+        while pending:
+            done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield pending.pop(task), task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def iterate_in_thread(iterable: Iterable[Any]) -> AsyncIterator[Any]:
+    """
+    Iterates over a blocking iterable without blocking the event loop, by
+    pulling every item in a worker thread.
+
+    Args:
+        iterable: The blocking iterable.
+
+    Yields:
+        Any: The next item of the iterable.
+    """
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def arun_in_parallel(parallelism: int):
+    """
+    A decorator to enable concurrent execution of a coroutine method within a
+    class, like run_in_parallel. The calls hold slots of the shared llm pool
+    and the async limiter of the instance's llm, if it has a model.
+
+    Args:
+        parallelism: The maximum number of calls awaited at once for one list
+                     of arguments.
+
+    Returns:
+        Callable: A decorator that wraps a coroutine method to await it
+                  concurrently for a list of arguments. Keyword arguments
+                  are passed to every call.
+    """
+    def decorator(fn: Callable):
+        @functools.wraps(fn)
+        async def wrapper(self, args_list: List[Tuple[Any]], **kwargs):
+            return await arun_fn_in_parallel(
+                    [(functools.partial(fn, self, **kwargs), args)
+                     for args in args_list], parallelism,
+                    limiter=get_limiter(self, asynchronous=True))
+        return wrapper
+    return decorator
@@ -0,0 +1,237 @@
+"""
+This module provides a stream of chunks that can be consumed by several
+readers, live or after it has completed.
+"""
+
+import asyncio
+from concurrent.futures import CancelledError
+from threading import Condition
+
+
+class _Generation:  # pylint: disable=too-few-public-methods
+    """
+    The state of one run of a SharedStream's source.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.producing = False
+        self.readers = 0
+
+
+class SharedStream:
+    """
+    A replayable stream of chunks produced lazily by a source iterator.
+
+    Every reader iterates over all the chunks from the beginning. Chunks are
+    pulled from the source by whichever reader first needs them, while the
+    other readers wait, so a single source is shared by concurrent readers.
+    If the source fails, the readers in progress get the error and the next
+    reader restarts the stream with a fresh source. Once every reader has
+    gone away before the stream completed, for instance because the clients
+    disconnected, the source is closed and the next reader restarts the
+    stream as well.
+    """
+
+    def __init__(self, factory):
+        """
+        Initializes the SharedStream.
+
+        Args:
+            factory: A function without arguments returning a new source
+                     iterator of chunks.
+        """
+        self.factory = factory
+        self.cond = Condition()
+        self.generation = _Generation(factory)
+
+    def __iter__(self):
+        """
+        Iterates over every chunk of the stream.
+
+        Yields:
+            str: The next chunk.
+
+        Raises:
+            Exception: Whatever the source raised.
+        """
+        with self.cond:
+            if self.generation.error is not None:
+                self.generation = _Generation(self.factory)
+            generation = self.generation
+            generation.readers += 1
+        index = 0
+        try:
+            while True:
+                with self.cond:
+                    while index >= len(generation.chunks) and \
+                            generation.producing:
+                        self.cond.wait()
+                    if index < len(generation.chunks):
+                        chunk = generation.chunks[index]
+                    elif generation.error is not None:
+                        raise generation.error
+                    elif generation.done:
+                        return
+                    else:
+                        generation.producing = True
+                        chunk = None
+                if chunk is None:
+                    self.__produce(generation)
+                    continue
+                index += 1
+                yield chunk
+        finally:
+            with self.cond:
+                generation.readers -= 1
+                abandoned = self.__abandon(generation)
+            if abandoned:
+                generation.source.close()
+
+    def __abandon(self, generation):
+        """
+        Marks a generation without readers as cancelled if it is incomplete,
+        with the condition held.
+
+        Args:
+            generation: The generation to check.
+
+        Returns:
+            bool: True if the caller must close the source of the generation.
+        """
+        if generation.readers > 0 or generation.producing or \
+                generation.done or generation.error is not None:
+            return False
+        generation.error = CancelledError()
+        return generation.source is not None
+
+    def __produce(self, generation):
+        """
+        Pulls the next chunk from the source and appends it to the stream.
+
+        Args:
+            generation: The generation whose source is pulled.
+        """
+        chunk = None
+        done = False
+        error = None
+        try:
+            if generation.source is None:
+                generation.source = iter(generation.factory())
+            chunk = next(generation.source)
+        except StopIteration:
+            done = True
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            error = e
+        finally:
+            with self.cond:
+                if chunk is not None:
+                    generation.chunks.append(chunk)
+                generation.done = done
+                generation.error = error
+                generation.producing = False
+                self.cond.notify_all()
+                abandoned = self.__abandon(generation)
+            if abandoned:
+                generation.source.close()
+
+    def __str__(self):
+        """
+        Returns the whole content of the stream, consuming it if needed.
+        """
+        return ''.join(self)
+
+
+class _AsyncGeneration(_Generation):  # pylint: disable=too-few-public-methods
+    """
+    The state of one run of an AsyncSharedStream's source.
+    """
+
+    def __init__(self, factory):
+        super().__init__(factory)
+        self.cond = asyncio.Condition()
+        self.task = None
+
+
+class AsyncSharedStream:
+    """
+    An async counterpart of SharedStream, whose chunks are produced by a
+    source async iterator and consumed by readers on the same event loop.
+
+    The source is pulled by a task of its own, so a reader going away
+    doesn't interrupt the others. Once every reader has gone away before the
+    stream completed, for instance because the clients disconnected, the
+    source is cancelled and the next reader restarts the stream.
+    """
+
+    def __init__(self, factory):
+        """
+        Initializes the AsyncSharedStream.
+
+        Args:
+            factory: A function without arguments returning a new source
+                     async iterator of chunks.
+        """
+        self.factory = factory
+        self.generation = None
+
+    async def __aiter__(self):
+        """
+        Iterates over every chunk of the stream.
+
+        Yields:
+            str: The next chunk.
+
+        Raises:
+            Exception: Whatever the source raised.
+        """
+        if self.generation is None or self.generation.error is not None:
+            self.generation = _AsyncGeneration(self.factory)
+        generation = self.generation
+        if generation.task is None:
+            generation.task = asyncio.ensure_future(self.__produce(generation))
+        generation.readers += 1
+        index = 0
+        try:
+            while True:
+                async with generation.cond:
+                    await generation.cond.wait_for(
+                            lambda: index < len(generation.chunks) or
+                            generation.done or generation.error is not None)
+                if index < len(generation.chunks):
+                    index += 1
+                    yield generation.chunks[index - 1]
+                elif generation.error is not None:
+                    raise generation.error
+                else:
+                    return
+        finally:
+            generation.readers -= 1
+            if generation.readers == 0 and not generation.done and \
+                    generation.error is None:
+                generation.error = asyncio.CancelledError()
+                generation.task.cancel()
+
+    async def __produce(self, generation):
+        """
+        Pulls every chunk from the source and appends it to the stream.
+
+        Args:
+            generation: The generation whose source is pulled.
+        """
+        try:
+            async for chunk in generation.factory():
+                async with generation.cond:
+                    generation.chunks.append(chunk)
+                    generation.cond.notify_all()
+            generation.done = True
+        except asyncio.CancelledError:
+            return
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            generation.error = e
+        async with generation.cond:
+            generation.cond.notify_all()
@@ -0,0 +1,179 @@
+"""
+This module provides a planner sizing the documents given to a language
+model, in tokens of the model's own tokenizer, so that every prompt fills
+the context window without overflowing it.
+"""
+
+from itertools import chain
+from threading import Lock
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.prompts import PromptTemplate
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+DEFAULT_CONTEXT_SIZE = 4096
+DEFAULT_OUTPUT_TOKENS = 512
+DEFAULT_CHUNK_OVERLAP = 64
+CHARS_PER_TOKEN = 4
+DOC_SEPARATOR = '\n\n'
+
+
+def get_tokenizer(llm):
+    """
+    Finds the tokenizer of a language model. The default token counting of
+    langchain models uses the GPT-2 tokenizer, which doesn't match most
+    models and is downloaded on first use, so it isn't used.
+
+    Args:
+        llm: The language model.
+
+    Returns:
+        Callable: A function counting the tokens of a text, or None if the
+                  model has no tokenizer of its own.
+    """
+    pipeline = getattr(llm, 'pipeline', None)
+    tokenizer = getattr(pipeline, 'tokenizer', None)
+    if tokenizer is not None:
+        # Hugging Face pipelines
+        return lambda text: len(tokenizer.encode(text))
+    client = getattr(llm, 'client', None)
+    if callable(getattr(client, 'tokenize', None)):
+        # llama.cpp models
+        return lambda text: len(client.tokenize(text.encode('utf-8')))
+    model_type = type(llm)
+    if model_type.get_num_tokens is not BaseLanguageModel.get_num_tokens or \
+            model_type.get_token_ids is not BaseLanguageModel.get_token_ids:
+        # Models counting their tokens themselves, such as OpenAI's
+        return llm.get_num_tokens
+    return None
+
+
+class TokenBudget:
+    """
+    Plans the token budget of the prompts sent to a language model.
+
+    A prompt holds the prompt template, the document and, when refining, the
+    previous output, and leaves room for the output itself. The documents
+    are therefore sized to the context window minus the template and two
+    output reserves, which also bounds the prompts merging two outputs.
+
+    The context window is the configured context size rather than one read
+    from the model, so it must not exceed what the model supports. Tokens
+    are counted with the model's own tokenizer where one is available, and
+    estimated from the number of characters otherwise.
+    """
+
+    def __init__(self, llm, context_size=DEFAULT_CONTEXT_SIZE,
+                 output_tokens=DEFAULT_OUTPUT_TOKENS):
+        """
+        Initializes the TokenBudget.
+
+        Args:
+            llm: The language model whose tokenizer counts the tokens.
+            context_size: The context window of the model in tokens.
+            output_tokens: The tokens reserved for an output of the model.
+        """
+        self.llm = llm
+        self.tokenize = get_tokenizer(llm)
+        self.context_size = context_size
+        self.output_tokens = output_tokens
+        self.mutex = Lock()
+        self.chunk_sizes = {}
+
+    def count(self, text):
+        """
+        Counts the tokens of a text with the model's tokenizer, or estimates
+        them if the model has no tokenizer or it fails, for instance when it
+        can't be loaded offline.
+
+        Args:
+            text: The text to count.
+
+        Returns:
+            int: The number of tokens.
+        """
+        if self.tokenize is not None:
+            try:
+                return self.tokenize(text)
+            except Exception:  # pylint: disable=broad-exception-caught
+                pass
+        return -(-len(text) // CHARS_PER_TOKEN)
+
+    def __get_template_tokens(self, prompt):
+        """
+        Counts the tokens of a prompt template without its variables.
+
+        Args:
+            prompt: The prompt template.
+
+        Returns:
+            int: The number of tokens.
+        """
+        template = PromptTemplate.from_template(prompt)
+        return self.count(template.format(
+            **{name: '' for name in template.input_variables}))
+
+    def get_chunk_size(self, *prompts):
+        """
+        Computes the size of the documents formatted into the prompts.
+
+        Args:
+            *prompts: The prompt templates the documents are formatted into.
+
+        Returns:
+            int: The maximum number of tokens of a document.
+
+        Raises:
+            ValueError: If the context window can't hold a document.
+        """
+        with self.mutex:
+            chunk_size = self.chunk_sizes.get(prompts)
+        if chunk_size is not None:
+            return chunk_size
+        template_tokens = max(self.__get_template_tokens(prompt)
+                              for prompt in prompts)
+        chunk_size = self.context_size - template_tokens - \
+            2 * self.output_tokens
+        if chunk_size <= DEFAULT_CHUNK_OVERLAP:
+            raise ValueError(f'The context size {self.context_size} is too '
+                             f'small for the prompts')
+        with self.mutex:
+            self.chunk_sizes[prompts] = chunk_size
+        return chunk_size
+
+    def split(self, texts, *prompts):
+        """
+        Splits texts into documents filling the budget of the prompts. Texts
+        exceeding the budget are split, and consecutive texts fitting in the
+        budget together are packed into one document.
+
+        Args:
+            texts: The texts to split.
+            *prompts: The prompt templates the documents are formatted into.
+
+        Returns:
+            List[Document]: The documents.
+        """
+        chunk_size = self.get_chunk_size(*prompts)
+        splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size,
+                chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+                length_function=self.count,
+                )
+        separator_tokens = self.count(DOC_SEPARATOR)
+        docs = []
+        chunks = []
+        tokens = 0
+        for chunk in chain.from_iterable(map(splitter.split_text, texts)):
+            chunk_tokens = self.count(chunk)
+            if chunks and tokens + separator_tokens + chunk_tokens > \
+                    chunk_size:
+                docs.append(Document(page_content=DOC_SEPARATOR.join(chunks)))
+                chunks = []
+                tokens = 0
+            tokens += chunk_tokens + (separator_tokens if chunks else 0)
+            chunks.append(chunk)
+        if chunks:
+            docs.append(Document(page_content=DOC_SEPARATOR.join(chunks)))
+        return docs
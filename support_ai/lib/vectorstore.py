@@ -3,32 +3,116 @@ Vector Store for Embedding and Similarity Search
 """
 
 import os
+import time
+from threading import get_ident, Lock
 
+import chromadb
 from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
 from support_ai.lib import const
 
 VECTORDB_DIR = const.META_DIR + 'vectordb'
 COLLECTION_METADATA = 'collection_metadata'
 DEFAULT_COLLECTION_NAME = '__default'
+# The collection name langchain uses by default, which the existing stores
+# were written under.
+COLLECTION_NAME = 'langchain'
+REBUILD_SUFFIX = '-rebuild'
+REBUILD_BATCH_SIZE = 1000
+HNSW_KEYS = {
+    const.CONFIG_SPACE: 'hnsw:space',
+    const.CONFIG_M: 'hnsw:M',
+    const.CONFIG_CONSTRUCTION_EF: 'hnsw:construction_ef',
+    const.CONFIG_SEARCH_EF: 'hnsw:search_ef',
+}
+
+
+def get_collection_metadata(ds_config):
+    """
+    Builds the Chroma collection metadata configuring the HNSW index of a
+    data source.
+
+    Args:
+        ds_config: The data source configuration, which may contain a
+                   collection_metadata section with the distance space (l2,
+                   cosine or ip), M, construction_ef and search_ef.
+
+    Returns:
+        dict: The collection metadata, or None to use Chroma's defaults.
+
+    Raises:
+        ValueError: If the section contains an unknown setting.
+    """
+    index_config = ds_config.get(COLLECTION_METADATA)
+    if not index_config:
+        return None
+    for key in index_config:
+        if key not in HNSW_KEYS:
+            raise ValueError(f'Unknown {COLLECTION_METADATA} setting: {key}')
+    return {HNSW_KEYS[key]: value for key, value in index_config.items()}
 
 
 class VectorStore:
     """
     A class to manage vector storage and similarity search using Chroma.
 
+    Every write to the vector store of a data source records a new
+    generation stamp on disk, so that results derived from its content, in
+    this process or another, can be told apart from fresher ones.
+
+    Chroma clients and collection handles are kept in a process-wide registry
+    so that every VectorStore instance shares the same long-lived handle per
+    (ds_type, embedding) pair instead of reopening the persistent store on
+    each call. The HNSW index parameters of every data source's collection
+    are registered process-wide as well; they apply when the collection is
+    created, and an existing collection takes new ones when rebuilt.
+
     Attributes:
         VECTORDB_DIR (str): Directory for vector database persistence.
     """
 
-    def __init__(self):
+    __mutex = Lock()
+    __clients = {}
+    __vectorstores = {}
+    __collection_metadata = {}
+
+    def __init__(self, config=None):
         """
         Initializes the VectorStore, ensuring the storage directory exists.
+
+        Args:
+            config: An optional configuration whose data sources configure
+                    the HNSW index of their collection.
         """
         os.makedirs(VECTORDB_DIR, exist_ok=True)
+        if config is not None:
+            for ds_config in config.get(const.CONFIG_DATASOURCES, []):
+                metadata = get_collection_metadata(ds_config)
+                with self.__mutex:
+                    self.__collection_metadata[
+                        ds_config[const.CONFIG_TYPE]] = metadata
+
+    def __get_client(self, ds_type):
+        """
+        Retrieves or creates the persistent Chroma client for a data source
+        type. Must be called with the registry mutex held.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            chromadb.api.ClientAPI: The persistent client for the data source.
+        """
+        if ds_type not in self.__clients:
+            persist_dir = os.path.join(VECTORDB_DIR, ds_type)
+            self.__clients[ds_type] = \
+                chromadb.PersistentClient(path=persist_dir)
+        return self.__clients[ds_type]
 
     def __get_vectorstore(self, ds_type, embedding):
         """
-        Initializes a Chroma vector store for a specified data source type.
+        Retrieves the cached Chroma vector store for a specified data source
+        type, creating it on first use.
 
         Args:
             ds_type: Type identifier for the data source.
@@ -38,9 +122,64 @@ class VectorStore:
             Chroma: A Chroma vector store instance configured for the specified
                     data source.
         """
-        persist_dir = os.path.join(VECTORDB_DIR, ds_type)
-        return Chroma(embedding_function=embedding,
-                      persist_directory=persist_dir)
+        # The embedding instance is held by the registry entry, so its id
+        # stays unique for as long as the entry exists.
+        key = (ds_type, id(embedding))
+        with self.__mutex:
+            if key not in self.__vectorstores:
+                self.__vectorstores[key] = Chroma(
+                        collection_name=COLLECTION_NAME,
+                        client=self.__get_client(ds_type),
+                        embedding_function=embedding,
+                        persist_directory=os.path.join(VECTORDB_DIR, ds_type),
+                        collection_metadata=self.__collection_metadata.get(
+                            ds_type))
+            return self.__vectorstores[key]
+
+    @staticmethod
+    def __get_generation_path(ds_type):
+        """
+        Returns the path of the generation stamp of a data source type.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            str: The path of the file holding the generation stamp.
+        """
+        return os.path.join(VECTORDB_DIR, f'{ds_type}.generation')
+
+    def get_generation(self, ds_type):
+        """
+        Retrieves the generation stamp of the vector store of a data source.
+
+        Args:
+            ds_type: Type identifier for the data source.
+
+        Returns:
+            str: The stamp of the last write, or an empty string if the
+                 vector store was never written.
+        """
+        try:
+            with open(self.__get_generation_path(ds_type),
+                      encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def __bump_generation(self, ds_type):
+        """
+        Records a new generation stamp for the vector store of a data source,
+        replacing the previous one atomically.
+
+        Args:
+            ds_type: Type identifier for the data source.
+        """
+        path = self.__get_generation_path(ds_type)
+        tmp_path = f'{path}.{os.getpid()}.{get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(time.time_ns()))
+        os.replace(tmp_path, path)
 
     def update(self, ds_type, embedding, data):
         """
@@ -52,10 +191,48 @@ class VectorStore:
             data: Document data with attributes `document`, `metadata`,
                   and `id`.
         """
-        self.__get_vectorstore(ds_type, embedding) \
-            .add_texts([data.document], [data.metadata], [data.id])
+        self.bulk_update(ds_type, embedding, [data])
 
-    def similarity_search(self, ds_type, embedding, query):
+    def bulk_update(self, ds_type, embedding, data_list):
+        """
+        Adds a batch of documents to the vector store with a single
+        embedding call and a single write.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            embedding: Embedding function to convert text into vector format.
+            data_list: A list of document data with attributes `document`,
+                       `metadata`, and `id`.
+        """
+        if not data_list:
+            return
+        self.__get_vectorstore(ds_type, embedding).add_texts(
+                [data.document for data in data_list],
+                [data.metadata for data in data_list],
+                [data.id for data in data_list])
+        self.__bump_generation(ds_type)
+
+    def update_metadata(self, ds_type, data_list):
+        """
+        Replaces the metadata of stored documents without embedding them
+        again. Documents that were never stored are ignored.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            data_list: A list of document data with attributes `metadata`
+                       and `id`.
+        """
+        if not data_list:
+            return
+        with self.__mutex:
+            collection = self.__get_client(ds_type).get_or_create_collection(
+                    COLLECTION_NAME,
+                    metadata=self.__collection_metadata.get(ds_type))
+        collection.update(ids=[data.id for data in data_list],
+                          metadatas=[data.metadata for data in data_list])
+        self.__bump_generation(ds_type)
+
+    def similarity_search(self, ds_type, embedding, query, where=None):
         """
         Performs a similarity search on the vector store based on the query.
 
@@ -64,9 +241,139 @@ class VectorStore:
             embedding: Embedding function for text-to-vector
                                   conversion.
             query: The search query text.
+            where: An optional Chroma where filter on the document metadata,
+                   applied before the nearest neighbor search.
 
         Returns:
             list: List of search results ranked by similarity to the query.
         """
-        return self.__get_vectorstore(ds_type,
-                                      embedding).similarity_search(query)
+        return self.__get_vectorstore(ds_type, embedding).similarity_search(
+                query, filter=where)
+
+    def similarity_search_with_score(self, ds_type, embedding, query, k=4,
+                                     where=None):
+        """
+        Performs a similarity search on the vector store based on the query,
+        along with the relevance score of every result.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            embedding: Embedding function for text-to-vector conversion.
+            query: The search query text.
+            k: The number of results.
+            where: An optional Chroma where filter on the document metadata,
+                   applied before the nearest neighbor search.
+
+        Returns:
+            List[Tuple[Document, float]]: The search results, with their
+                                          record id, and their relevance
+                                          scores, ranked by relevance. The
+                                          scores are derived from the
+                                          distance space of the collection
+                                          without normalization, so they
+                                          fall outside [0, 1] for distant
+                                          results in the l2 and ip spaces.
+        """
+        vectorstore = self.__get_vectorstore(ds_type, embedding)
+        # Queries the collection directly, since langchain drops the record
+        # ids of the results, which identify them across searches.
+        # pylint: disable=protected-access
+        results = vectorstore._collection.query(
+                query_embeddings=[embedding.embed_query(query)], n_results=k,
+                where=where, include=['documents', 'metadatas', 'distances'])
+        relevance_score_fn = vectorstore._select_relevance_score_fn()
+        return [(Document(page_content=document, metadata=metadata or {},
+                          id=record_id), relevance_score_fn(distance))
+                for record_id, document, metadata, distance in zip(
+                    results['ids'][0], results['documents'][0],
+                    results['metadatas'][0], results['distances'][0])]
+
+    def iter_records(self, ds_type, batch_size=REBUILD_BATCH_SIZE,
+                     collection=None):
+        """
+        Iterates over the stored records of a data source with their
+        embeddings, without embedding anything.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            batch_size: The number of records read at once.
+            collection: The Chroma collection to read, or None for the
+                        collection of the data source.
+
+        Yields:
+            dict: The next batch, with the ids, embeddings, documents and
+                  metadatas of its records.
+        """
+        if collection is None:
+            with self.__mutex:
+                collection = self.__get_client(ds_type).get_collection(
+                        COLLECTION_NAME)
+        offset = 0
+        while True:
+            batch = collection.get(
+                    include=['embeddings', 'documents', 'metadatas'],
+                    limit=batch_size, offset=offset)
+            if not batch['ids']:
+                return
+            yield batch
+            offset += len(batch['ids'])
+
+    def rebuild(self, ds_type, batch_size=REBUILD_BATCH_SIZE):
+        """
+        Rebuilds the collection of a data source with the registered HNSW
+        index parameters, copying the stored embeddings into a fresh index,
+        which also drops the space held by deleted records. The collection
+        must not be used by another process meanwhile.
+
+        The records are copied into a new collection, which replaces the
+        old one once complete, so an interrupted rebuild leaves either
+        collection intact and is resumed by the next rebuild.
+
+        Args:
+            ds_type: Type identifier for the data source.
+            batch_size: The number of records copied at once.
+
+        Returns:
+            int: The number of records copied.
+        """
+        with self.__mutex:
+            for key in [key for key in self.__vectorstores
+                        if key[0] == ds_type]:
+                del self.__vectorstores[key]
+            client = self.__get_client(ds_type)
+            metadata = self.__collection_metadata.get(ds_type)
+        rebuild_name = COLLECTION_NAME + REBUILD_SUFFIX
+        names = {collection.name for collection in client.list_collections()}
+        if COLLECTION_NAME not in names:
+            if rebuild_name in names:
+                client.get_collection(rebuild_name).modify(
+                        name=COLLECTION_NAME)
+            return 0
+        if rebuild_name in names:
+            client.delete_collection(rebuild_name)
+        collection = client.get_collection(COLLECTION_NAME)
+        rebuilt = client.create_collection(rebuild_name, metadata=metadata)
+        count = 0
+        for batch in self.iter_records(ds_type, batch_size, collection):
+            rebuilt.add(ids=batch['ids'], embeddings=batch['embeddings'],
+                        documents=batch['documents'],
+                        metadatas=batch['metadatas'])
+            count += len(batch['ids'])
+        client.delete_collection(COLLECTION_NAME)
+        rebuilt.modify(name=COLLECTION_NAME)
+        self.__bump_generation(ds_type)
+        return count
+
+    def close(self):
+        """
+        Closes every cached Chroma client. Subsequent calls reopen the
+        persistent stores on demand.
+        """
+        with self.__mutex:
+            self.__vectorstores.clear()
+            for client in self.__clients.values():
+                # Releases the client's reference on its shared system, which
+                # is stopped, closing its database and unloading its indexes,
+                # once no other client of the same store uses it.
+                client.close()
+            self.__clients.clear()
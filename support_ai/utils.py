@@ -1,11 +1,19 @@
 """
-This module provides functionality to load configuration data from YAML files.
+This module provides functionality to load configuration data from YAML files,
+to parse request arguments and to stream responses.
 """
 
+import json
+import logging
 import pkgutil
 
 import yaml
 from support_ai.lib import const
+from support_ai.lib.utils import metrics
+
+STREAM_ERROR = '\n\nThe response was interrupted by an error.\n'
+_END = object()
+logger = logging.getLogger(__name__)
 
 
 def get_config(path):
@@ -36,3 +44,94 @@ def get_config(path):
         with open(path, encoding="utf-8") as stream:
             config = yaml.safe_load(stream)
     return config
+
+
+def get_filter(arg):
+    """
+    Parses the metadata filter argument of a query.
+
+    Args:
+        arg: A JSON object in the Chroma where filter syntax, such as
+             {"severity": "L1"} or {"created_at": {"$gte": 1704067200}}, or
+             None.
+
+    Returns:
+        dict: The filter, or None if no filter is given.
+
+    Raises:
+        ValueError: If the argument isn't a JSON object.
+    """
+    if arg is None:
+        return None
+    where = json.loads(arg)
+    if not isinstance(where, dict):
+        raise ValueError('The filter must be a JSON object')
+    return where
+
+
+def start_stream(name, output):
+    """
+    Starts streaming a response, pulling its first chunk right away so that
+    an error raised before any output can still be answered with an error
+    status. An error raised later ends the stream with an error notice, as
+    the status has already been sent by then, and is logged and counted in
+    the metrics.
+
+    Args:
+        name: The prefix of the error counter.
+        output: An iterable of response chunks.
+
+    Returns:
+        Iterator[str]: The chunks of the response.
+
+    Raises:
+        Exception: Whatever the output raised before its first chunk.
+    """
+    iterator = iter(output)
+    first = next(iterator, _END)
+
+    def stream():
+        if first is _END:
+            return
+        yield first
+        try:
+            yield from iterator
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('%s stream failed', name)
+            metrics.incr(f'{name}.stream_errors')
+            yield STREAM_ERROR
+    return stream()
+
+
+async def astart_stream(name, output):
+    """
+    Starts streaming a response from an async iterable like start_stream.
+
+    Args:
+        name: The prefix of the error counter.
+        output: An async iterable of response chunks.
+
+    Returns:
+        AsyncIterator[str]: The chunks of the response.
+
+    Raises:
+        Exception: Whatever the output raised before its first chunk.
+    """
+    iterator = aiter(output)
+    try:
+        first = await anext(iterator)
+    except StopAsyncIteration:
+        first = _END
+
+    async def stream():
+        if first is _END:
+            return
+        yield first
+        try:
+            async for chunk in iterator:
+                yield chunk
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception('%s stream failed', name)
+            metrics.incr(f'{name}.stream_errors')
+            yield STREAM_ERROR
+    return stream()
@@ -4,7 +4,6 @@ Support AI to retrieve summaries for specified case numbers from an
 API service.
 """
 import os
-import time
 
 import requests
 import streamlit as st
@@ -24,10 +23,9 @@ if case_number:
     try:
         response = requests.get(URL, stream=True, timeout=3600)
         with st.empty():
-            for token in response.iter_content():
-                st.session_state.content += "  \n" \
-                    if token == b'\n' else token.decode('utf-8')
+            for token in response.iter_content(chunk_size=None,
+                                               decode_unicode=True):
+                st.session_state.content += token.replace('\n', '  \n')
                 st.write(st.session_state.content)
-                time.sleep(1/100)
     except requests.exceptions.RequestException as e:
         st.error(f"An error occurred: {e}")
@@ -0,0 +1,558 @@
+""" Data Source Unit Tests """
+import asyncio
+import gc
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import weakref
+from unittest import mock
+
+import simple_salesforce
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.llms.fake import FakeListLLM
+from langchain_core.documents import Document
+from support_ai.lib import vectorstore
+from support_ai.lib.chain import Chain, NO_MATCH
+from support_ai.lib.datasources import checkpoint as checkpoint_module
+from support_ai.lib.datasources import ds_querier, ds_updater, salesforce
+from support_ai.lib.datasources.checkpoint import (
+    CheckpointStore,
+    get_checkpoint,
+    get_soql_condition,
+)
+from support_ai.lib.datasources.comment_filter import CommentFilter
+from support_ai.lib.datasources.ds import Checkpoint, Data
+from support_ai.lib.datasources.salesforce import (
+    Dialogs,
+    SalesforceSource,
+)
+from support_ai.lib.datasources.fingerprint import (
+    FingerprintIndex,
+    get_fingerprint,
+)
+from support_ai.lib.utils.lru import SingleFlight, TTLCache
+from support_ai.lib.utils.token_budget import TokenBudget
+
+# pylint: disable=no-self-use
+
+
+class TestCheckpoint(unittest.TestCase):
+    """ Unit Tests for the checkpoints. """
+
+    def test_soql_condition_tie_break(self):
+        """
+        Test records modified at the checkpoint time are resumed after its
+        record Id, and a checkpoint without record includes them all.
+        """
+        checkpoint = get_checkpoint({
+            'Id': '500A', 'LastModifiedDate': '2024-01-02T03:04:05.000+0000'})
+        self.assertEqual(checkpoint,
+                         Checkpoint('2024-01-02T03:04:05Z', '500A'))
+        self.assertEqual(get_soql_condition(checkpoint),
+                         "(LastModifiedDate > 2024-01-02T03:04:05Z OR "
+                         "(LastModifiedDate = 2024-01-02T03:04:05Z AND "
+                         "Id > '500A'))")
+        self.assertEqual(get_soql_condition(
+                             Checkpoint('2024-01-02T00:00:00Z')),
+                         'LastModifiedDate >= 2024-01-02T00:00:00Z')
+
+    def test_atomic_save(self):
+        """
+        Test a failed save keeps the previous checkpoint.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(checkpoint_module, 'CHECKPOINT_DIR',
+                                  tmpdir):
+            store = CheckpointStore()
+            self.assertIsNone(store.load('salesforce'))
+            store.save('salesforce', Checkpoint('2024-01-02T03:04:05Z', 'A'))
+            with mock.patch.object(checkpoint_module.json, 'dump',
+                                   side_effect=OSError('disk full')), \
+                    self.assertRaises(OSError):
+                store.save('salesforce', Checkpoint('2024-02-01T00:00:00Z'))
+            self.assertEqual(store.load('salesforce'),
+                             Checkpoint('2024-01-02T03:04:05Z', 'A'))
+            with open(os.path.join(tmpdir, 'salesforce.json'),
+                      encoding='utf-8') as f:
+                self.assertEqual(json.load(f)['record_id'], 'A')
+
+    def test_legacy_update_time(self):
+        """
+        Test a data source without checkpoint resumes from the update date
+        written by earlier versions.
+        """
+        updater = ds_updater.DSUpdater.__new__(ds_updater.DSUpdater)
+        updater.stop_update_thread = threading.Event()
+        updater.checkpoint_store = mock.Mock()
+        updater.checkpoint_store.load.return_value = None
+        updater.fingerprint_index = mock.Mock()
+        ds = mock.Mock()
+        ds.get_update_data.return_value = iter([])
+        updater.datasources = {'salesforce': ds}
+        updater.batch_size = ds_updater.DEFAULT_BATCH_SIZE
+        updater.batch_bytes = ds_updater.DEFAULT_BATCH_BYTES
+        with tempfile.TemporaryDirectory() as tmpdir:
+            update_time = os.path.join(tmpdir, 'update_time')
+            with open(update_time, 'w', encoding='utf-8') as f:
+                f.write('01/02/2024')
+            with mock.patch.object(ds_updater, 'UPDATE_TIME', update_time):
+                # pylint: disable=protected-access
+                updater._DSUpdater__update_data()
+        self.assertEqual(ds.get_update_data.call_args.args[0],
+                         Checkpoint('2024-01-02T00:00:00Z'))
+
+    def test_skipped_records_advance_checkpoint(self):
+        """
+        Test the checkpoint advances past the records skipped as unchanged or
+        without description, and only their metadata is refreshed.
+        """
+        source = TestSalesforceSource.get_source()
+        source.sf.query_all.return_value = {'records': [
+            {'Id': '500A', 'CaseNumber': '1', 'Subject': 'subject',
+             'Description': 'description', 'Sev_Lvl__c': 'L1',
+             'CreatedDate': '2024-01-01T00:00:00.000+0000',
+             'LastModifiedDate': '2024-01-02T03:04:05.000+0000'},
+            {'Id': '500B', 'CaseNumber': '2', 'Subject': 'subject',
+             'Description': None, 'Sev_Lvl__c': 'L1',
+             'CreatedDate': '2024-01-01T00:00:00.000+0000',
+             'LastModifiedDate': '2024-01-03T00:00:00.000+0000'}]}
+        updater = ds_updater.DSUpdater.__new__(ds_updater.DSUpdater)
+        updater.stop_update_thread = threading.Event()
+        updater.checkpoint_store = mock.Mock()
+        updater.checkpoint_store.load.return_value = Checkpoint(
+                '2024-01-01T00:00:00Z')
+        updater.fingerprint_index = mock.Mock()
+        updater.fingerprint_index.is_unchanged.return_value = True
+        updater.vector_store = mock.Mock()
+        updater.datasources = {'salesforce': source}
+        updater.batch_size = ds_updater.DEFAULT_BATCH_SIZE
+        updater.batch_bytes = ds_updater.DEFAULT_BATCH_BYTES
+        # pylint: disable=protected-access
+        updater._DSUpdater__update_data()
+        updater.fingerprint_index.is_unchanged.assert_called_once()
+        updater.vector_store.bulk_update.assert_called_once_with(
+                'salesforce', source.model.embeddings, [])
+        data_list = updater.vector_store.update_metadata.call_args.args[1]
+        self.assertEqual([(data.id, data.document, data.metadata)
+                          for data in data_list],
+                         [('1', None, {'case_number': '1',
+                                       'subject': 'subject',
+                                       'severity': 'L1',
+                                       'created_at': 1704067200,
+                                       'modified_at': 1704164645}),
+                          ('2', None, {'case_number': '2',
+                                       'subject': 'subject',
+                                       'severity': 'L1',
+                                       'created_at': 1704067200,
+                                       'modified_at': 1704240000})])
+        updater.checkpoint_store.save.assert_called_once_with(
+                'salesforce', Checkpoint('2024-01-03T00:00:00Z', '500B'))
+
+
+class TestFingerprintIndex(unittest.TestCase):
+    """ Unit Tests for FingerprintIndex. """
+
+    def test_skip_unchanged_records(self):
+        """
+        Test only records written with the same content are unchanged, per
+        data source and across reopening the index.
+        """
+        old = get_fingerprint('subject', 'description')
+        new = get_fingerprint('subject', 'new description')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'fingerprints.db')
+            index = FingerprintIndex(path)
+            self.assertFalse(index.is_unchanged('salesforce', '1', old))
+            index.bulk_update('salesforce', [
+                Data('doc', {}, '1', fingerprint=old),
+                Data('doc', {}, '2')])
+            self.assertTrue(index.is_unchanged('salesforce', '1', old))
+            self.assertFalse(index.is_unchanged('salesforce', '1', new))
+            self.assertFalse(index.is_unchanged('knowledgebase', '1', old))
+            self.assertFalse(index.is_unchanged('salesforce', '2', None))
+            index.close()
+
+            index = FingerprintIndex(path)
+            index.bulk_update('salesforce', [
+                Data('doc', {}, '1', fingerprint=new)])
+            self.assertTrue(index.is_unchanged('salesforce', '1', new))
+            self.assertFalse(index.is_unchanged('salesforce', '1', old))
+            index.close()
+
+
+class TestDSQuerier(unittest.TestCase):
+    """ Unit Tests for DSQuerier. """
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.enterContext(mock.patch.object(vectorstore, 'VECTORDB_DIR',
+                                            tmpdir))
+        self.embeddings = DeterministicFakeEmbedding(size=4)
+        self.store = vectorstore.VectorStore()
+        self.addCleanup(self.store.close)
+
+    def get_querier(self, ds_types=('test',)):
+        """
+        Creates a DSQuerier searching the test vector store, without models.
+        """
+        querier = ds_querier.DSQuerier.__new__(ds_querier.DSQuerier)
+        querier.vector_store = self.store
+        querier.datasources = {}
+        for ds_type in ds_types:
+            querier.datasources[ds_type] = mock.Mock()
+            querier.datasources[ds_type].model.embeddings = self.embeddings
+        querier.query_cache = TTLCache()
+        querier.query_flight = SingleFlight()
+        querier.k = ds_querier.DEFAULT_K
+        querier.score_threshold = ds_querier.DEFAULT_SCORE_THRESHOLD
+        querier.routing_mode = ds_querier.ROUTING_FANOUT
+        querier.fusion = ds_querier.FUSION_RRF
+        return querier
+
+    def test_query_cache_invalidated_by_update(self):
+        """
+        Test cached query results are reused until the vector store of their
+        data source is written.
+        """
+        self.store.bulk_update('test', self.embeddings,
+                               [Data('first doc', {}, '1')])
+        querier = self.get_querier()
+        with mock.patch.object(self.store, 'similarity_search_with_score',
+                               wraps=self.store.similarity_search_with_score
+                               ) as search:
+            hits = querier.query_hits('first doc', 'test')
+            self.assertEqual([(hit[1].id, hit[1].page_content)
+                              for hit in hits], [('1', 'first doc')])
+            self.assertEqual(querier.query_hits(' First  DOC ', 'test'),
+                             hits)
+            self.assertEqual(search.call_count, 1)
+
+            self.store.bulk_update('test', self.embeddings,
+                                   [Data('second doc', {}, '2')])
+            hits = querier.query_hits('first doc', 'test')
+            self.assertEqual(search.call_count, 2)
+            self.assertCountEqual([hit[1].page_content for hit in hits],
+                                  ['first doc', 'second doc'])
+
+    def test_score_threshold(self):
+        """
+        Test the results below the score threshold are dropped, and a chain
+        answers a query without any relevant result with no match.
+        """
+        self.store.bulk_update('test', self.embeddings,
+                               [Data('first doc', {}, '1'),
+                                Data('second doc', {}, '2')])
+        querier = self.get_querier()
+        querier.score_threshold = 0.99
+        self.assertEqual([hit[1].page_content
+                          for hit in querier.query_hits('first doc', 'test')],
+                         ['first doc'])
+
+        querier.score_threshold = 1.01
+        self.assertEqual(querier.query('first doc', 'test'), (None, None))
+        qa_chain = Chain.__new__(Chain)
+        qa_chain.ds_querier = querier
+        self.assertEqual(''.join(qa_chain.ask('first doc', 'test')),
+                         NO_MATCH)
+
+        async def aask():
+            return ''.join([segment async for segment in
+                            await qa_chain.aask('first doc', 'test')])
+        self.assertEqual(asyncio.run(aask()), NO_MATCH)
+        querier.datasources['test'].get_content.assert_not_called()
+
+    def test_where_filter(self):
+        """
+        Test a where filter selects the records by their metadata, which is
+        refreshed without writing the records again.
+        """
+        self.store.bulk_update('test', self.embeddings,
+                               [Data('first doc', {'severity': 'L1'}, '1'),
+                                Data('second doc', {'severity': 'L2'}, '2')])
+        querier = self.get_querier()
+        self.assertEqual([hit[1].page_content for hit in querier.query_hits(
+                              'doc', 'test', {'severity': 'L1'})],
+                         ['first doc'])
+
+        self.store.update_metadata('test', [Data(None, {'severity': 'L1'},
+                                                 '2'),
+                                            Data(None, {'severity': 'L1'},
+                                                 'never stored')])
+        self.assertCountEqual([hit[1].page_content
+                               for hit in querier.query_hits(
+                                   'doc', 'test', {'severity': 'L1'})],
+                              ['first doc', 'second doc'])
+
+    def test_backfill_metadata(self):
+        """
+        Test the backfill refreshes the metadata of every stored record
+        without writing them again or moving the checkpoint.
+        """
+        self.store.bulk_update('test', self.embeddings,
+                               [Data('first doc', {}, '1')])
+        updater = ds_updater.DSUpdater.__new__(ds_updater.DSUpdater)
+        updater.vector_store = self.store
+        updater.checkpoint_store = mock.Mock()
+        updater.fingerprint_index = mock.Mock()
+        updater.datasources = {'test': mock.Mock()}
+        updater.datasources['test'].get_update_data.return_value = iter([
+            Data(None, {'severity': 'L1'}, '1',
+                 Checkpoint('2024-01-01T00:00:00Z', '1'))])
+        updater.batch_size = ds_updater.DEFAULT_BATCH_SIZE
+        updater.batch_bytes = ds_updater.DEFAULT_BATCH_BYTES
+        with mock.patch.object(self.store, 'bulk_update',
+                               wraps=self.store.bulk_update) as bulk_update:
+            self.assertEqual(updater.backfill_metadata('test'), 1)
+        bulk_update.assert_called_once_with(
+                'test', updater.datasources['test'].model.embeddings, [])
+        checkpoint, is_unchanged = \
+            updater.datasources['test'].get_update_data.call_args.args
+        self.assertIsNone(checkpoint)
+        self.assertTrue(is_unchanged('1', 'fingerprint'))
+        updater.checkpoint_store.save.assert_not_called()
+        self.assertEqual(
+                [hit[1].metadata for hit in self.get_querier().query_hits(
+                    'first doc', 'test')],
+                [{'severity': 'L1'}])
+        with self.assertRaises(ValueError):
+            updater.backfill_metadata('unknown')
+
+    def test_fuse(self):
+        """
+        Test the rankings of several data sources are interleaved by rank, or
+        merged by score, keeping the records of different data sources apart
+        even if they share the same content.
+        """
+        querier = self.get_querier(('salesforce', 'knowledgebase'))
+        sf_ds = querier.datasources['salesforce']
+        kb_ds = querier.datasources['knowledgebase']
+        results = [
+            [(sf_ds, Document('same', id='1'), 0.3),
+             (sf_ds, Document('sf second', id='2'), 0.2),
+             (sf_ds, Document('sf third', id='3'), 0.1)],
+            [(kb_ds, Document('same', id='1'), 0.9),
+             (kb_ds, Document('kb second', id='4'), 0.8)],
+        ]
+        # pylint: disable=protected-access
+        self.assertEqual(
+                [(hit[0], hit[1].page_content, hit[2])
+                 for hit in querier._DSQuerier__fuse(results)],
+                [(sf_ds, 'same', 0.3), (kb_ds, 'same', 0.9),
+                 (sf_ds, 'sf second', 0.2), (kb_ds, 'kb second', 0.8),
+                 (sf_ds, 'sf third', 0.1)])
+        querier.fusion = ds_querier.FUSION_SCORE
+        self.assertEqual(
+                [(hit[0], hit[1].page_content, hit[2])
+                 for hit in querier._DSQuerier__fuse(results)],
+                [(kb_ds, 'same', 0.9), (kb_ds, 'kb second', 0.8),
+                 (sf_ds, 'same', 0.3), (sf_ds, 'sf second', 0.2),
+                 (sf_ds, 'sf third', 0.1)])
+
+    def test_fanout_query(self):
+        """
+        Test a fan-out query searches every data source and fuses their
+        results.
+        """
+        for ds_type in ('salesforce', 'knowledgebase'):
+            self.store.bulk_update(ds_type, self.embeddings,
+                                   [Data('same doc', {}, '1'),
+                                    Data(f'{ds_type} doc', {}, '2')])
+        querier = self.get_querier(('salesforce', 'knowledgebase'))
+        hits = querier.query_hits('same doc')
+        self.assertCountEqual([(hit[0], hit[1].page_content)
+                               for hit in hits[:2]],
+                              [(ds, 'same doc')
+                               for ds in querier.datasources.values()])
+        self.assertEqual(len(hits), 4)
+        self.assertEqual(asyncio.run(querier.aquery_hits('same doc')), hits)
+
+
+class TestSalesforceSource(unittest.TestCase):
+    """ Unit Tests for SalesforceSource. """
+
+    @staticmethod
+    def get_source():
+        """
+        Creates a SalesforceSource without connecting to Salesforce.
+        """
+        source = SalesforceSource.__new__(SalesforceSource)
+        source.sf = mock.Mock()
+        source.model = mock.Mock()
+        source.summary_cache = None
+        source.strategy = 'refine'
+        source.tree_reduce_parallelism = 4
+        source.use_relationship_query = True
+        return source
+
+    def get_judging_source(self, responses):
+        """
+        Creates a SalesforceSource judging comments with a fake llm.
+        """
+        source = self.get_source()
+        source.model.llm = FakeListLLM(responses=responses)
+        source.model.limiter = None
+        source.model.alimiter = None
+        source.model.budget = TokenBudget(source.model.llm)
+        source.judge_batch_size = 20
+        return source
+
+    def test_parse_verdicts(self):
+        """
+        Test verdicts are parsed in any case and order, extra lines and
+        repeated numbers are ignored, and a missing verdict fails the batch.
+        """
+        comments = ['fixed by a restart', 'still looking', 'workaround']
+        # pylint: disable=protected-access
+        parse = SalesforceSource._SalesforceSource__parse_verdicts
+        self.assertEqual(parse('3. yes\n1: YES\n2 - No', comments),
+                         ['fixed by a restart', None, 'workaround'])
+        self.assertEqual(parse('ANS:\n1: YES\n2: NO\n3: YES\n4: NO\n'
+                               '2: YES', comments),
+                         ['fixed by a restart', None, 'workaround'])
+        self.assertIsNone(parse('1: YES\n3: NO', comments))
+        self.assertIsNone(parse('YES\nNO\nYES', comments))
+        self.assertIsNone(parse('1: MAYBE\n2: NO\n3: YES', comments))
+
+    def test_judge_batched(self):
+        """
+        Test a batch of comments is judged in a single call.
+        """
+        source = self.get_judging_source(['1: NO\n2: YES', 'unused'])
+        # pylint: disable=protected-access
+        self.assertEqual(
+                source._SalesforceSource__judge_comment(
+                    ['still looking', 'workaround']),
+                [None, 'workaround'])
+        self.assertEqual(source.model.llm.i, 1)
+
+    def test_judge_fallback(self):
+        """
+        Test comments are judged one call each if the verdicts of their batch
+        can't be parsed, synchronously or not.
+        """
+        comments = ['still looking', 'workaround']
+        source = self.get_judging_source(['1: NO', 'NO', 'YES', 'unused'])
+        # pylint: disable=protected-access
+        self.assertEqual(source._SalesforceSource__judge_comment(comments),
+                         [None, 'workaround'])
+        self.assertEqual(source.model.llm.i, 3)
+
+        source = self.get_judging_source(
+                ['I cannot tell', 'NO', 'YES', 'unused'])
+        self.assertEqual(
+                asyncio.run(source._SalesforceSource__ajudge_comment(
+                    comments)),
+                [None, 'workaround'])
+        self.assertEqual(source.model.llm.i, 3)
+
+    def test_user_names_cached(self):
+        """
+        Test user names are queried once, including the users without first
+        name or not found, which fall back to their Id.
+        """
+        source = self.get_source()
+        source.sf.query_all.return_value = {'records': [
+            {'Id': 'test-user-a', 'FirstName': None},
+            {'Id': 'test-user-b', 'FirstName': 'Bob'}]}
+        user_ids = ['test-user-a', 'test-user-b', 'test-user-c']
+        expected = {'test-user-a': 'test-user-a', 'test-user-b': 'Bob',
+                    'test-user-c': 'test-user-c'}
+        # pylint: disable=protected-access
+        self.assertEqual(source._SalesforceSource__get_user_names(user_ids),
+                         expected)
+        self.assertEqual(source._SalesforceSource__get_user_names(user_ids),
+                         expected)
+        source.sf.query_all.assert_called_once()
+
+    def test_filter_comments_calls_saved(self):
+        """
+        Test the judging calls saved by the comment filter are counted
+        without counting tokens.
+        """
+        source = self.get_source()
+        source.comment_filter = CommentFilter({})
+        source.judge_batch_size = 2
+        source.model.budget = budget = mock.Mock()
+        comments = ['Any update?', 'Thanks!', 'Logs attached.',
+                    'Reboot fixed it.', 'The workaround is to disable GRO.']
+        with mock.patch.object(salesforce.metrics, 'incr') as incr:
+            # pylint: disable=protected-access
+            self.assertEqual(
+                    source._SalesforceSource__filter_comments(comments),
+                    comments[3:])
+        incr.assert_any_call('salesforce.comment_filter.calls_saved', 2)
+        budget.count.assert_not_called()
+
+    def test_case_with_comments_query(self):
+        """
+        Test a case and its comments are retrieved with a single relationship
+        query, following the pages of the comments, and the comment authors'
+        names are cached.
+        """
+        source = self.get_source()
+        comments = [
+            {'CommentBody': 'first', 'CreatedById': 'test-rel-user-a',
+             'CreatedBy': {'FirstName': 'Alice'}},
+            {'CommentBody': 'second', 'CreatedById': 'test-rel-user-b',
+             'CreatedBy': None}]
+        case = {'Id': '500A', 'CaseNumber': '1', 'CaseComments': {
+            'done': False, 'nextRecordsUrl': '/next',
+            'records': comments[:1]}}
+        source.sf.query_all.return_value = {'records': [case]}
+        source.sf.query_more.return_value = {'done': True,
+                                             'records': comments[1:]}
+        # pylint: disable=protected-access
+        self.assertEqual(source._SalesforceSource__get_case_and_comments('1'),
+                         (case, comments))
+        self.assertIn('FROM CaseComments',
+                      source.sf.query_all.call_args.args[0])
+        source.sf.query_more.assert_called_once_with('/next',
+                                                     identifier_is_url=True)
+        self.assertEqual(source._SalesforceSource__get_user_names(
+                             ['test-rel-user-a', 'test-rel-user-b']),
+                         {'test-rel-user-a': 'Alice',
+                          'test-rel-user-b': 'test-rel-user-b'})
+        source.sf.query_all.assert_called_once()
+
+    def test_case_and_comments_fallback(self):
+        """
+        Test a rejected relationship query falls back to separate queries,
+        which are used directly afterwards.
+        """
+        source = self.get_source()
+        case = {'Id': '500A', 'CaseNumber': '1'}
+        comments = [{'CommentBody': 'first', 'CreatedById': 'user'}]
+        source.sf.query_all.side_effect = [
+            simple_salesforce.SalesforceMalformedRequest(
+                'url', 400, 'query', b'unsupported relationship'),
+            {'records': [case]}, {'records': comments},
+            {'records': [case]}, {'records': comments}]
+        # pylint: disable=protected-access
+        for _ in range(2):
+            self.assertEqual(
+                    source._SalesforceSource__get_case_and_comments('1'),
+                    (case, comments))
+        self.assertFalse(source.use_relationship_query)
+        self.assertEqual(source.sf.query_all.call_count, 5)
+        self.assertIn("WHERE ParentId = '500A'",
+                      source.sf.query_all.call_args.args[0])
+
+    def test_summary_not_keeping_source_alive(self):
+        """
+        Test a cached summary stream doesn't keep the data source alive.
+        """
+        source = self.get_source()
+        dialogs = Dialogs()
+        dialogs.append('Bob', 'Restarting the service fixed it.')
+        # pylint: disable=protected-access
+        stream = source._SalesforceSource__get_summary('desc', dialogs)
+        self.assertIs(source._SalesforceSource__get_summary('desc', dialogs),
+                      stream)
+        ref = weakref.ref(source)
+        del source
+        gc.collect()
+        self.assertIsNone(ref())
@@ -2,7 +2,14 @@
 import unittest
 from unittest import mock
 
-from support_ai import ai_bot
+from starlette.testclient import TestClient
+from support_ai import ai_bot, api_server, asgi_app
+from support_ai.utils import (
+    astart_stream,
+    get_filter,
+    start_stream,
+    STREAM_ERROR,
+)
 
 # pylint: disable=no-self-use
 
@@ -21,3 +28,176 @@ class TestSupportAI(unittest.TestCase):
         """
         mock_input.return_value = 'quit'
         ai_bot.main()
+
+
+class TestApiServer(unittest.TestCase):
+    """ Unit Tests for the API server. """
+
+    @mock.patch.object(api_server, 'chain')
+    def test_ai(self, mock_chain):
+        """
+        Test a query is streamed, and fails with 400 on invalid arguments
+        and with a logged 500 on other errors.
+        """
+        mock_chain.ask.return_value = iter(['an ', 'answer'])
+        with api_server.app.test_request_context('/api/ai?query=q'):
+            response = api_server.AI().get()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(as_text=True), 'an answer')
+
+            mock_chain.ask.side_effect = ValueError('Unknown datasource')
+            self.assertEqual(api_server.AI().get(),
+                             ({'message': 'Service unavailable'}, 400))
+
+            mock_chain.ask.side_effect = RuntimeError('bug')
+            with self.assertLogs(api_server.logger, 'ERROR'):
+                self.assertEqual(api_server.AI().get(),
+                                 ({'message': 'Internal server error'}, 500))
+
+        with api_server.app.test_request_context(
+                '/api/ai?query=q&filter=not-json'):
+            self.assertEqual(api_server.AI().get(),
+                             ({'message': 'Invalid filter'}, 400))
+
+        mock_chain.ask.side_effect = None
+        with api_server.app.test_request_context(
+                '/api/ai?query=q&filter={"severity": "L1"}'):
+            self.assertEqual(api_server.AI().get().status_code, 200)
+        mock_chain.ask.assert_called_with('q', ds_type=None, session=None,
+                                          where={'severity': 'L1'})
+
+    @mock.patch.object(api_server, 'chain')
+    def test_salesforce(self, mock_chain):
+        """
+        Test a case summary fails with a logged 500 on unexpected errors.
+        """
+        mock_chain.custom_api.side_effect = RuntimeError('bug')
+        with api_server.app.test_request_context(
+                '/api/salesforce/1/summary'), \
+                self.assertLogs(api_server.logger, 'ERROR'):
+            self.assertEqual(api_server.Salesforce().get('1'),
+                             ({'message': 'Internal server error'}, 500))
+
+
+class TestAsgiApp(unittest.TestCase):
+    """ Unit Tests for the ASGI application. """
+
+    def setUp(self):
+        self.chain = mock.Mock()
+        self.enterContext(mock.patch.object(asgi_app, 'get_config'))
+        self.enterContext(mock.patch.object(asgi_app, 'Chain',
+                                            return_value=self.chain))
+        self.client = self.enterContext(TestClient(asgi_app.create_app()))
+
+    @staticmethod
+    async def agenerate(chunks):
+        """ Yield chunks asynchronously. """
+        for chunk in chunks:
+            yield chunk
+
+    def test_ai(self):
+        """
+        Test a query is streamed, and fails with 400 on invalid arguments
+        and with a logged 500 on other errors.
+        """
+        self.chain.aask = mock.AsyncMock(
+                return_value=self.agenerate(['an ', 'answer']))
+        response = self.client.get('/api/ai', params={
+            'query': 'q', 'datasource': 'salesforce',
+            'filter': '{"severity": "L1"}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'an answer')
+        self.chain.aask.assert_awaited_once_with(
+                'q', ds_type='salesforce', session=None,
+                where={'severity': 'L1'})
+
+        self.assertEqual(self.client.get('/api/ai').status_code, 400)
+        self.assertEqual(self.client.get('/api/ai', params={
+            'query': 'q', 'filter': 'not-json'}).json(),
+            {'message': 'Invalid filter'})
+        self.chain.aask.side_effect = ValueError('Unknown datasource')
+        self.assertEqual(self.client.get(
+            '/api/ai', params={'query': 'q'}).status_code, 400)
+        self.chain.aask.side_effect = RuntimeError('bug')
+        with self.assertLogs(asgi_app.logger, 'ERROR'):
+            response = self.client.get('/api/ai', params={'query': 'q'})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json(),
+                         {'message': 'Internal server error'})
+
+    def test_salesforce(self):
+        """
+        Test a case summary is streamed, and fails with 400 on invalid
+        arguments and with a logged 500 on other errors.
+        """
+        self.chain.acustom_api = mock.AsyncMock(
+                return_value=self.agenerate(['a ', 'summary']))
+        response = self.client.get('/api/salesforce/1/summary')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'a summary')
+
+        self.chain.acustom_api.side_effect = ValueError('Unknown case')
+        self.assertEqual(self.client.get(
+            '/api/salesforce/1/summary').status_code, 400)
+        self.chain.acustom_api.side_effect = RuntimeError('bug')
+        with self.assertLogs(asgi_app.logger, 'ERROR'):
+            self.assertEqual(self.client.get(
+                '/api/salesforce/1/summary').status_code, 500)
+
+    def test_history(self):
+        """
+        Test a session history is cleared, and a missing session fails.
+        """
+        response = self.client.delete('/api/history',
+                                      params={'session': 's'})
+        self.assertEqual(response.json(), {'success': True})
+        self.chain.clear_history.assert_called_once_with('s')
+        self.assertEqual(self.client.delete('/api/history').status_code, 400)
+
+
+class TestGetFilter(unittest.TestCase):
+    """ Unit Tests for get_filter. """
+
+    def test_get_filter(self):
+        """
+        Test a filter is parsed from a JSON object, and anything else but no
+        filter is rejected.
+        """
+        self.assertEqual(get_filter('{"created_at": {"$gte": 1704067200}}'),
+                         {'created_at': {'$gte': 1704067200}})
+        self.assertIsNone(get_filter(None))
+        for arg in ('not-json', '["severity"]', '"L1"'):
+            with self.assertRaises(ValueError):
+                get_filter(arg)
+
+
+class TestStartStream(unittest.IsolatedAsyncioTestCase):
+    """ Unit Tests for start_stream and astart_stream. """
+
+    @staticmethod
+    def generate(fail_after):
+        """ Yield chunks, then fail. """
+        yield from ['a', 'b'][:fail_after]
+        raise ValueError('llm error')
+
+    async def agenerate(self, fail_after):
+        """ Yield chunks like generate, asynchronously. """
+        for chunk in self.generate(fail_after):
+            yield chunk
+
+    async def test_errors(self):
+        """
+        Test an error before the first chunk is raised, and an error after
+        it ends the stream with an error notice.
+        """
+        with self.assertRaises(ValueError):
+            start_stream('test', self.generate(0))
+        self.assertEqual(list(start_stream('test', self.generate(2))),
+                         ['a', 'b', STREAM_ERROR])
+        self.assertEqual(list(start_stream('test', iter([]))), [])
+
+        with self.assertRaises(ValueError):
+            await astart_stream('test', self.agenerate(0))
+        self.assertEqual([chunk async for chunk in await astart_stream(
+                              'test', self.agenerate(1))],
+                         ['a', STREAM_ERROR])
@@ -0,0 +1,622 @@
+""" SupportAI Utils Unit Tests """
+import asyncio
+from concurrent.futures import CancelledError
+import gc
+import os
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from functools import partial
+from unittest import mock
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.llms.fake import FakeListLLM
+from langchain_core.documents import Document
+from support_ai.lib.datasources.comment_filter import CommentFilter
+from support_ai.lib.datasources.router import EmbeddingRouter
+from support_ai.lib.model_manager.cached_embeddings import CachedEmbeddings
+from support_ai.lib.summary_cache import SqliteSummaryCache
+from support_ai.lib.utils.batch import batched
+from support_ai.lib.utils.docs_chain import (
+    adocs_tree_reduce,
+    docs_tree_reduce,
+)
+from support_ai.lib.utils.lru import (
+    SingleFlight,
+    timed_lru_cache,
+    TTLCache,
+)
+from support_ai.lib.utils.parallel_executor import (
+    arun_fn_unordered,
+    run_fn_in_background,
+    run_fn_unordered,
+)
+from support_ai.lib.utils.shared_stream import AsyncSharedStream, SharedStream
+from support_ai.lib.utils.token_budget import TokenBudget
+from support_ai.lib import vectorstore
+
+# pylint: disable=no-self-use
+
+
+class TestBatched(unittest.TestCase):
+    """ Unit Tests for batched. """
+
+    def test_batched_by_count_and_bytes(self):
+        """
+        Test batches are bounded by count and total size.
+        """
+        items = ['a' * 3, 'b' * 3, 'c' * 3, 'd' * 8, 'e']
+        batches = list(batched(items, 2, 8, len))
+        self.assertEqual(batches, [['aaa', 'bbb'], ['ccc'], ['dddddddd'],
+                                   ['e']])
+
+
+class TestRunFnUnordered(unittest.TestCase):
+    """ Unit Tests for run_fn_unordered. """
+
+    def test_bounded_and_complete(self):
+        """
+        Test every argument is processed with bounded concurrency.
+        """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def square(value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return value * value
+
+        results = dict(run_fn_unordered(square, iter(range(20)), 3))
+        self.assertEqual(results, {i: i * i for i in range(20)})
+        self.assertEqual(running[1], 3)
+
+
+class TestRunFnInBackground(unittest.TestCase):
+    """ Unit Tests for run_fn_in_background. """
+
+    def test_cancel_nested_work_on_exit(self):
+        """
+        Test the work submitted by a background call is skipped once the
+        caller has left.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def step(value):
+            started.set()
+            release.wait()
+            return value
+
+        def work(values):
+            return dict(run_fn_unordered(step, values, 1))
+
+        with run_fn_in_background([(work, [1, 2])]) as futures:
+            started.wait()
+        release.set()
+        with self.assertRaises(CancelledError):
+            futures[0].result()
+
+
+class TestTTLCache(unittest.TestCase):
+    """ Unit Tests for TTLCache. """
+
+    @mock.patch('support_ai.lib.utils.lru.time.monotonic')
+    def test_expiry_and_eviction(self, mock_monotonic):
+        """
+        Test entries expire individually and the oldest entry is evicted.
+        """
+        cache = TTLCache(maxsize=2, seconds=10)
+        mock_monotonic.return_value = 0
+        cache.put('a', 1)
+        mock_monotonic.return_value = 5
+        cache.put('b', 2)
+        mock_monotonic.return_value = 12
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        cache.put('c', 3)
+        cache.put('d', 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    """ Unit Tests for SingleFlight. """
+
+    def test_coalesce(self):
+        """
+        Test concurrent calls for the same key share a single call.
+        """
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(None)
+            started.set()
+            release.wait()
+            return 'result'
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(flight.do('key', fn)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flight.coalesced < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.do('key', fn), 'result')
+        self.assertEqual(len(calls), 2)
+
+    async def test_acoalesce_leader_cancelled(self):
+        """
+        Test concurrent async calls for the same key share a single call,
+        which still completes for the others if the first caller is
+        cancelled.
+        """
+        flight = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fn():
+            calls.append(None)
+            await release.wait()
+            return 'result'
+        leader = asyncio.ensure_future(flight.ado('key', fn))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(flight.ado('key', fn))
+                     for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertEqual(flight.coalesced, 3)
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        release.set()
+        self.assertEqual(await asyncio.gather(*followers),
+                         ['result'] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(flight.calls)
+
+
+class TestSqliteSummaryCache(unittest.TestCase):
+    """ Unit Tests for SqliteSummaryCache. """
+
+    @mock.patch('support_ai.lib.summary_cache.time.time')
+    def test_expiry_and_eviction(self, mock_time):
+        """
+        Test summaries expire, and the least recently used summaries of a
+        namespace are evicted without touching the other namespaces.
+        """
+        mock_time.return_value = 0.0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {'path': os.path.join(tmpdir, 'summary_cache.db'),
+                      'ttl': 10, 'maxsize': 2}
+            cache = SqliteSummaryCache(config, 'salesforce')
+            other = SqliteSummaryCache(config, 'knowledgebase')
+            other.put('a', 'kb a')
+            cache.put('a', 'sf a')
+            mock_time.return_value = 1.0
+            cache.put('b', 'sf b')
+            mock_time.return_value = 2.0
+            self.assertEqual(cache.get('a'), 'sf a')
+            cache.put('c', 'sf c')
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(cache.get('a'), 'sf a')
+            self.assertEqual(other.get('a'), 'kb a')
+
+            mock_time.return_value = 11.0
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('c'), 'sf c')
+
+
+class TestTimedLruCache(unittest.TestCase):
+    """ Unit Tests for timed_lru_cache. """
+
+    def test_coalesce_concurrent_misses(self):
+        """
+        Test concurrent misses for the same key run the function once.
+        """
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @timed_lru_cache()
+        def slow(value):
+            calls.append(value)
+            started.set()
+            release.wait()
+            return value * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow(2)))
+                   for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while slow.cache_info()['coalesced'] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [2])
+        self.assertEqual(results, [4, 4, 4])
+        self.assertEqual(slow(2), 4)
+        self.assertEqual(slow.cache_info()['hits'], 1)
+
+    def test_instance_not_kept_alive(self):
+        """
+        Test cached method results don't keep the instance alive.
+        """
+        class Source:  # pylint: disable=too-few-public-methods
+            """ A class with a cached method. """
+
+            @timed_lru_cache()
+            def get(self, value):
+                """ Return the value. """
+                return value
+
+        source = Source()
+        self.assertEqual(source.get(1), 1)
+        ref = weakref.ref(source)
+        del source
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestSharedStream(unittest.TestCase):
+    """ Unit Tests for SharedStream. """
+
+    def test_replay_and_restart_after_error(self):
+        """
+        Test readers share one source and a failed source is restarted.
+        """
+        calls = []
+
+        def factory():
+            calls.append(None)
+            yield 'a'
+            if len(calls) == 1:
+                raise RuntimeError('failed')
+            yield 'b'
+
+        stream = SharedStream(factory)
+        with self.assertRaises(RuntimeError):
+            list(stream)
+        self.assertEqual(list(stream), ['a', 'b'])
+        self.assertEqual(str(stream), 'ab')
+        self.assertEqual(len(calls), 2)
+
+    def test_abandoned_stream_closes_source(self):
+        """
+        Test the source is closed once every reader has gone away.
+        """
+        closed = []
+
+        def factory():
+            try:
+                yield 'a'
+                yield 'b'
+            finally:
+                closed.append(None)
+
+        stream = SharedStream(factory)
+        reader = iter(stream)
+        self.assertEqual(next(reader), 'a')
+        reader.close()
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(list(stream), ['a', 'b'])
+
+
+class TestAsyncSharedStream(unittest.IsolatedAsyncioTestCase):
+    """ Unit Tests for AsyncSharedStream. """
+
+    async def test_abandoned_stream_restarts(self):
+        """
+        Test concurrent readers share one source, and a stream abandoned by
+        every reader restarts with a fresh source.
+        """
+        calls = []
+
+        async def factory():
+            calls.append(None)
+            for chunk in ['a', 'b']:
+                await asyncio.sleep(0)
+                yield chunk
+
+        stream = AsyncSharedStream(factory)
+
+        async def read():
+            return [chunk async for chunk in stream]
+        self.assertEqual(await asyncio.gather(read(), read()),
+                         [['a', 'b'], ['a', 'b']])
+        self.assertEqual(len(calls), 1)
+
+        stream = AsyncSharedStream(factory)
+        reader = aiter(stream)
+        self.assertEqual(await anext(reader), 'a')
+        await reader.aclose()
+        self.assertEqual(await read(), ['a', 'b'])
+        self.assertEqual(len(calls), 3)
+
+
+class TestDocsTreeReduce(unittest.TestCase):
+    """ Unit Tests for docs_tree_reduce. """
+
+    def test_merge_pairwise(self):
+        """
+        Test every document is summarized, then merged pairwise down to one
+        summary.
+        """
+        llm = FakeListLLM(responses=['summary'] * 10)
+        docs = [Document(page_content=str(i)) for i in range(5)]
+        result = docs_tree_reduce(llm, docs, '{context}',
+                                  '{prev_context} {context}', parallelism=1)
+        self.assertEqual(result, 'summary')
+        # 5 summaries, then 2 + 1 + 1 merges over the levels
+        self.assertEqual(llm.i, 9)
+
+    def test_limiter(self):
+        """
+        Test the calls hold the limiter, and run within a task already
+        holding it without waiting for it.
+        """
+        lock = threading.Lock()
+        running = [0, 0]
+
+        class CountingLLM(FakeListLLM):
+            """ A fake llm counting its concurrent calls. """
+
+            def _call(self, *_args, **_kwargs):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.02)
+                with lock:
+                    running[0] -= 1
+                return 'summary'
+
+        llm = CountingLLM(responses=['summary'])
+        limiter = threading.BoundedSemaphore(2)
+        docs = [Document(page_content=str(i)) for i in range(8)]
+        summarize = partial(docs_tree_reduce, llm, docs, '{context}',
+                            '{prev_context} {context}', parallelism=4,
+                            limiter=limiter)
+        self.assertEqual(summarize(), 'summary')
+        self.assertEqual(running[1], 2)
+
+        running[1] = 0
+        self.assertEqual(dict(run_fn_unordered(
+            lambda _: summarize(), [None, None], 2, limiter=limiter)),
+            {0: 'summary', 1: 'summary'})
+        self.assertEqual(running[1], 2)
+
+    def test_held_limiter_refines(self):
+        """
+        Test documents are refined, one call each, within a task already
+        holding the limiter, synchronously or not.
+        """
+        docs = [Document(page_content=str(i)) for i in range(4)]
+        llm = FakeListLLM(responses=['summary'] * 10)
+        limiter = threading.BoundedSemaphore(1)
+        summarize = partial(docs_tree_reduce, llm, docs, '{context}',
+                            '{prev_context} {context}', limiter=limiter)
+        self.assertEqual(dict(run_fn_unordered(
+            lambda _: summarize(), [None], 1, limiter=limiter)),
+            {0: 'summary'})
+        self.assertEqual(llm.i, 4)
+
+        async def asummarize():
+            alimiter = asyncio.Semaphore(1)
+            return [result async for result in arun_fn_unordered(
+                lambda _: adocs_tree_reduce(
+                    llm, docs, '{context}', '{prev_context} {context}',
+                    limiter=alimiter),
+                [None], 1, limiter=alimiter)]
+        llm.i = 0
+        self.assertEqual(asyncio.run(asummarize()), [(0, 'summary')])
+        self.assertEqual(llm.i, 4)
+
+
+class TestTokenBudget(unittest.TestCase):
+    """ Unit Tests for TokenBudget. """
+
+    def test_split_fills_budget(self):
+        """
+        Test long texts are split and short texts are packed within the
+        budget left by the prompts and the output reserves.
+        """
+        llm = FakeListLLM(responses=[''])
+        budget = TokenBudget(llm, context_size=100, output_tokens=10)
+        chunk_size = budget.get_chunk_size('{context}',
+                                           '{prev_context} {context}')
+        self.assertEqual(chunk_size, 79)
+        docs = budget.split(['word ' * 200, 'a', 'b'], '{context}')
+        self.assertGreater(len(docs), 1)
+        for doc in docs:
+            self.assertLessEqual(budget.count(doc.page_content), chunk_size)
+        self.assertTrue(docs[-1].page_content.endswith('a\n\nb'))
+        self.assertRaises(ValueError,
+                          TokenBudget(llm, 100, 50).get_chunk_size,
+                          '{context}')
+
+    def test_count_with_model_tokenizer(self):
+        """
+        Test tokens are counted with the model's tokenizer, and estimated if
+        it fails or the model has none.
+        """
+        client = mock.Mock()
+        client.tokenize.side_effect = lambda text: text.split()
+        llm = mock.Mock(spec=['client'], client=client)
+        self.assertEqual(TokenBudget(llm).count('one two three'), 3)
+        client.tokenize.side_effect = OSError('tokenizer not available')
+        self.assertEqual(TokenBudget(llm).count('one two three'), 4)
+        with mock.patch('langchain_core.language_models.base.'
+                        'get_tokenizer') as get_gpt2_tokenizer:
+            llm = FakeListLLM(responses=[''])
+            self.assertEqual(TokenBudget(llm).count('one two three'), 4)
+            get_gpt2_tokenizer.assert_not_called()
+
+
+class TestCommentFilter(unittest.TestCase):
+    """ Unit Tests for CommentFilter. """
+
+    def test_drop_noise(self):
+        """
+        Test short, boilerplate and near-duplicate comments are dropped.
+        """
+        solution = ('The root cause is a bug in the bonding driver, fixed '
+                    'by upgrading the kernel to 5.15.0-100.')
+        comments = [
+            'Any update?',
+            'Hi team,\nThank you for the logs. We will get back to you '
+            'soon.\n\nRegards,\nAlice',
+            solution,
+            f'Hi John,\n{solution}\n--\nBob',
+            'The workaround is to disable GRO with ethtool.',
+        ]
+        kept, dropped = CommentFilter({}).filter(comments)
+        self.assertEqual(kept, [solution, comments[-1]])
+        self.assertEqual(dropped, {'short': 1, 'boilerplate': 1,
+                                   'duplicate': 1})
+
+    def test_keep_short_resolutions(self):
+        """
+        Test short comments mentioning a resolution are kept.
+        """
+        comments = ['Reboot fixed it.', 'Resolved by upgrading.',
+                    'Works now, thanks!', 'Any news?', 'Logs attached.']
+        kept, dropped = CommentFilter({}).filter(comments)
+        self.assertEqual(kept, comments[:3])
+        self.assertEqual(dropped, {'short': 2})
+
+
+class TestCachedEmbeddings(unittest.TestCase):
+    """ Unit Tests for CachedEmbeddings. """
+
+    def test_memory_and_disk_tiers(self):
+        """
+        Test distinct texts are embedded once, then served from memory, and
+        from disk by a new cache.
+        """
+        backend = mock.Mock(wraps=DeterministicFakeEmbedding(size=4))
+        expected = backend.embed_documents(['a', 'b', 'a'])
+        backend.reset_mock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = {'path': os.path.join(tmpdir, 'embeddings.db')}
+            embeddings = CachedEmbeddings(backend, 'fake', config)
+            self.assertEqual(embeddings.embed_documents(['a', 'b', 'a']),
+                             expected)
+            backend.embed_documents.assert_called_once_with(['a', 'b'])
+            embeddings.embed_documents(['a'])
+            self.assertEqual(embeddings.stats()['memory_hits'], 1)
+
+            embeddings = CachedEmbeddings(backend, 'fake', config)
+            self.assertEqual(embeddings.embed_documents(['b']), expected[1:2])
+            self.assertEqual(embeddings.stats()['disk_hits'], 1)
+            backend.embed_documents.assert_called_once()
+
+
+class TestEmbeddingRouter(unittest.TestCase):
+    """ Unit Tests for EmbeddingRouter. """
+
+    def test_route_by_margin(self):
+        """
+        Test queries are routed to the nearest centroid, unless the margin
+        is too low.
+        """
+        vectors = {'case': [1.0, 0.0], 'bug': [0.9, 0.1],
+                   'howto': [0.0, 1.0], 'steps': [0.1, 0.9],
+                   'both': [1.0, 1.0]}
+        embeddings = mock.Mock()
+        embeddings.embed_documents.side_effect = \
+            lambda texts: [vectors[text] for text in texts]
+        embeddings.embed_query.side_effect = vectors.get
+        router = EmbeddingRouter(embeddings, {'salesforce': ['case', 'bug'],
+                                              'knowledgebase': ['howto',
+                                                                'steps']})
+        self.assertEqual(router.route('bug'), 'salesforce')
+        self.assertEqual(router.route('steps'), 'knowledgebase')
+        self.assertIsNone(router.route('both'))
+        embeddings.embed_documents.assert_has_calls(
+                [mock.call(['case', 'bug']), mock.call(['howto', 'steps'])])
+
+
+class TestVectorStore(unittest.TestCase):
+    """ Unit Tests for VectorStore. """
+
+    def test_handles_reused(self):
+        """
+        Test a client and a collection handle are opened once per data source
+        and embedding across calls and instances, and reopened after close.
+        """
+        embeddings = DeterministicFakeEmbedding(size=4)
+        data = mock.Mock(document='doc', metadata={'i': 0}, id='0')
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(vectorstore, 'VECTORDB_DIR', tmpdir), \
+                mock.patch.object(
+                    vectorstore.chromadb, 'PersistentClient',
+                    wraps=vectorstore.chromadb.PersistentClient) as client, \
+                mock.patch.object(vectorstore, 'Chroma',
+                                  wraps=vectorstore.Chroma) as chroma:
+            store = vectorstore.VectorStore()
+            store.close()
+            store.update('test', embeddings, data)
+            store.similarity_search('test', embeddings, 'doc')
+            other = vectorstore.VectorStore()
+            other.similarity_search_with_score('test', embeddings, 'doc')
+            self.assertEqual(client.call_count, 1)
+            self.assertEqual(chroma.call_count, 1)
+
+            other.similarity_search('test',
+                                    DeterministicFakeEmbedding(size=4),
+                                    'doc')
+            self.assertEqual(client.call_count, 1)
+            self.assertEqual(chroma.call_count, 2)
+
+            store.close()
+            self.assertEqual(other.similarity_search(
+                'test', embeddings, 'doc')[0].page_content, 'doc')
+            self.assertEqual(client.call_count, 2)
+            self.assertEqual(chroma.call_count, 3)
+            other.close()
+
+    def test_rebuild_with_index_params(self):
+        """
+        Test a rebuild applies the configured index parameters and keeps the
+        stored records and their embeddings.
+        """
+        embeddings = mock.Mock(wraps=DeterministicFakeEmbedding(size=4))
+        data_list = [mock.Mock(document=f'doc {i}', metadata={'i': i},
+                               id=str(i)) for i in range(5)]
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch.object(vectorstore, 'VECTORDB_DIR', tmpdir):
+            store = vectorstore.VectorStore()
+            store.bulk_update('test', embeddings, data_list)
+            store.close()
+            store = vectorstore.VectorStore({'datasources': [{
+                'type': 'test',
+                'collection_metadata': {'space': 'cosine', 'M': 8}}]})
+            embeddings.reset_mock()
+            self.assertEqual(store.rebuild('test', batch_size=2), 5)
+            embeddings.embed_documents.assert_not_called()
+            records = [record for batch in store.iter_records('test')
+                       for record in batch['documents']]
+            self.assertCountEqual(records, [data.document
+                                            for data in data_list])
+            self.assertEqual(store.similarity_search_with_score(
+                'test', embeddings, 'doc 3', k=1)[0][0].page_content,
+                'doc 3')
+            store.close()